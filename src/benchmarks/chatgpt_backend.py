@@ -0,0 +1,97 @@
+"""Throughput of the ChatGPT IMT system against a local OpenAI-compatible
+stand-in server, which answers each prompt with its last line after a random
+delay and rejects a share of the requests with a rate-limit error. Checks
+that every request gets its own answer despite concurrency and retries.
+
+    cd src && python -m benchmarks.chatgpt_backend --src-path ../data/wmt14-ende/test.en
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from imt_environment.imt_system import ChatgptImt
+
+class StandInHandler(BaseHTTPRequestHandler):
+    latency = (0.05, 0.15)
+    rate_limit_prob = 0.1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(random.uniform(*self.latency))
+        if random.random() < self.rate_limit_prob:
+            body = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            self.reply(429, body, {"Retry-After": "0.1"})
+            return
+        prompt = request["messages"][-1]["content"]
+        answer = prompt.split("\n")[-1]
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(answer) // 4
+        self.reply(200, {
+            "id": "chatcmpl-stand-in",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def reply(self, status, body, headers={}):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--num", type=int, default=200, help="number of requests")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrency caps to compare")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.1, help="share of requests rejected by the stand-in server")
+    parser.add_argument("--rpm", type=int, default=3500, help="requests per minute limit")
+    parser.add_argument("--tpm", type=int, default=90000, help="tokens per minute limit")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    StandInHandler.rate_limit_prob = args.rate_limit_prob
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.setdefault("OPENAI_API_KEY", "stand-in")
+
+    with open(args.src_path) as src:
+        srcs = [line.strip() for line in src][:args.num]
+
+    print("{:<12} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format("concurrency", "requests", "retries", "total(s)", "req/s", "p50(ms)", "p95(ms)"))
+    for concurrency in args.concurrency:
+        imt_args = argparse.Namespace(
+            src_lang="en", tgt_lang="de",
+            chatgpt_api_base="http://127.0.0.1:{}/v1".format(server.server_address[1]),
+            chatgpt_concurrency=concurrency, chatgpt_max_retries=10,
+            chatgpt_rpm=args.rpm, chatgpt_tpm=args.tpm,
+        )
+        imt_system = ChatgptImt(imt_args)
+        start = time.perf_counter()
+        hypos = imt_system.translate_batch(srcs)
+        total = time.perf_counter() - start
+        assert hypos == [imt_system.build_prompt(src).split("\n")[-1] for src in srcs], "answers do not match their requests"
+        info = imt_system.request_info()
+        print("{:<12} {:>8} {:>8} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            concurrency, info["requests"], info["retries"], total, info["requests"] / total,
+            1000 * info["p50_latency"], 1000 * info["p95_latency"],
+        ))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Startup time and memory of an IMT system loading its fairseq checkpoint,
+against the memory-mapped checkpoint converted from it. Each load runs in a
+fresh process, --repeats times per format, timing the IMT system
+constructor and reading the private (anonymous) and file-backed resident
+memory of the process after it. The memory-mapped weights are file-backed,
+shared by all the processes mapping the same file. Both formats translate
+the first --num sentences, checked to be the same.
+
+    cd src && python -m benchmarks.checkpoint_loading --imt 0 --imt-args ../config/prefix_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+def build_imt_system(imt_type, imt_args):
+    from imt_environment.imt_system import PrefixTransformer, DBATransformer, Bitiimt, LecaImt
+    if imt_type == 0:
+        return PrefixTransformer(imt_args)
+    elif imt_type == 1:
+        return DBATransformer(imt_args)
+    elif imt_type == 2:
+        return Bitiimt(imt_args)
+    elif imt_type == 3:
+        return LecaImt(imt_args)
+
+def memory():
+    """The resident anonymous and file-backed memory of this process, in MB."""
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            status[key] = value.split()
+    return int(status["RssAnon"][0]) / 1024, int(status["RssFile"][0]) / 1024
+
+def measure(args, imt_args):
+    """Loads the IMT system in this process and prints its startup time,
+    memory and translations as JSON."""
+    logging.disable(logging.WARNING)
+    with open(args.src_path) as src:
+        sentences = [line.strip() for line in src][:args.num]
+    # the imports are the same for both formats, and not timed
+    import imt_environment.imt_system
+    before = memory()
+    start = time.perf_counter()
+    imt_system = build_imt_system(args.imt, imt_args)
+    init_time = time.perf_counter() - start
+    after = memory()
+    print(json.dumps({
+        "init_time": init_time,
+        "anon": after[0] - before[0],
+        "file": after[1] - before[1],
+        "hypos": [imt_system.translate(sentence) for sentence in sentences],
+    }))
+
+def with_paths(imt_args, paths):
+    i = imt_args.index("--path")
+    return imt_args[:i + 1] + [os.pathsep.join(paths)] + imt_args[i + 2:]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt", type=int, default=0, help="the type of imt system, as in run.py")
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of imt's args")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--num", type=int, default=5, help="number of sentences translated to compare the formats")
+    parser.add_argument("--repeats", type=int, default=3, help="loads of each format")
+    parser.add_argument("--measure", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    with open(args.imt_args) as iarg:
+        imt_args = json.load(iarg)
+    if args.measure is not None:
+        measure(args, json.loads(args.measure))
+        return
+
+    from fairseq import utils
+    from imt_environment.mmap_checkpoint import convert_checkpoint
+
+    paths = utils.split_paths(imt_args[imt_args.index("--path") + 1])
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        mmap_paths = [os.path.join(tmp, "{}.{}.mmap".format(os.path.basename(path), k)) for k, path in enumerate(paths)]
+        start = time.perf_counter()
+        for path, mmap_path in zip(paths, mmap_paths):
+            convert_checkpoint(path, mmap_path)
+        print("converted {} checkpoint(s) in {:.1f}s".format(len(paths), time.perf_counter() - start))
+
+        formats = {"torch.load": imt_args, "mmap": with_paths(imt_args, mmap_paths)}
+        results = {name: [] for name in formats}
+        # alternated, so both see the same state of the page cache
+        for _ in range(args.repeats):
+            for name, format_args in formats.items():
+                command = [sys.executable, "-m", "benchmarks.checkpoint_loading"] + sys.argv[1:] + ["--measure", json.dumps(format_args)]
+                output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+                results[name].append(json.loads(output.strip().splitlines()[-1]))
+
+    reference = results["torch.load"][0]
+    print("{:<12} {:>10} {:>10} {:>10} {:>10} {:>8}  {}".format("format", "init(s)", "min(s)", "anon(MB)", "file(MB)", "speedup", "hypos"))
+    for name, runs in results.items():
+        init_time = statistics.median(run["init_time"] for run in runs)
+        same = all(run["hypos"] == reference["hypos"] for run in runs)
+        failed = failed or not same
+        print("{:<12} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>7.1f}x  {}".format(
+            name, init_time, min(run["init_time"] for run in runs),
+            statistics.median(run["anon"] for run in runs), statistics.median(run["file"] for run in runs),
+            statistics.median(run["init_time"] for run in results["torch.load"]) / init_time,
+            "same" if same else "DIFFERENT",
+        ))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
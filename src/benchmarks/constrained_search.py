@@ -0,0 +1,87 @@
+"""Latency of the constraint-bank step of LexicallyConstrainedBeamSearch
+processed one sentence at a time and for the whole batch at once, for
+several beam sizes and numbers of constraints, checking that both give the
+same translations. The constraints of a request are words of the
+reference, in order, as a template of the DBA system would give them.
+
+    cd src && python -m benchmarks.constrained_search --imt-args ../config/dba_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en --tgt-path ../data/wmt14-ende/test.de \
+        --beams 5 10 --constraints 1 2 4 8 --batch-size 1 8
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from imt_environment.template import Template
+from imt_environment.imt_system import DBATransformer
+
+def constraint_template(words):
+    """A template keeping words, separated by blanks."""
+    revised_hypo = "_".join(words)
+    tag = []
+    for i, word in enumerate(words):
+        tag += ([4] if i > 0 else []) + [1] * len(word)
+    return Template(revised_hypo, tag)
+
+def translate_all(imt_system, requests, batch_size):
+    hypos = []
+    start = time.perf_counter()
+    for i in range(0, len(requests), batch_size):
+        batch = requests[i:i + batch_size]
+        if len(batch) == 1:
+            hypos.append(imt_system.translate(*batch[0]))
+        else:
+            hypos += imt_system.translate_batch([src for src, _ in batch], [template for _, template in batch])
+    return hypos, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of the args of a DBA system")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--tgt-path", type=str, required=True, help="file path of target language")
+    parser.add_argument("--num", type=int, default=20, help="number of sentences")
+    parser.add_argument("--beams", type=int, nargs="+", default=[5, 10], help="beam sizes")
+    parser.add_argument("--constraints", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of constraints per request")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 8], help="requests per translate call")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the constraints")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with open(args.imt_args) as iarg:
+        imt_system = DBATransformer(json.load(iarg))
+    search = imt_system.generator.search
+    with open(args.src_path) as src, open(args.tgt_path) as tgt:
+        testset = [(s.strip(), t.strip().split()) for s, t in list(zip(src, tgt))[:args.num]]
+
+    print("{:>5} {:>12} {:>6} {:>12} {:>12} {:>8}  {}".format(
+        "beam", "constraints", "batch", "loop(s)", "batched(s)", "speedup", "hypos"))
+    failed = False
+    for beam in args.beams:
+        imt_system.generator.beam_size = beam
+        for num_constraints in args.constraints:
+            rng = random.Random(args.seed)
+            requests = []
+            for src, words in testset:
+                positions = sorted(rng.sample(range(len(words)), min(num_constraints, len(words))))
+                requests.append((src, constraint_template([words[i] for i in positions])))
+            for batch_size in args.batch_size:
+                results = {}
+                for vectorized in (False, True):
+                    search.vectorized = vectorized
+                    # warm up
+                    translate_all(imt_system, requests[:batch_size], batch_size)
+                    results[vectorized] = translate_all(imt_system, requests, batch_size)
+                same = results[False][0] == results[True][0]
+                failed = failed or not same
+                print("{:>5} {:>12} {:>6} {:>12.2f} {:>12.2f} {:>7.2f}x  {}".format(
+                    beam, num_constraints, batch_size, results[False][1], results[True][1],
+                    results[False][1] / results[True][1], "same" if same else "DIFFERENT",
+                ), flush=True)
+    search.vectorized = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
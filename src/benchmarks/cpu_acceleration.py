@@ -0,0 +1,111 @@
+"""Quality/latency regression check of the CPU acceleration modes of the
+fairseq IMT systems. Every mode translates the same requests as fp32: the
+first sentences of the test set, then the same sentences with the
+Left2Right template of the fp32 translation. Hypotheses are compared with
+those of fp32 (BLEU and exact matches) and the check fails if a mode falls
+below --min-bleu.
+
+    cd src && python -m benchmarks.cpu_acceleration --imt 0 --imt-args ../config/prefix_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en --tgt-path ../data/wmt14-ende/test.de --tgt-lang de \
+        --modes fp32 int8 bf16 script int8+script
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+import sacrebleu
+
+from imt_environment.imt_system import PrefixTransformer, DBATransformer, Bitiimt, LecaImt
+from imt_environment.policy import Left2RightPolicy, utils
+
+MODE_ARGS = {
+    "fp32": [],
+    "int8": ["--quantize-int8"],
+    "bf16": ["--autocast-bf16"],
+    "script": ["--compile-layers", "script"],
+    "compile": ["--compile-layers", "compile"],
+}
+
+def build_imt_system(imt_type, imt_args):
+    if imt_type == 0:
+        return PrefixTransformer(imt_args)
+    elif imt_type == 1:
+        return DBATransformer(imt_args)
+    elif imt_type == 2:
+        return Bitiimt(imt_args)
+    elif imt_type == 3:
+        return LecaImt(imt_args)
+
+def translate_all(imt_system, requests):
+    hypos, latencies = [], []
+    for src, template in requests:
+        start = time.perf_counter()
+        hypos.append(imt_system.translate(src, template))
+        latencies.append(time.perf_counter() - start)
+    return hypos, latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt", type=int, default=0, help="the type of imt system, as in run.py")
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of imt's args")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--tgt-path", type=str, required=True, help="file path of target language")
+    parser.add_argument("--tgt-lang", type=str, required=True, help="target language")
+    parser.add_argument("--policy-spm-model", type=str, default=None, help="path of spm model used by policy")
+    parser.add_argument("--num", type=int, default=50, help="number of sentences")
+    parser.add_argument("--modes", type=str, nargs="+", default=["fp32", "int8", "bf16", "script"],
+                        help="modes to compare with fp32, combined with + (e.g. int8+script)")
+    parser.add_argument("--min-bleu", type=float, default=90, help="lowest BLEU against the fp32 hypotheses that passes")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with open(args.imt_args) as iarg:
+        imt_args = json.load(iarg)
+    if args.policy_spm_model is not None:
+        tokenizer = utils.SentencePieceTokenizer(args.policy_spm_model)
+    else:
+        tokenizer = utils.SpaceTokenizer()
+    with open(args.src_path) as src, open(args.tgt_path) as tgt:
+        testset = [(s.strip(), t.strip()) for s, t in list(zip(src, tgt))[:args.num]]
+    tokenize = "zh" if args.tgt_lang == "zh" else "13a"
+
+    reference = None
+    print("{:<14} {:>10} {:>10} {:>10} {:>8} {:>8} {:>8}  {}".format(
+        "mode", "total(s)", "mean(ms)", "p95(ms)", "speedup", "bleu", "exact", "check"))
+    failed = False
+    for mode in ["fp32"] + [mode for mode in args.modes if mode != "fp32"]:
+        mode_args = [arg for name in mode.split("+") for arg in MODE_ARGS[name]]
+        imt_system = build_imt_system(args.imt, imt_args + mode_args)
+        if reference is None:
+            hypos, _ = translate_all(imt_system, [(src, None) for src, _ in testset])
+            policy = Left2RightPolicy(tokenizer, n=1)
+            requests = [(src, None) for src, _ in testset]
+            for (src, tgt), hypo in zip(testset, hypos):
+                policy.initialize_episode()
+                template, _, failed_revision = policy.revise(hypo, tgt)
+                if not failed_revision:
+                    requests.append((src, template))
+        # compiled layers are built on the first calls
+        translate_all(imt_system, requests[:2])
+        hypos, latencies = translate_all(imt_system, requests)
+        if reference is None:
+            reference = (hypos, sum(latencies))
+        bleu = sacrebleu.corpus_bleu(hypos, [reference[0]], tokenize=tokenize).score
+        exact = sum(h == r for h, r in zip(hypos, reference[0])) / len(hypos)
+        passed = bleu >= args.min_bleu
+        failed = failed or not passed
+        print("{:<14} {:>10.2f} {:>10.1f} {:>10.1f} {:>7.2f}x {:>8.2f} {:>7.1%}  {}".format(
+            mode, sum(latencies), 1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 0.95),
+            reference[1] / sum(latencies), bleu, exact, "ok" if passed else "FAIL",
+        ), flush=True)
+        del imt_system
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
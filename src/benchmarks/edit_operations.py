@@ -0,0 +1,129 @@
+"""Compare policy.utils.edit_operations with the original cell-by-cell
+implementation on the WMT test sets and on long synthetic pairs.
+
+    cd src && python -m benchmarks.edit_operations
+"""
+import argparse
+import glob
+import os
+import random
+import time
+import numpy as np
+
+from imt_environment.policy.utils import edit_operations, SpaceTokenizer, ZhTokenizer
+
+def edit_operations_reference(src, tgt):
+    src_len = len(src)
+    tgt_len = len(tgt)
+    dis = np.ones((src_len + 1, tgt_len + 1), dtype=int) * 1000
+    dis[:, 0] = np.arange(src_len + 1)
+    dis[0, :] = np.arange(tgt_len + 1)
+    op = np.zeros_like(dis) # 0: keep 1: insert 2: delete 3: replace
+    op[0, 1:] = np.ones(tgt_len, dtype=int)
+    op[1:, 0] = np.ones(src_len, dtype=int) * 2
+    for i in range(1, src_len + 1):
+        for j in range(1, tgt_len + 1):
+            diagonal = dis[i - 1, j - 1] + int(src[i - 1] != tgt[j - 1])
+            dis[i, j] = min(dis[i - 1, j] + 1, dis[i, j - 1] + 1, diagonal)
+            if dis[i, j] == dis[i, j - 1] + 1:
+                op[i, j] = 1
+            elif dis[i, j] == diagonal > dis[i - 1, j - 1]:
+                op[i, j] = 3
+            elif dis[i, j] == dis[i - 1, j] + 1:
+                op[i, j] = 2
+    i, j = src_len, tgt_len
+    op_list = []
+    while i > 0 or j > 0:
+        if op[i, j] == 0:
+            i -= 1
+            j -= 1
+            op_list.insert(0, ("keep", i, j))
+        elif op[i, j] == 1:
+            j -= 1
+            op_list.insert(0, ("ins", i, j))
+        elif op[i, j] == 2:
+            i -= 1
+            op_list.insert(0, ("del", i, j))
+        else:
+            i -= 1
+            j -= 1
+            op_list.insert(0, ("repl", i, j))
+    return op_list, dis
+
+def perturb(words, rng, rate):
+    """A hypothesis-like copy of words with deleted, inserted, replaced and
+    moved tokens."""
+    hypo = list(words)
+    for _ in range(max(1, int(len(words) * rate))):
+        action = rng.randrange(4)
+        pos = rng.randrange(len(hypo) + 1)
+        if action == 0 and pos < len(hypo):
+            hypo.pop(pos)
+        elif action == 1:
+            hypo.insert(pos, rng.choice(words))
+        elif action == 2 and pos < len(hypo):
+            hypo[pos] = rng.choice(words)
+        elif pos < len(hypo):
+            span = hypo[pos: pos + 3]
+            del hypo[pos: pos + 3]
+            new_pos = rng.randrange(len(hypo) + 1)
+            hypo[new_pos: new_pos] = span
+    return hypo
+
+def load_pairs(path, tokenizer, rng, rate):
+    with open(path) as f:
+        refs = [tokenizer.encode(line.strip()) for line in f if line.strip()]
+    return [(perturb(ref, rng, rate), ref) for ref in refs]
+
+def synthetic_pairs(pairs, rng, rate, min_len, num):
+    refs = [ref for _, ref in pairs]
+    long_pairs = []
+    for _ in range(num):
+        ref = []
+        while len(ref) < min_len:
+            ref += rng.choice(refs)
+        long_pairs.append((perturb(ref, rng, rate), ref))
+    return long_pairs
+
+def bench(fn, pairs, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for hypo, ref in pairs:
+            fn(hypo, ref)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default="../data", help="dir of the WMT test sets")
+    parser.add_argument("--zh-spm-model", type=str, default="../zh40k.model", help="spm model used to tokenize Chinese")
+    parser.add_argument("--rate", type=float, default=0.3, help="ratio of edited tokens in a hypothesis")
+    parser.add_argument("--num", type=int, default=None, help="number of sentences used from each test set")
+    parser.add_argument("--long-len", type=int, default=200, help="minimum length of the synthetic pairs")
+    parser.add_argument("--long-num", type=int, default=20, help="number of synthetic pairs")
+    parser.add_argument("--repeat", type=int, default=3, help="take the best time of this many runs")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tests = []
+    for path in sorted(glob.glob(os.path.join(args.data_dir, "wmt*", "test.*"))):
+        tokenizer = ZhTokenizer(args.zh_spm_model) if path.endswith(".zh") else SpaceTokenizer()
+        pairs = load_pairs(path, tokenizer, rng, args.rate)[:args.num]
+        tests.append((os.path.relpath(path, args.data_dir), pairs))
+    tests.append(("synthetic {}+ tokens".format(args.long_len), synthetic_pairs(
+        [p for _, pairs in tests for p in pairs], rng, args.rate, args.long_len, args.long_num
+    )))
+
+    print("{:<28} {:>6} {:>8} {:>12} {:>12} {:>8}".format("test set", "pairs", "avg len", "original(s)", "new(s)", "speedup"))
+    for name, pairs in tests:
+        for hypo, ref in pairs:
+            assert edit_operations(hypo, ref)[0] == edit_operations_reference(hypo, ref)[0], (hypo, ref)
+        original = bench(edit_operations_reference, pairs, args.repeat)
+        new = bench(edit_operations, pairs, args.repeat)
+        avg_len = sum(len(hypo) + len(ref) for hypo, ref in pairs) / 2 / len(pairs)
+        print("{:<28} {:>6} {:>8.1f} {:>12.3f} {:>12.3f} {:>7.1f}x".format(name, len(pairs), avg_len, original, new, original / new))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""End-to-end throughput of IMTLab without the released checkpoints, in the
+spirit of fairseq/benchmark/dummy_mt.py. For each language pair of data/ it
+trains a small sentencepiece model on the test sets, builds the dictionary
+from its pieces and saves tiny randomly initialised transformer and LeCA
+models, then runs every policy x IMT system pair (the --imt and --policy
+types of run.py; BiTIIMT and DBA use the transformer) on the first sentences
+of the test set on CPU. The translations are garbage, the amount of work per
+turn is that of real models of the same vocabulary and output length.
+
+    cd src && python -m benchmarks.end_to_end --output results.json
+    cd src && python -m benchmarks.end_to_end --pairs wmt14-ende --baseline results.json
+
+Reports episodes/sec, turns/sec, the p50/p95 latency of a turn and the peak
+RSS of the process after each run, and writes them as JSON to --output;
+--baseline prints the turns/sec of each run relative to an earlier output.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+import torch
+import sentencepiece as spm
+from fairseq import options, tasks
+from fairseq.data import Dictionary
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+
+from imt_environment.environment import Environment
+from imt_environment.imt_system import PrefixTransformer, DBATransformer, Bitiimt, LecaImt
+from imt_environment.policy import (
+    MtpePolicy,
+    Left2RightPolicy,
+    RandomPolicy,
+    Left2RightInfillingPolicy,
+    RandomInfillingPolicy,
+    utils,
+)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+PAIRS = ["wmt14-ende", "wmt14-deen", "wmt17-enzh", "wmt17-zhen"]
+SYSTEMS = {0: "prefix", 1: "dba", 2: "bitiimt", 3: "leca"}
+POLICIES = {0: "mtpe", 1: "left2right", 2: "random", 3: "left2right_infilling", 4: "random_infilling"}
+SPECIAL_SYMBOLS = ["<sep>", "<blank>", "<eob>"]
+
+def build_models(model_dir, data_dir, src_lang, tgt_lang, args):
+    """Writes spm.model, the joined dictionaries, transformer.pt and leca.pt
+    to model_dir."""
+    spm_prefix = os.path.join(model_dir, "spm")
+    spm.SentencePieceTrainer.train(
+        input=",".join(os.path.join(data_dir, "test." + lang) for lang in (src_lang, tgt_lang)),
+        model_prefix=spm_prefix, vocab_size=args.vocab_size, minloglevel=2,
+    )
+    sp = spm.SentencePieceProcessor(model_file=spm_prefix + ".model")
+    dictionary = Dictionary()
+    for i in range(sp.get_piece_size()):
+        piece = sp.id_to_piece(i)
+        if piece not in ("<unk>", "<s>", "</s>"):
+            dictionary.add_symbol(piece)
+    # the template symbols of BiTIIMT and LeCA
+    for symbol in SPECIAL_SYMBOLS:
+        dictionary.add_symbol(symbol)
+    for lang in (src_lang, tgt_lang):
+        dictionary.save(os.path.join(model_dir, "dict.{}.txt".format(lang)))
+
+    for arch, task, name in (("transformer", "translation", "transformer"), ("leca_base", "leca_translation", "leca")):
+        model_args = options.parse_args_and_arch(options.get_training_parser(), [
+            model_dir, "--task", task, "--arch", arch, "-s", src_lang, "-t", tgt_lang,
+            "--encoder-layers", str(args.layers), "--decoder-layers", str(args.layers),
+            "--encoder-embed-dim", str(args.embed_dim), "--decoder-embed-dim", str(args.embed_dim),
+            "--encoder-ffn-embed-dim", str(4 * args.embed_dim), "--decoder-ffn-embed-dim", str(4 * args.embed_dim),
+            "--encoder-attention-heads", "4", "--decoder-attention-heads", "4",
+            "--share-all-embeddings", "--seed", str(args.seed),
+        ])
+        cfg = convert_namespace_to_omegaconf(model_args)
+        torch.manual_seed(args.seed)
+        model = tasks.setup_task(cfg.task).build_model(cfg.model)
+        torch.save({
+            "cfg": cfg, "model": model.state_dict(), "args": None, "extra_state": {},
+            "optimizer_history": [{
+                "criterion_name": "CrossEntropyCriterion", "optimizer_name": "Adam",
+                "lr_scheduler_state": {"best": None}, "num_updates": 0,
+            }],
+        }, os.path.join(model_dir, name + ".pt"))
+
+def build_imt_system(imt_type, model_dir, src_lang, tgt_lang, args):
+    checkpoint = "leca.pt" if imt_type == 3 else "transformer.pt"
+    imt_args = [
+        model_dir, "--path", os.path.join(model_dir, checkpoint),
+        "--task", "leca_translation" if imt_type == 3 else "translation",
+        "--bpe", "sentencepiece", "--sentencepiece-model", os.path.join(model_dir, "spm.model"),
+        "-s", src_lang, "-t", tgt_lang, "--beam", str(args.beam), "--cpu",
+        # random models rarely stop by themselves, bound their outputs like
+        # trained ones that end near the source length
+        "--max-len-a", "1.2", "--max-len-b", "10",
+    ]
+    if imt_type == 1:
+        return DBATransformer(imt_args + ["--constraints"])
+    elif imt_type == 2:
+        return Bitiimt(imt_args)
+    elif imt_type == 3:
+        return LecaImt(imt_args + ["--left-pad-source"])
+    return PrefixTransformer(imt_args)
+
+def build_policy(policy_type, tokenizer, seed):
+    if policy_type == 0:
+        return MtpePolicy(tokenizer)
+    elif policy_type == 1:
+        return Left2RightPolicy(tokenizer, n=1)
+    elif policy_type == 2:
+        return RandomPolicy(tokenizer, seed)
+    elif policy_type == 3:
+        return Left2RightInfillingPolicy(tokenizer)
+    elif policy_type == 4:
+        return RandomInfillingPolicy(tokenizer, seed)
+
+def run_episodes(imt_system, policy_type, tokenizer, testset, seed):
+    """Runs one episode per sentence with the seeds of run.py's
+    --per-episode-seed, returns the total time and the time of every turn."""
+    env = Environment(imt_system, None)
+    latencies = []
+    start = time.perf_counter()
+    for i, (src, tgt) in enumerate(testset):
+        env.policy = build_policy(policy_type, tokenizer, seed + i)
+        env.initialize_episode(src, tgt, i)
+        episode_over = False
+        while not episode_over:
+            turn_start = time.perf_counter()
+            episode_over, _ = env.next_turn()
+            latencies.append(time.perf_counter() - turn_start)
+    return time.perf_counter() - start, latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default=DATA_DIR, help="directory with one sub-directory of test sets per language pair")
+    parser.add_argument("--pairs", type=str, nargs="+", default=PAIRS, help="language pairs to run")
+    parser.add_argument("--imt", type=int, nargs="+", default=list(SYSTEMS), help="types of imt system to run, as in run.py")
+    parser.add_argument("--policy", type=int, nargs="+", default=list(POLICIES), help="types of policy to run, as in run.py")
+    parser.add_argument("--num", type=int, default=5, help="number of episodes per run")
+    parser.add_argument("--policy-seed", type=int, default=1, help="random seed for policy")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the model weights")
+    parser.add_argument("--vocab-size", type=int, default=2000, help="size of the sentencepiece vocabulary")
+    parser.add_argument("--embed-dim", type=int, default=64, help="embedding dim of the models, the ffn dim is 4 times larger")
+    parser.add_argument("--layers", type=int, default=2, help="encoder and decoder layers of the models")
+    parser.add_argument("--beam", type=int, default=5, help="beam size")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", type=str, default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", type=str, default=None, help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            for run in json.load(f)["runs"]:
+                baseline[run["pair"], run["imt"], run["policy"]] = run
+
+    runs = []
+    print("{:<11} {:<8} {:<21} {:>5} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8}{}".format(
+        "pair", "imt", "policy", "turns", "total(s)", "eps/s", "turns/s", "p50(ms)", "p95(ms)", "rss(MB)",
+        " {:>8}".format("vs base") if baseline else "",
+    ))
+    for pair in args.pairs:
+        data_dir = os.path.join(args.data_dir, pair)
+        src_lang, tgt_lang = pair[-4:-2], pair[-2:]
+        with open(os.path.join(data_dir, "test." + src_lang)) as src, open(os.path.join(data_dir, "test." + tgt_lang)) as tgt:
+            testset = list(zip(src, tgt))[:args.num]
+        with tempfile.TemporaryDirectory() as model_dir:
+            build_models(model_dir, data_dir, src_lang, tgt_lang, args)
+            # the policies of run.py split words at spaces, chinese needs pieces
+            if tgt_lang == "zh":
+                tokenizer = utils.SentencePieceTokenizer(os.path.join(model_dir, "spm.model"))
+            else:
+                tokenizer = utils.SpaceTokenizer()
+            for imt_type in args.imt:
+                imt_system = build_imt_system(imt_type, model_dir, src_lang, tgt_lang, args)
+                for policy_type in args.policy:
+                    total, latencies = run_episodes(imt_system, policy_type, tokenizer, testset, args.policy_seed)
+                    run = {
+                        "pair": pair, "imt": SYSTEMS[imt_type], "policy": POLICIES[policy_type],
+                        "episodes": len(testset), "turns": len(latencies), "total": total,
+                        "episodes_per_sec": len(testset) / total, "turns_per_sec": len(latencies) / total,
+                        "p50_latency": percentile(latencies, 0.5), "p95_latency": percentile(latencies, 0.95),
+                        "peak_rss_mb": peak_rss_mb(),
+                    }
+                    runs.append(run)
+                    base = baseline.get((pair, run["imt"], run["policy"]))
+                    print("{:<11} {:<8} {:<21} {:>5} {:>10.2f} {:>8.2f} {:>8.2f} {:>8.1f} {:>8.1f} {:>8.0f}{}".format(
+                        pair, run["imt"], run["policy"], run["turns"], total, run["episodes_per_sec"], run["turns_per_sec"],
+                        1000 * run["p50_latency"], 1000 * run["p95_latency"], run["peak_rss_mb"],
+                        " {:>7.2f}x".format(run["turns_per_sec"] / base["turns_per_sec"]) if base is not None else "",
+                    ), flush=True)
+                del imt_system
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": git_commit(), "torch": torch.__version__, "threads": torch.get_num_threads(),
+                "args": vars(args), "runs": runs,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
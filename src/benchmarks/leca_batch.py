@@ -0,0 +1,106 @@
+"""Throughput of a LeCA system translating the requests of episodes one at
+a time (translate) and in batches (translate_batch), for several batch
+sizes, checking that both give the same translations. The requests are
+recorded from episodes of --policy on the first sentences of the test set,
+so a batch mixes requests with and without constraints, and with different
+source lengths and numbers of constraints.
+
+    cd src && python -m benchmarks.leca_batch --imt-args ../config/leca_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en --tgt-path ../data/wmt14-ende/test.de \
+        --batch-size 2 4 8 16
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from imt_environment.environment import Environment
+from imt_environment.imt_system import LecaImt
+from imt_environment.policy import Left2RightPolicy, RandomPolicy, Left2RightInfillingPolicy, RandomInfillingPolicy, utils
+
+def build_policy(policy_type, tokenizer, seed):
+    if policy_type == 1:
+        return Left2RightPolicy(tokenizer, n=1)
+    elif policy_type == 2:
+        return RandomPolicy(tokenizer, seed)
+    elif policy_type == 3:
+        return Left2RightInfillingPolicy(tokenizer)
+    elif policy_type == 4:
+        return RandomInfillingPolicy(tokenizer, seed)
+
+def record_requests(imt_system, policy_type, tokenizer, testset, seed):
+    requests = []
+    translate = imt_system.translate
+    def recorded_translate(src, template=None):
+        requests.append((src, template))
+        return translate(src, template)
+    imt_system.translate = recorded_translate
+    try:
+        env = Environment(imt_system, None)
+        for i, (src, tgt) in enumerate(testset):
+            env.policy = build_policy(policy_type, tokenizer, seed + i)
+            env.initialize_episode(src, tgt)
+            episode_over = False
+            while not episode_over:
+                episode_over, _ = env.next_turn()
+    finally:
+        del imt_system.translate
+    return requests
+
+def translate_all(imt_system, requests, batch_size):
+    hypos = []
+    start = time.perf_counter()
+    for i in range(0, len(requests), batch_size):
+        batch = requests[i:i + batch_size]
+        if batch_size == 1:
+            hypos.append(imt_system.translate(*batch[0]))
+        else:
+            hypos += imt_system.translate_batch([src for src, _ in batch], [template for _, template in batch])
+    return hypos, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of the args of a LeCA system")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--tgt-path", type=str, required=True, help="file path of target language")
+    parser.add_argument("--policy", type=int, default=4, help="type of policy whose templates are used, as in run.py")
+    parser.add_argument("--policy-spm-model", type=str, default=None, help="path of spm model used by policy")
+    parser.add_argument("--num", type=int, default=20, help="number of sentences")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[2, 4, 8, 16], help="requests per translate_batch call")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with open(args.imt_args) as iarg:
+        imt_system = LecaImt(json.load(iarg))
+    # batches are bounded by --batch-size of this benchmark only
+    imt_system.cfg.dataset.batch_size = None
+    imt_system.cfg.dataset.max_tokens = None
+    if args.policy_spm_model is not None:
+        tokenizer = utils.SentencePieceTokenizer(args.policy_spm_model)
+    else:
+        tokenizer = utils.SpaceTokenizer()
+    with open(args.src_path) as src, open(args.tgt_path) as tgt:
+        testset = list(zip(src, tgt))[:args.num]
+    requests = record_requests(imt_system, args.policy, tokenizer, testset, 1)
+    constrained = sum(template is not None and bool(template.get_constraints()) for _, template in requests)
+    print("{} requests, {} with constraints".format(len(requests), constrained))
+
+    # warm up
+    translate_all(imt_system, requests[:2], 1)
+    single_hypos, single_time = translate_all(imt_system, requests, 1)
+    print("{:>6} {:>10} {:>12} {:>8}  {}".format("batch", "time(s)", "requests/s", "speedup", "hypos"))
+    print("{:>6} {:>10.2f} {:>12.2f} {:>8}".format(1, single_time, len(requests) / single_time, ""), flush=True)
+    failed = False
+    for batch_size in args.batch_size:
+        hypos, batch_time = translate_all(imt_system, requests, batch_size)
+        same = hypos == single_hypos
+        failed = failed or not same
+        print("{:>6} {:>10.2f} {:>12.2f} {:>7.2f}x  {}".format(
+            batch_size, batch_time, len(requests) / batch_time, single_time / batch_time,
+            "same" if same else "DIFFERENT",
+        ), flush=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Per-step latency of the LeCA decoder with the source masks and the
+pointer gate projection of the encoder output computed at every step and
+kept in the incremental state, checking that both give the same
+translations. The constraints of a request are words of the reference, in
+order, as a template would keep them.
+
+    cd src && python -m benchmarks.leca_decoder --imt-args ../config/leca_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en --tgt-path ../data/wmt14-ende/test.de \
+        --constraints 0 2 4 --batch-size 1 8
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+
+from imt_environment.imt_system import LecaImt
+from benchmarks.constrained_search import constraint_template
+
+def translate_all(imt_system, requests, batch_size):
+    """The translations of requests and the latency of each decoder step."""
+    model = imt_system.generator.model
+    forward_decoder = model.forward_decoder
+    step_times = []
+    def timed_forward_decoder(*args, **kwargs):
+        start = time.perf_counter()
+        result = forward_decoder(*args, **kwargs)
+        step_times.append(time.perf_counter() - start)
+        return result
+    model.forward_decoder = timed_forward_decoder
+    try:
+        hypos = []
+        for i in range(0, len(requests), batch_size):
+            batch = requests[i:i + batch_size]
+            if batch_size == 1:
+                hypos.append(imt_system.translate(*batch[0]))
+            else:
+                hypos += imt_system.translate_batch([src for src, _ in batch], [template for _, template in batch])
+    finally:
+        del model.forward_decoder
+    return hypos, step_times
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of the args of a LeCA system")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--tgt-path", type=str, required=True, help="file path of target language")
+    parser.add_argument("--num", type=int, default=20, help="number of sentences")
+    parser.add_argument("--constraints", type=int, nargs="+", default=[0, 2, 4], help="numbers of constraints per request")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 8], help="requests per translate call")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the constraints")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with open(args.imt_args) as iarg:
+        imt_system = LecaImt(json.load(iarg))
+    imt_system.cfg.dataset.batch_size = None
+    imt_system.cfg.dataset.max_tokens = None
+    decoder = imt_system.models[0].decoder
+    with open(args.src_path) as src, open(args.tgt_path) as tgt:
+        testset = [(s.strip(), t.strip().split()) for s, t in list(zip(src, tgt))[:args.num]]
+
+    print("{:>12} {:>6} {:>7} {:>14} {:>14} {:>14} {:>14} {:>8}  {}".format(
+        "constraints", "batch", "steps", "step(ms)", "cached(ms)", "p95(ms)", "cached p95", "speedup", "hypos"))
+    failed = False
+    for num_constraints in args.constraints:
+        rng = random.Random(args.seed)
+        requests = []
+        for src, words in testset:
+            if num_constraints == 0:
+                requests.append((src, None))
+                continue
+            positions = sorted(rng.sample(range(len(words)), min(num_constraints, len(words))))
+            requests.append((src, constraint_template([words[i] for i in positions])))
+        for batch_size in args.batch_size:
+            results = {}
+            for cache_source in (False, True):
+                decoder.cache_source = cache_source
+                # warm up
+                translate_all(imt_system, requests[:batch_size], batch_size)
+                results[cache_source] = translate_all(imt_system, requests, batch_size)
+            same = results[False][0] == results[True][0]
+            failed = failed or not same
+            means = [1000 * statistics.mean(results[c][1]) for c in (False, True)]
+            p95s = [1000 * statistics.quantiles(results[c][1], n=20)[-1] for c in (False, True)]
+            print("{:>12} {:>6} {:>7} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.3f} {:>7.2f}x  {}".format(
+                num_constraints, batch_size, len(results[True][1]), means[0], means[1], p95s[0], p95s[1],
+                means[0] / means[1], "same" if same else "DIFFERENT",
+            ), flush=True)
+    decoder.cache_source = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Latency of PrefixTransformer forcing the prefix step by step, priming it
+in one pass, and priming it from the decoder state kept from the previous
+turn, on Left2Right episodes, checking that all give the same translations.
+
+    cd src && python -m benchmarks.prefix_priming --imt-args ../config/prefix_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en --tgt-path ../data/wmt14-ende/test.de
+"""
+import argparse
+import json
+import logging
+import time
+
+from imt_environment.environment import Environment
+from imt_environment.imt_system import PrefixTransformer
+from imt_environment.policy import Left2RightPolicy, utils
+from fairseq.sequence_generator import PrefixStateCache
+
+def run_episodes(imt_system, policy, testset):
+    """Runs one episode per sentence, returns the hypotheses of every turn
+    and the time spent in each translate call."""
+    hypos, latencies = [], []
+    translate = imt_system.translate
+    def timed_translate(src, template=None):
+        start = time.perf_counter()
+        hypo = translate(src, template)
+        latencies.append(time.perf_counter() - start)
+        hypos.append(hypo)
+        return hypo
+    imt_system.translate = timed_translate
+    try:
+        env = Environment(imt_system, policy)
+        for src, tgt in testset:
+            env.initialize_episode(src, tgt)
+            episode_over = False
+            while not episode_over:
+                episode_over, _ = env.next_turn()
+    finally:
+        del imt_system.translate
+    return hypos, latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of imt's args")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--tgt-path", type=str, required=True, help="file path of target language")
+    parser.add_argument("--policy-spm-model", type=str, default=None, help="path of spm model used by policy")
+    parser.add_argument("--num", type=int, default=50, help="number of episodes")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with open(args.imt_args) as iarg:
+        imt_system = PrefixTransformer(json.load(iarg))
+    if args.policy_spm_model is not None:
+        tokenizer = utils.SentencePieceTokenizer(args.policy_spm_model)
+    else:
+        tokenizer = utils.SpaceTokenizer()
+    with open(args.src_path) as src, open(args.tgt_path) as tgt:
+        testset = list(zip(src, tgt))[:args.num]
+
+    results = {}
+    cache = PrefixStateCache(imt_system.decoder_cache_bytes)
+    for mode, prime_prefix, prefix_state_cache in (("forced", False, None), ("primed", True, None), ("cached", True, cache)):
+        imt_system.prime_prefix = prime_prefix
+        imt_system.generator.prefix_state_cache = prefix_state_cache
+        results[mode] = run_episodes(imt_system, Left2RightPolicy(tokenizer, n=1), testset)
+        assert results[mode][0] == results["forced"][0], "{} changed the translations".format(mode)
+
+    print("{:<10} {:>8} {:>10} {:>10} {:>10} {:>10}".format("mode", "turns", "total(s)", "mean(ms)", "p50(ms)", "p95(ms)"))
+    for mode, (_, latencies) in results.items():
+        print("{:<10} {:>8} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            mode, len(latencies), sum(latencies),
+            1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.95),
+        ))
+    for mode in ("primed", "cached"):
+        print("{} speedup: {:.2f}x".format(mode, sum(results["forced"][1]) / sum(results[mode][1])))
+    print("decoder state cache: {}".format(cache.cache_info()))
+
+if __name__ == "__main__":
+    main()
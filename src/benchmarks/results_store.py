@@ -0,0 +1,108 @@
+"""Time to aggregate the results of a grid of runs from the columnar results
+store, against reading the episode journals of the same runs. The episodes
+are synthetic: --systems x --policies x --pairs x --seeds runs of --episodes
+episodes each, written both as journals and to a store in a temporary
+directory. Both give the success rate, turns and response time of each
+system x policy, checked to be the same.
+
+    cd src && python -m benchmarks.results_store --seeds 10 --episodes 500
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from imt_environment.journal import EpisodeJournal, load_journals
+from imt_environment.results import ResultsStore, aggregate, episode_records
+
+def random_state(rng):
+    turns = rng.randint(1, 8)
+    cached_turns = rng.randint(0, turns - 1)
+    return {
+        "turn": turns,
+        "editing_cost": rng.randint(0, 80),
+        "normalized_editing_cost": rng.random(),
+        "success": rng.random() < 0.9,
+        "response_time": rng.random() * (turns - cached_turns),
+        "cached_turns": cached_turns,
+        "cached_response_time": 0.001 * cached_turns,
+        "consistency": rng.randint(0, 10),
+    }
+
+def aggregate_journals(runs):
+    """The sums of the results of each system x policy, from the journals,
+    as run.py would compute them run by run."""
+    groups = {}
+    for meta, path in runs:
+        group = groups.setdefault((meta["system"], meta["policy"]), {"episodes": 0, "success": 0, "turns": 0, "response_time": 0., "translated": 0})
+        for state in load_journals([path]).values():
+            group["episodes"] += 1
+            group["success"] += int(state["success"])
+            group["turns"] += state["turn"]
+            translated_turns = state["turn"] - state["cached_turns"]
+            if translated_turns > 0:
+                group["response_time"] += state["response_time"] / translated_turns
+                group["translated"] += 1
+    return {key: {
+        "success_rate": group["success"] / group["episodes"],
+        "avg_turns": group["turns"] / group["episodes"],
+        "avg_response_time": group["response_time"] / group["translated"],
+    } for key, group in groups.items()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--systems", type=int, default=4, help="number of IMT systems")
+    parser.add_argument("--policies", type=int, default=5, help="number of policies")
+    parser.add_argument("--pairs", type=int, default=4, help="number of language pairs")
+    parser.add_argument("--seeds", type=int, default=10, help="number of policy seeds")
+    parser.add_argument("--episodes", type=int, default=500, help="episodes per run")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ResultsStore(os.path.join(tmp, "results"))
+        runs = []
+        start = time.perf_counter()
+        for system in range(args.systems):
+            for policy in range(args.policies):
+                for pair in range(args.pairs):
+                    for seed in range(args.seeds):
+                        meta = {"system": "system{}".format(system), "policy": "policy{}".format(policy), "pair": "pair{}".format(pair), "seed": seed}
+                        states = {i: random_state(rng) for i in range(args.episodes)}
+                        path = os.path.join(tmp, "journal.{}".format(len(runs)))
+                        journal = EpisodeJournal(path, fsync_every=args.episodes)
+                        for i, state in states.items():
+                            journal.append(i, state)
+                        journal.close()
+                        runs.append((meta, path))
+                        store.write(meta, episode_records(states))
+        print("{} runs of {} episodes written in {:.1f}s".format(len(runs), args.episodes, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        expected = aggregate_journals(runs)
+        journal_time = time.perf_counter() - start
+        start = time.perf_counter()
+        store.table()
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        table_runs, table = store.table()
+        rows = aggregate(table_runs, table, ["system", "policy"])
+        store_time = time.perf_counter() - start
+
+    failed = False
+    for row in rows:
+        reference = expected[(row["system"], row["policy"])]
+        # the store keeps float32 columns
+        if any(abs(row[key] - reference[key]) > 1e-4 * max(1, abs(reference[key])) for key in reference):
+            failed = True
+            print("DIFFERENT {} x {}: {} != {}".format(row["system"], row["policy"], {key: row[key] for key in reference}, reference))
+    print("{:>28} {:>10}".format("", "time(ms)"))
+    print("{:>28} {:>10.1f}".format("journals", 1000 * journal_time))
+    print("{:>28} {:>10.1f}".format("store, building the table", 1000 * build_time))
+    print("{:>28} {:>10.1f}  {:.0f}x  {}".format("store", 1000 * store_time, journal_time / store_time, "DIFFERENT" if failed else "same"))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Time the IMT systems spend building their model inputs from the
+templates of episodes, from strings (encode_fn on the text of the template,
+then the dictionary) and from token ids (TemplateEncoder), checking that
+both give the same inputs. The requests are recorded from episodes of
+--policy on the first sentences of the test set.
+
+    cd src && python -m benchmarks.token_templates --imt 2 --imt-args ../config/bitiimt_wmt14ende.json \
+        --src-path ../data/wmt14-ende/test.en --tgt-path ../data/wmt14-ende/test.de
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+import torch
+
+from imt_environment.environment import Environment
+from imt_environment.imt_system import PrefixTransformer, DBATransformer, Bitiimt, LecaImt
+from imt_environment.policy import Left2RightPolicy, RandomPolicy, Left2RightInfillingPolicy, RandomInfillingPolicy, utils
+
+def build_imt_system(imt_type, imt_args):
+    if imt_type == 0:
+        return PrefixTransformer(imt_args)
+    elif imt_type == 1:
+        return DBATransformer(imt_args)
+    elif imt_type == 2:
+        return Bitiimt(imt_args)
+    elif imt_type == 3:
+        return LecaImt(imt_args)
+
+def build_policy(policy_type, tokenizer, seed):
+    if policy_type == 1:
+        return Left2RightPolicy(tokenizer, n=1)
+    elif policy_type == 2:
+        return RandomPolicy(tokenizer, seed)
+    elif policy_type == 3:
+        return Left2RightInfillingPolicy(tokenizer)
+    elif policy_type == 4:
+        return RandomInfillingPolicy(tokenizer, seed)
+
+def record_requests(imt_system, policy_type, tokenizer, testset, seed):
+    requests = []
+    translate = imt_system.translate
+    def recorded_translate(src, template=None):
+        if template is not None:
+            requests.append((src, template))
+        return translate(src, template)
+    imt_system.translate = recorded_translate
+    try:
+        env = Environment(imt_system, None)
+        for i, (src, tgt) in enumerate(testset):
+            env.policy = build_policy(policy_type, tokenizer, seed + i)
+            env.initialize_episode(src, tgt)
+            episode_over = False
+            while not episode_over:
+                episode_over, _ = env.next_turn()
+    finally:
+        del imt_system.translate
+    return requests
+
+def model_input(imt_system, src, template):
+    """What the system gives the model for a request, besides the source."""
+    if isinstance(imt_system, PrefixTransformer):
+        return imt_system.encode_prefix(template)
+    elif isinstance(imt_system, DBATransformer):
+        return imt_system.encode_constraints(template)
+    elif imt_system.token_templates:
+        input = imt_system.encode_input(src, template)
+        return input[0] if isinstance(imt_system, Bitiimt) else input
+    else:
+        input = imt_system.encode_fn(src) + imt_system.build_template(template)
+        return imt_system.src_dict.encode_line(input, add_if_not_exist=False).long()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imt", type=int, default=0, help="the type of imt system, as in run.py")
+    parser.add_argument("--imt-args", type=str, required=True, help="the path of imt's args")
+    parser.add_argument("--src-path", type=str, required=True, help="file path of source language")
+    parser.add_argument("--tgt-path", type=str, required=True, help="file path of target language")
+    parser.add_argument("--policy", type=int, nargs="+", default=[1, 2, 3, 4], help="types of policy whose templates are used, as in run.py")
+    parser.add_argument("--policy-spm-model", type=str, default=None, help="path of spm model used by policy")
+    parser.add_argument("--num", type=int, default=20, help="number of sentences")
+    parser.add_argument("--repeat", type=int, default=5, help="times each request is encoded")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with open(args.imt_args) as iarg:
+        imt_system = build_imt_system(args.imt, json.load(iarg))
+    if args.policy_spm_model is not None:
+        tokenizer = utils.SentencePieceTokenizer(args.policy_spm_model)
+    else:
+        tokenizer = utils.SpaceTokenizer()
+    with open(args.src_path) as src, open(args.tgt_path) as tgt:
+        testset = list(zip(src, tgt))[:args.num]
+
+    print("{:<8} {:>9} {:>12} {:>12} {:>8}  {}".format("policy", "requests", "string(ms)", "tokens(ms)", "speedup", "inputs"))
+    failed = False
+    for policy_type in args.policy:
+        requests = record_requests(imt_system, policy_type, tokenizer, testset, 1)
+        results = {}
+        for token_templates in (False, True):
+            imt_system.token_templates = token_templates
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                # only the texts repeated within the episodes hit
+                imt_system.template_encoder.cache.clear()
+                inputs = [model_input(imt_system, src, template) for src, template in requests]
+            results[token_templates] = (inputs, (time.perf_counter() - start) / args.repeat)
+        same = all(torch.equal(a, b) for a, b in zip(results[False][0], results[True][0]))
+        failed = failed or not same
+        print("{:<8} {:>9} {:>12.2f} {:>12.2f} {:>7.2f}x  {}".format(
+            policy_type, len(requests), 1000 * results[False][1], 1000 * results[True][1],
+            results[False][1] / results[True][1], "same" if same else "DIFFERENT",
+        ), flush=True)
+    print("template encoder: {}".format(imt_system.template_encoder.cache_info()))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
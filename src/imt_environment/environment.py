@@ -2,15 +2,18 @@ import time
 import logging
 import openai
 
+from .tracing import tracer
+
 logger = logging.getLogger("environment")
 
 class Environment():
-    def __init__(self, imt_system, policy) -> None:
+    def __init__(self, imt_system, policy, record_turns=False) -> None:
         self.imt_system = imt_system
         self.policy = policy
-        self.state = State()
+        self.state = State(record_turns)
 
-    def initialize_episode(self, src, tgt):
+    def initialize_episode(self, src, tgt, episode=None):
+        self.episode = episode
         self.state.initialize_episode()
         self.policy.initialize_episode()
         self.episode_over = False
@@ -21,55 +24,82 @@ class Environment():
         self.tolerance = 3
 
     def next_turn(self):
+        tracer.begin_turn(
+            system=self.imt_system.name, policy=type(self.policy).__name__, episode=self.episode, turn=self.state.turn,
+        )
+        try:
+            return self.play_turn()
+        finally:
+            tracer.end_turn()
+
+    def play_turn(self):
+        if self.state.turn > 0 and self.tolerance == 3:
+            if self.revise():
+                return self.episode_over, self.state.get_state()
+        start_time = time.time()
+        try:
+            with tracer.timer("translate"):
+                hypo = self.imt_system.translate(self.src, self.template)
+            response_time = time.time() - start_time
+            from_cache = self.imt_system.last_from_cache is not None and self.imt_system.last_from_cache[0]
+        except (openai.error.APIError, openai.error.RateLimitError, openai.error.APIConnectionError) as e:
+            print(e)
+            self.tolerance -= 1
+            if self.tolerance < 0:
+                print("exit")
+                exit(1)
+            time.sleep(5)
+            return False, None
+        return self.receive(hypo, response_time, from_cache)
+
+    def revise(self):
+        """Let the policy revise the current hypothesis into the template of
+        the next request. Returns True if this ends the episode."""
+        with tracer.timer("revise"):
+            self.template, editing_cost, failed = self.policy.revise(self.hypo, self.tgt)
+        if failed:
+            logger.info("policy failed!")
+            self.end_episode(False)
+            return True
+        self.state.editing_cost += editing_cost
+        hypo_tmp = self.template.template2hypo()
+        with tracer.timer("accept"):
+            accepted = self.policy.accept(hypo_tmp, self.tgt)
+        if accepted:
+            logger.info("accept at turn {}!".format(self.state.turn))
+            self.end_episode(True)
+            return True
+        return False
+
+    def receive(self, hypo, response_time, from_cache=False):
+        """Finish the turn with the hypothesis the IMT system returned for
+        (self.src, self.template). The response time of hypotheses served by
+        a translation cache is accounted separately."""
         if self.state.turn == 0:
-            start_time = time.time()
-            try:
-                self.hypo = self.imt_system.translate(self.src)
-                response_time = time.time() - start_time
-            except (openai.error.APIError, openai.error.RateLimitError, openai.error.APIConnectionError) as e:
-                print(e)
-                self.tolerance -= 1
-                if self.tolerance < 0:
-                    print("exit")
-                    exit(1)
-                time.sleep(5)
-                return False, None
-            self.max_turn = self.policy.max_turn(self.hypo, self.tgt)
-            self.tolerance = 3
+            self.hypo = hypo
+            with tracer.timer("max_turn"):
+                self.max_turn = self.policy.max_turn(self.hypo, self.tgt)
         else:
-            if self.tolerance == 3:
-                self.template, editing_cost, failed = self.policy.revise(self.hypo, self.tgt)
-                if failed:
-                    logger.info("policy failed!")
-                    return self.end_episode(False)
-                self.state.editing_cost += editing_cost
-                hypo_tmp = self.template.template2hypo()
-                if self.policy.accept(hypo_tmp, self.tgt):
-                    logger.info("accept at turn {}!".format(self.state.turn))
-                    return self.end_episode(True)
-            start_time = time.time()
-            try:
-                hypo = self.imt_system.translate(self.src, self.template)
-                response_time = time.time() - start_time
-            except (openai.error.APIError, openai.error.RateLimitError, openai.error.APIConnectionError) as e:
-                print(e)
-                self.tolerance -= 1
-                if self.tolerance < 0:
-                    print("exit")
-                    exit(1)
-                time.sleep(5)
-                return False, None
-            self.tolerance = 3
             if hypo == self.hypo:
                 logger.warning("same hypothesis with the last turn!")
             else:
-                self.state.consistency += self.policy.consistency(self.hypo, hypo)
+                with tracer.timer("consistency"):
+                    self.state.consistency += self.policy.consistency(self.hypo, hypo)
             self.hypo = hypo
+        self.tolerance = 3
 
-        self.state.response_time += response_time
+        if from_cache:
+            self.state.cached_turns += 1
+            self.state.cached_response_time += response_time
+        else:
+            self.state.response_time += response_time
         self.state.turn += 1
+        if self.state.turns is not None:
+            self.state.turns.append({"hypo": hypo, "response_time": response_time, "from_cache": from_cache})
 
-        if self.policy.accept(self.hypo, self.tgt):
+        with tracer.timer("accept"):
+            accepted = self.policy.accept(self.hypo, self.tgt)
+        if accepted:
             logger.info("accept at turn {}!".format(self.state.turn))
             return self.end_episode(True)
             
@@ -83,17 +113,111 @@ class Environment():
         self.episode_over = True
         if success:
             self.state.success = True
-            self.imt_system.update(self.src, self.hypo)
+            with tracer.timer("update"):
+                self.imt_system.update(self.src, self.hypo)
         else:
-            _, _, editing_cost = self.policy.post_editing(self.hypo, self.tgt)
+            with tracer.timer("post_editing"):
+                _, _, editing_cost = self.policy.post_editing(self.hypo, self.tgt)
             self.state.editing_cost += editing_cost
         self.state.norm_editing_cost = self.state.editing_cost / len(self.tgt)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("tokenization cache: %s", self.policy.cache_info())
+            logger.debug("imt system cache: %s", self.imt_system.cache_info())
         return self.episode_over, self.state.get_state()
 
+class BatchEnvironment():
+    """Runs many episodes in lockstep: every turn, the pending requests of all
+    running episodes are translated with one imt_system.translate_batch call.
+    Each episode has its own policy (built by policy_fn), so per-episode
+    results match the sequential Environment."""
+    def __init__(self, imt_system, policy_fn, batch_episodes, record_turns=False) -> None:
+        self.imt_system = imt_system
+        self.policy_fn = policy_fn
+        self.batch_episodes = batch_episodes
+        self.record_turns = record_turns
+        self.tolerance = 3
+
+    def run(self, episodes):
+        """Takes an iterable of (index, src, tgt) and yields (index, state)
+        of each episode as it ends, which is not necessarily in order."""
+        episodes = iter(episodes)
+        running = []
+        pending = []
+        # one trace record per translate_batch call, with the policy calls
+        # of the episodes before it
+        policy_name = None
+        while True:
+            if tracer.record is None:
+                tracer.begin_turn(system=self.imt_system.name, episode=None, turn=None)
+            if not pending:
+                while len(running) < self.batch_episodes:
+                    episode = next(episodes, None)
+                    if episode is None:
+                        break
+                    index, src, tgt = episode
+                    logger.info("test case {}".format(index))
+                    env = Environment(self.imt_system, self.policy_fn(index), self.record_turns)
+                    env.initialize_episode(src, tgt, index)
+                    policy_name = type(env.policy).__name__
+                    running.append((index, env))
+                if not running:
+                    break
+                for index, env in running:
+                    if env.state.turn > 0 and env.revise():
+                        yield index, env.state.get_state()
+                    else:
+                        pending.append((index, env))
+                running = []
+                if not pending:
+                    continue
+
+            start_time = time.time()
+            try:
+                with tracer.timer("translate"):
+                    hypos = self.imt_system.translate_batch(
+                        [env.src for _, env in pending], [env.template for _, env in pending]
+                    )
+                response_times = self.response_times(time.time() - start_time, len(pending))
+            except (openai.error.APIError, openai.error.RateLimitError, openai.error.APIConnectionError) as e:
+                print(e)
+                self.tolerance -= 1
+                if self.tolerance < 0:
+                    print("exit")
+                    exit(1)
+                time.sleep(5)
+                continue
+            self.tolerance = 3
+
+            from_cache = self.imt_system.last_from_cache or [False] * len(pending)
+            for (index, env), hypo, cached, response_time in zip(pending, hypos, from_cache, response_times):
+                episode_over, state = env.receive(hypo, response_time, cached)
+                if episode_over:
+                    yield index, state
+                else:
+                    running.append((index, env))
+            tracer.end_turn(policy=policy_name, requests=len(pending))
+            pending = []
+        # opened by the last pass, which found nothing left to translate
+        tracer.discard_turn()
+
+    def response_times(self, elapsed, num_requests):
+        """The response time of each request of a translate_batch call, as
+        reported by the IMT system or else its share of the call."""
+        if self.imt_system.last_response_times is not None:
+            return self.imt_system.last_response_times
+        return [elapsed / num_requests] * num_requests
+
 class State():
+    def __init__(self, record_turns=False) -> None:
+        self.record_turns = record_turns
+
     def initialize_episode(self):
         self.turn = 0
+        # hypothesis and response time of every turn, if recorded
+        self.turns = [] if self.record_turns else None
         self.response_time = 0
+        self.cached_turns = 0
+        self.cached_response_time = 0
         self.editing_cost = 0
         self.norm_editing_cost = 0
         self.success = False
@@ -106,5 +230,8 @@ class State():
             "normalized_editing_cost": self.norm_editing_cost,
             "success": self.success,
             "response_time": self.response_time,
+            "cached_turns": self.cached_turns,
+            "cached_response_time": self.cached_response_time,
             "consistency": self.consistency,
+            **({"turns": self.turns} if self.turns is not None else {}),
         }
@@ -3,4 +3,5 @@ from .prefix_transformer import PrefixTransformer
 from .dba_transformer import DBATransformer
 from .bitiimt import Bitiimt
 from .leca.leca_imt import LecaImt
-from .chatgpt import ChatgptImt
\ No newline at end of file
+from .chatgpt import ChatgptImt
+from .translation_cache import TranslationCache, CachedImt
@@ -0,0 +1,62 @@
+import logging
+from contextlib import nullcontext
+
+import torch
+from torch import nn
+
+from fairseq.modules import MultiheadAttention
+from fairseq.modules.transformer_layer import TransformerEncoderLayerBase
+
+logger = logging.getLogger("imt_system")
+
+def add_acceleration_args(parser):
+    group = parser.add_argument_group("CPU acceleration")
+    group.add_argument("--quantize-int8", action="store_true",
+                       help="dynamically quantize the linear layers of the models to int8 (CPU only)")
+    group.add_argument("--autocast-bf16", action="store_true",
+                       help="run the models under bf16 autocast if the CPU supports bf16 (CPU only)")
+    group.add_argument("--compile-layers", choices=["none", "script", "compile"], default="none",
+                       help="compile the encoder layers with TorchScript, or the encoder and decoder layers with torch.compile (CPU only)")
+
+def acceleration_settings(args):
+    return {
+        "quantize_int8": getattr(args, "quantize_int8", False),
+        "autocast_bf16": getattr(args, "autocast_bf16", False),
+        "compile_layers": getattr(args, "compile_layers", "none"),
+    }
+
+def accelerate(model, settings):
+    """Applies the int8 quantization and layer compilation of settings to a
+    model prepared for inference, in place."""
+    if settings["quantize_int8"] or settings["autocast_bf16"]:
+        for module in model.modules():
+            if isinstance(module, TransformerEncoderLayerBase):
+                # the BetterTransformer kernel runs on its own fp32 copy of
+                # the weights, neither quantized nor autocast
+                module.load_to_BT = False
+    if settings["quantize_int8"]:
+        for module in model.modules():
+            if isinstance(module, MultiheadAttention):
+                # the fused attention kernel reads the projection weights,
+                # which quantized layers do not have
+                module._set_skip_embed_dim_check()
+        torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if settings["compile_layers"] == "script":
+        # a scripted layer gets a copy of the incremental state, so only the
+        # encoder layers, which have none, can be scripted
+        for i, layer in enumerate(model.encoder.layers):
+            model.encoder.layers[i] = torch.jit.script(layer)
+    elif settings["compile_layers"] == "compile":
+        for layers in (model.encoder.layers, model.decoder.layers):
+            for i, layer in enumerate(layers):
+                # source and prefix lengths change with every request
+                layers[i] = torch.compile(layer, dynamic=True)
+
+def autocast_context(settings):
+    """Returns a function giving the context to run the models in."""
+    if not settings["autocast_bf16"]:
+        return nullcontext
+    if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        logger.warning("bf16 is not supported by this CPU, running in fp32")
+        return nullcontext
+    return lambda: torch.autocast("cpu", dtype=torch.bfloat16)
@@ -1,16 +1,100 @@
-from fairseq_cli.generate import get_symbols_to_strip_from_output
+import torch
+
 from .imt_system import IMTSystem, logger
+from .token_template import TemplateEncoder
+from ..tracing import tracer
 
 class Bitiimt(IMTSystem):
     def __init__(self, args) -> None:
         super().__init__(args)
         self.src = None
         self.max_blank = 6
+        # the template is appended to the source
+        self.template_encoder = TemplateEncoder(self.encode_fn, self.src_dict)
 
     def translate(self, src, template=None):
-        if src != self.src:
-            self.src = src
-            self.encoded_src = self.encode_fn(src)
+        with tracer.timer("imt.tokenize"):
+            if self.token_templates:
+                input, template_pieces = self.encode_input(src, template)
+            else:
+                if src != self.src:
+                    self.src = src
+                    self.encoded_src = self.encode_fn(src)
+                template_str = self.build_template(template)
+                input = self.encoded_src + template_str
+                template_pieces = template_str.lstrip().split(" ")
+        logger.debug("template:\n{}".format(template_pieces))
+        with tracer.timer("imt.batch"):
+            batch = self.make_token_batch(input) if self.token_templates else self.make_batches(input)
+        src_tokens = batch["net_input"]["src_tokens"]
+        src_lengths = batch["net_input"]["src_lengths"]
+
+        if self.use_cuda:
+            src_tokens = src_tokens.cuda()
+            src_lengths = src_lengths.cuda()
+        
+        sample = {
+            "net_input": {
+                "src_tokens": src_tokens,
+                "src_lengths": src_lengths,
+            }
+        }
+        
+        with tracer.timer("imt.search"), self.autocast():
+            translations = self.task.inference_step(
+                self.generator, self.models, sample
+            )
+        self.trace_search(sample, translations)
+        with tracer.timer("imt.detokenize"):
+            return self.fill_template(translations[0][0]["tokens"], template_pieces)
+
+    def translate_batch(self, srcs, templates=None):
+        if templates is None:
+            templates = [None] * len(srcs)
+        with tracer.timer("imt.tokenize"):
+            if self.token_templates:
+                inputs, templates_pieces = zip(*[self.encode_input(src, template) for src, template in zip(srcs, templates)])
+            else:
+                template_strs = [self.build_template(template) for template in templates]
+                inputs = [self.encode_fn(src) + template_str for src, template_str in zip(srcs, template_strs)]
+                templates_pieces = [template_str.lstrip().split(" ") for template_str in template_strs]
+        hypos = self.generate_batch(list(inputs), None if self.token_templates else lambda x: x)
+        with tracer.timer("imt.detokenize"):
+            return [self.fill_template(hypo["tokens"], pieces) for hypo, pieces in zip(hypos, templates_pieces)]
+
+    def encode_input(self, src, template):
+        """The source token ids followed by the template as build_template
+        gives it, and the pieces of the template."""
+        pieces = ["<sep>"]
+        if template is None:
+            pieces += ["<blank>", "<eob>"]
+        else:
+            spans = template.spans()
+            blank = False
+            blank_num = 0
+            for k, (kind, text) in enumerate(spans):
+                if kind == "blank":
+                    blank = True
+                    continue
+                if blank:
+                    pieces += ["<blank>", "<eob>"]
+                    blank_num += 1
+                    blank = False
+                    if blank_num >= self.max_blank:
+                        text = "".join(text for kind, text in spans[k:] if kind == "keep")
+                        pieces += self.template_encoder.encode_constraint(text)[0]
+                        break
+                pieces += self.template_encoder.encode_constraint(text)[0]
+            else:
+                if blank:
+                    pieces += ["<blank>", "<eob>"]
+                elif not spans:
+                    logger.warning("template error!")
+        _, ids = self.template_encoder.encode_text(src)
+        ids = ids + [self.src_dict.index(piece) for piece in pieces] + [self.src_dict.eos()]
+        return torch.LongTensor(ids), pieces
+
+    def build_template(self, template):
         if template is None:
             template_str = " <sep> <blank> <eob>"
         else:
@@ -43,40 +127,26 @@ class Bitiimt(IMTSystem):
                 template_str += " <blank> <eob>"
             else:
                 logger.warning("template error!")
+        return template_str
 
-        input = self.encoded_src + template_str
-        logger.debug("template_str:\n{}".format(template_str))
-        batch = self.make_batches(input)
-        src_tokens = batch["net_input"]["src_tokens"]
-        src_lengths = batch["net_input"]["src_lengths"]
-
-        if self.use_cuda:
-            src_tokens = src_tokens.cuda()
-            src_lengths = src_lengths.cuda()
-        
-        sample = {
-            "net_input": {
-                "src_tokens": src_tokens,
-                "src_lengths": src_lengths,
-            }
-        }
-        
-        translation = self.task.inference_step(
-            self.generator, self.models, sample
-        )[0][0]
+    def partial_decoder(self, src, template=None):
+        """Fills the template up to the blank being generated."""
+        if self.token_templates:
+            _, template_pieces = self.encode_input(src, template)
+        else:
+            template_pieces = self.build_template(template).lstrip().split(" ")
+        return lambda tokens: self.fill_template(tokens, template_pieces, partial=True)
 
-        hypo_tokens = translation["tokens"]
-        hypo_str = self.tgt_dict.string(
-            hypo_tokens, self.cfg.common_eval.post_process,
-            extra_symbols_to_ignore=get_symbols_to_strip_from_output(self.generator)
-        )
-        logger.debug("output:\n{}".format(hypo_str))
+    def fill_template(self, hypo_tokens, template_pieces, partial=False):
+        hypo_str = self.hypo_string(hypo_tokens)
+        if not partial:
+            logger.debug("output:\n{}".format(hypo_str))
 
         hypo = []
         j = 0
         hypo_tokens = hypo_str.split(" ")
         hypo_len = len(hypo_tokens)
-        template_tokens = template_str.lstrip().split(" ")[1:]
+        template_tokens = template_pieces[1:]
         for t in template_tokens:
             if t != "<blank>" and t != "<eob>":
                 hypo.append(t)
@@ -86,13 +156,18 @@ class Bitiimt(IMTSystem):
                         hypo.append(hypo_tokens[j])
                         j += 1
                     j += 1
+                    if partial and j > hypo_len:
+                        break
+                elif partial:
+                    break
                 else:
                     logger.warning("blank is not infilled!")
-        if j < hypo_len:
+        if j < hypo_len and not partial:
             logger.warning("generate more than needed!")
         hypo_str = " ".join(hypo)
         detok_hypo_str = self.decode_fn(hypo_str)
-        logger.debug("detok str:\n{}".format(detok_hypo_str))
+        if not partial:
+            logger.debug("detok str:\n{}".format(detok_hypo_str))
         return detok_hypo_str
 
     def make_batches(self, input):
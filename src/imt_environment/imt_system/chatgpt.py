@@ -1,18 +1,180 @@
 import os
+import time
+import random
+import asyncio
 import openai
+from collections import deque
 from .imt_system import IMTSystem, logger
+from ..tracing import tracer
 
 language_map = {"zh": "simplified Chinese", "en": "English", "de": "German"}
 
+# number of the last requests whose latencies are kept for request_info()
+LATENCY_WINDOW = 10000
+
+# errors after which the request is sent again
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+class TokenBucket():
+    """Rate limit of amount per minute, with bursts of up to a minute's
+    worth. reserve() takes the amount right away, going into debt if needed,
+    and returns how long to wait before using it, so concurrent requests
+    queue up in the order they reserved."""
+    def __init__(self, per_minute) -> None:
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.last = time.monotonic()
+
+    def reserve(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        return max(0., -self.tokens / self.rate)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
 class ChatgptImt(IMTSystem):
     def __init__(self, args) -> None:
         openai.api_key = os.getenv("OPENAI_API_KEY")
+        if args.chatgpt_api_base is not None:
+            openai.api_base = args.chatgpt_api_base
         self.MODEL = "gpt-3.5-turbo-0301"
         self.args = args
         self.src = language_map[args.src_lang]
         self.tgt = language_map[args.tgt_lang]
+        self.max_tokens = 200
+        self.concurrency = args.chatgpt_concurrency
+        self.max_retries = args.chatgpt_max_retries
+        self.request_timeout = 60
+        self.requests_bucket = TokenBucket(args.chatgpt_rpm)
+        self.tokens_bucket = TokenBucket(args.chatgpt_tpm)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.retries = 0
+
+    def cache_signature(self):
+        return {"model": self.MODEL, "src": self.src, "tgt": self.tgt}
 
     def translate(self, src, template=None):
+        return self.translate_batch([src], [template])[0]
+
+    def translate_stream(self, src, template=None, on_partial=None):
+        """translate(), calling on_partial with the completion received so
+        far for each chunk streamed by the API."""
+        if on_partial is None:
+            return self.translate(src, template)
+        prompt = self.build_prompt(src, template)
+        with tracer.timer("imt.request"):
+            hypo, latency, retries = asyncio.run(self.request(prompt, asyncio.Semaphore(1), on_partial))
+        tracer.count("requests", 1)
+        tracer.count("retries", retries)
+        self.last_response_times = [latency]
+        return hypo
+
+    def translate_batch(self, srcs, templates=None):
+        """Sends the requests concurrently, at most self.concurrency at a time
+        and within the requests/tokens per minute limits. last_response_times
+        holds the latency of each request, rate limiting and retries
+        included."""
+        if templates is None:
+            templates = [None] * len(srcs)
+        prompts = [self.build_prompt(src, template) for src, template in zip(srcs, templates)]
+        with tracer.timer("imt.request"):
+            results = asyncio.run(self.request_all(prompts))
+        tracer.count("requests", len(prompts))
+        tracer.count("retries", sum(retries for _, _, retries in results))
+        self.last_response_times = [latency for _, latency, _ in results]
+        return [hypo for hypo, _, _ in results]
+
+    async def request_all(self, prompts):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[self.request(prompt, semaphore) for prompt in prompts])
+
+    async def request(self, prompt, semaphore, on_partial=None):
+        # the request keeps its slot while it backs off, so retries do not
+        # queue up behind new requests
+        async with semaphore:
+            start_time = time.time()
+            # the limit counts the prompt (about 4 characters per token) and max_tokens
+            estimated_tokens = len(prompt) // 4 + self.max_tokens
+            for attempt in range(self.max_retries + 1):
+                await asyncio.sleep(max(
+                    self.requests_bucket.reserve(1), self.tokens_bucket.reserve(estimated_tokens)
+                ))
+                hypo = ""
+                try:
+                    response = await openai.ChatCompletion.acreate(
+                        model=self.MODEL,
+                        messages=[{
+                            "role": "user",
+                            "content": prompt
+                        }],
+                        temperature=0,
+                        max_tokens=self.max_tokens,
+                        request_timeout=self.request_timeout,
+                        stream=on_partial is not None,
+                    )
+                    if on_partial is None:
+                        hypo = response["choices"][0]["message"]["content"]
+                        total_tokens = response["usage"]["total_tokens"]
+                    else:
+                        # streams do not report the usage, a chunk is about a token
+                        total_tokens = len(prompt) // 4
+                        async for chunk in response:
+                            content = chunk["choices"][0]["delta"].get("content")
+                            if content:
+                                hypo += content
+                                total_tokens += 1
+                                on_partial(hypo)
+                    break
+                except RETRY_ERRORS as e:
+                    # a stream is not sent again once part of it was shown
+                    if attempt == self.max_retries or hypo:
+                        raise
+                    self.tokens_bucket.refund(estimated_tokens)
+                    # full jitter, unless the server says when to come back
+                    delay = random.uniform(0, min(60, 2 ** attempt))
+                    headers = getattr(e, "headers", None) or {}
+                    retry_after = headers.get("retry-after", headers.get("Retry-After"))
+                    if retry_after is not None:
+                        delay = float(retry_after)
+                    self.retries += 1
+                    logger.warning("{}, retry {} in {:.2f}s".format(type(e).__name__, attempt + 1, delay))
+                    await asyncio.sleep(delay)
+        self.tokens_bucket.refund(estimated_tokens - total_tokens)
+        latency = time.time() - start_time
+        self.latencies.append(latency)
+        self.requests += 1
+        logger.debug("prompt:\n{}".format(prompt))
+        logger.debug("hypothesis:\n{}".format(hypo))
+        logger.debug("token used: {} | latency: {:.3f}".format(total_tokens, latency))
+        return hypo, latency, attempt
+
+    def request_info(self):
+        """The number of requests and retries, and the latencies of the last
+        LATENCY_WINDOW requests."""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {"requests": self.requests, "retries": self.retries}
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "mean_latency": sum(latencies) / len(latencies),
+            "p50_latency": latencies[len(latencies) // 2],
+            "p95_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        }
+
+    def build_prompt(self, src, template=None):
         if template is None:
             prompt = "Translate the following {} text to {}: {}".format(self.src, self.tgt, src)
         else:
@@ -56,18 +218,4 @@ class ChatgptImt(IMTSystem):
             #prompt 4
             # prompt = "{0} sentence: {1}\n{2} template: {3}\nYour task is to provide a German translation of the given English sentence. You must use the given {2} template and information exactly as provided without making any changes, and generate a complete translation.\n{2} translation:".format(self.src, src, self.tgt, template_str.strip())
 
-        response = openai.ChatCompletion.create(
-            model=self.MODEL,
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }],
-            temperature=0,
-            max_tokens=200,
-        )
-        hypo = response["choices"][0]["message"]["content"]
-        total_tokens = response["usage"]["total_tokens"]
-        logger.debug("prompt:\n{}".format(prompt))
-        logger.debug("hypothesis:\n{}".format(hypo))
-        logger.debug("token used: {}".format(total_tokens))
-        return hypo
+        return prompt
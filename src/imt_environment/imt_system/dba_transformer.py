@@ -1,56 +1,65 @@
 import torch
-from fairseq_cli.generate import get_symbols_to_strip_from_output
 from fairseq.token_generation_constraints import pack_constraints
 from .imt_system import IMTSystem, logger
+from ..tracing import tracer
 
 class DBATransformer(IMTSystem):
     def __init__(self, args) -> None:
         super().__init__(args)
-        self.src = None
 
     def translate(self, src, template=None):
-        if template is not None:
-            constraints = template.get_constraints()
-            logger.debug("constraints:\n{}".format(constraints))
-            constraint_tokens = [
-                self.tgt_dict.encode_line(
-                    self.encode_constraint(cons),
-                    append_eos=False,
-                    add_if_not_exist=False,
-                ) for cons in constraints
-            ]
-            constraints_tensor = pack_constraints([constraint_tokens])
-        else:
-            constraints_tensor = torch.LongTensor()
-
-        if src != self.src:
-            self.src = src
-            batch = self.make_batches(src)
-            # ids = batch["id"]
-            src_tokens = batch["net_input"]["src_tokens"]
-            src_lengths = batch["net_input"]["src_lengths"]
-
-            if self.use_cuda:
-                src_tokens = src_tokens.cuda()
-                src_lengths = src_lengths.cuda()
-            
-            self.sample = {
-                "net_input": {
-                    "src_tokens": src_tokens,
-                    "src_lengths": src_lengths,
-                }
-            }
+        with tracer.timer("imt.tokenize"):
+            constraints_tensor = self.encode_constraints(template)
+        sample, encoder_outs = self.encode_source(src)
         if self.use_cuda:
             constraints_tensor = constraints_tensor.cuda() if constraints_tensor is not None else None
 
-        translation = self.task.inference_step(
-            self.generator, self.models, self.sample, constraints=constraints_tensor
-        )[0][0]
-        hypo_tokens = translation["tokens"]
-        hypo_str = self.tgt_dict.string(
-            hypo_tokens, self.cfg.common_eval.post_process,
-            extra_symbols_to_ignore=get_symbols_to_strip_from_output(self.generator)
-        )
+        with tracer.timer("imt.search"), self.autocast():
+            translations = self.generator.generate(
+                self.models, sample, constraints=constraints_tensor, encoder_outs=encoder_outs
+            )
+        self.trace_search(sample, translations)
+        with tracer.timer("imt.detokenize"):
+            return self.decode_hypo(translations[0][0]["tokens"])
+
+    def translate_batch(self, srcs, templates=None):
+        if templates is None:
+            templates = [None] * len(srcs)
+        # unconstrained requests take the plain beam search path in
+        # LexicallyConstrainedBeamSearch, so they are decoded separately
+        hypos = [None] * len(srcs)
+        for constrained in (False, True):
+            ids = [i for i, t in enumerate(templates) if (t is not None) == constrained]
+            if not ids:
+                continue
+            with tracer.timer("imt.tokenize"):
+                constraints = [self.encode_constraints(templates[i])[0] if constrained else None for i in ids]
+            group_hypos = self.generate_batch([srcs[i] for i in ids], self.encode_fn, constraints=constraints)
+            with tracer.timer("imt.detokenize"):
+                for i, hypo in zip(ids, group_hypos):
+                    hypos[i] = self.decode_hypo(hypo["tokens"])
+        return hypos
+
+    def encode_constraints(self, template):
+        if template is None:
+            return torch.LongTensor()
+        if self.token_templates:
+            token_template = self.template_encoder.encode(template)
+            logger.debug("constraints:\n{}".format(token_template.spans))
+            return pack_constraints([[torch.LongTensor(ids) for ids in token_template.constraints()]])
+        constraints = template.get_constraints()
+        logger.debug("constraints:\n{}".format(constraints))
+        constraint_tokens = [
+            self.tgt_dict.encode_line(
+                self.encode_constraint(cons),
+                append_eos=False,
+                add_if_not_exist=False,
+            ) for cons in constraints
+        ]
+        return pack_constraints([constraint_tokens])
+
+    def decode_hypo(self, hypo_tokens):
+        hypo_str = self.hypo_string(hypo_tokens)
         detok_hypo_str = self.decode_fn(hypo_str)
         logger.debug("detok str:\n{}".format(detok_hypo_str))
         return detok_hypo_str
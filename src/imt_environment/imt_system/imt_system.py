@@ -1,18 +1,38 @@
 import logging
+import os
 import numpy as np
 import torch
 import ast
+from collections import OrderedDict
+from contextlib import nullcontext
+from omegaconf import OmegaConf
 
 from fairseq import options, utils, tasks, checkpoint_utils
+from fairseq.data import data_utils
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq_cli.generate import get_symbols_to_strip_from_output
+
+from ..tracing import tracer
+from .acceleration import add_acceleration_args, acceleration_settings, accelerate, autocast_context
+from ..mmap_checkpoint import is_mmap_checkpoint, load_mmap_ensemble
+from .token_template import TemplateEncoder
 
 logger = logging.getLogger("imt_system")
 logger.setLevel(logging.DEBUG)
 
 class IMTSystem():
+    # which hypotheses of the last translate/translate_batch call were
+    # served by a translation cache, see CachedImt
+    last_from_cache = None
+    # the response time of each request of the last translate_batch call,
+    # for systems that serve the requests of a batch concurrently
+    last_response_times = None
+
     def __init__(self, args) -> None:
         parser = options.get_interactive_generation_parser()
+        add_acceleration_args(parser)
         cfg = options.parse_args_and_arch(parser, args)
+        acceleration = acceleration_settings(cfg)
         cfg = convert_namespace_to_omegaconf(cfg)
         utils.import_user_module(cfg.common)
 
@@ -30,14 +50,18 @@ class IMTSystem():
         # Load ensemble
         overrides = ast.literal_eval(cfg.common_eval.model_overrides)
         logger.info("loading model(s) from {}".format(cfg.common_eval.path))
-        models, _model_args = checkpoint_utils.load_model_ensemble(
-            utils.split_paths(cfg.common_eval.path),
-            arg_overrides=overrides,
-            task=task,
-            suffix=cfg.checkpoint.checkpoint_suffix,
-            strict=(cfg.checkpoint.checkpoint_shard_count == 1),
-            num_shards=cfg.checkpoint.checkpoint_shard_count,
-        )
+        paths = utils.split_paths(cfg.common_eval.path)
+        if all(is_mmap_checkpoint(path) for path in paths):
+            models, _model_args = load_mmap_ensemble(paths, arg_overrides=overrides, task=task)
+        else:
+            models, _model_args = checkpoint_utils.load_model_ensemble(
+                paths,
+                arg_overrides=overrides,
+                task=task,
+                suffix=cfg.checkpoint.checkpoint_suffix,
+                strict=(cfg.checkpoint.checkpoint_shard_count == 1),
+                num_shards=cfg.checkpoint.checkpoint_shard_count,
+            )
 
         # Set dictionaries
         src_dict = task.source_dictionary
@@ -52,6 +76,8 @@ class IMTSystem():
             if use_cuda and not cfg.distributed_training.pipeline_model_parallel:
                 model.cuda()
             model.prepare_for_inference_(cfg)
+            if not use_cuda:
+                accelerate(model, acceleration)
         
         # Initialize generator
         generator = task.build_generator(models, cfg.generation)
@@ -93,9 +119,22 @@ class IMTSystem():
         self.max_positions = max_positions
         self.encode_fn = encode_fn
         self.decode_fn = decode_fn
+        self.acceleration = acceleration
+        self.autocast = autocast_context(acceleration) if not use_cuda else nullcontext
+        self.encoder_cache = OrderedDict()
+        self.encoder_cache_size = 32
+        # build the model inputs of templates from token ids, with the
+        # pieces of the source and kept spans cached as whole texts, instead
+        # of encoding strings built from the templates
+        self.token_templates = True
+        self.template_encoder = TemplateEncoder(encode_fn, tgt_dict)
 
         logger.info("initialize done!")
 
+    @property
+    def name(self):
+        return type(self).__name__
+
     def encode_constraint(self, cons):
         cons_tokens = self.encode_fn(cons)
         if cons.startswith(" "):
@@ -109,5 +148,164 @@ class IMTSystem():
     def translate(self, src, template=None):
         pass
 
+    def translate_stream(self, src, template=None, on_partial=None):
+        """translate(), calling on_partial with the detokenized text of the
+        best active hypothesis after each search step, whenever it changes.
+        The returned translation is the final one."""
+        if on_partial is None:
+            return self.translate(src, template)
+        decode = self.partial_decoder(src, template)
+        last = None
+        def on_step(step, tokens, scores):
+            nonlocal last
+            # the first sentence is the one of a single request; DBA does not
+            # keep the beams sorted by score
+            text = decode(tokens[0, scores[0].argmax(), 1:])
+            if text != last:
+                last = text
+                on_partial(text)
+        self.generator.step_callback = on_step
+        try:
+            return self.translate(src, template)
+        finally:
+            self.generator.step_callback = None
+
+    def partial_decoder(self, src, template=None):
+        """The function detokenizing a partial hypothesis of src."""
+        return lambda tokens: self.decode_fn(self.hypo_string(tokens))
+
+    def encode_source(self, src):
+        """Returns the sample of src and the encoder output on it. Both only
+        depend on the source, so they are kept in an LRU over sources and
+        reused by later turns, episodes and policies on the same sentence."""
+        if src in self.encoder_cache:
+            self.encoder_cache.move_to_end(src)
+            return self.encoder_cache[src]
+        with tracer.timer("imt.batch"):
+            batch = self.make_batches(src)
+        src_tokens = batch["net_input"]["src_tokens"]
+        src_lengths = batch["net_input"]["src_lengths"]
+        if self.use_cuda:
+            src_tokens = src_tokens.cuda()
+            src_lengths = src_lengths.cuda()
+        sample = {
+            "net_input": {
+                "src_tokens": src_tokens,
+                "src_lengths": src_lengths,
+            }
+        }
+        with tracer.timer("imt.encoder"), torch.no_grad(), self.autocast():
+            encoder_outs = self.generator.model.forward_encoder(sample["net_input"])
+        self.encoder_cache[src] = (sample, encoder_outs)
+        if len(self.encoder_cache) > self.encoder_cache_size:
+            self.encoder_cache.popitem(last=False)
+        return sample, encoder_outs
+
+    def make_token_batch(self, tokens):
+        """The batch of one input of source token ids."""
+        dataset = self.task.build_dataset_for_inference([tokens], [tokens.numel()])
+        return dataset.collater([dataset[0]])
+
+    def cache_info(self):
+        # systems not built by IMTSystem.__init__, e.g. ChatGPT, have no
+        # template encoder
+        template_encoder = getattr(self, "template_encoder", None)
+        return {"template": template_encoder.cache_info()} if template_encoder is not None else {}
+
+    def cache_signature(self):
+        """Everything besides the request that determines a translation: the
+        config (checkpoints, decoding args, ...), the CPU acceleration and
+        the checkpoint files."""
+        checkpoints = []
+        for path in utils.split_paths(self.cfg.common_eval.path):
+            stat = os.stat(path)
+            checkpoints.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+        return {"cfg": OmegaConf.to_yaml(self.cfg), "checkpoints": checkpoints, "acceleration": self.acceleration}
+
+    def translate_batch(self, srcs, templates=None):
+        if templates is None:
+            templates = [None] * len(srcs)
+        return [self.translate(src, template) for src, template in zip(srcs, templates)]
+
+    def generate_batch(self, inputs, encode_fn, prefix_tokens=None, constraints=None, **kwargs):
+        """Decode the inputs in padded, length-bucketed batches (bounded by
+        --batch-size/--max-tokens) and return the best hypothesis of each
+        input in the original order. Every sentence gets its own maximum
+        length, so its output does not depend on the rest of the batch.
+        With encode_fn None, the inputs are tensors of source token ids.
+
+        prefix_tokens/constraints are per-input lists; a None constraint means
+        unconstrained (a batch of only None uses the plain search path).
+        Other kwargs are passed to the generator."""
+        with tracer.timer("imt.batch"):
+            if encode_fn is None:
+                tokens, lengths = inputs, [t.numel() for t in inputs]
+            else:
+                tokens, lengths = self.task.get_interactive_tokens_and_lengths(inputs, encode_fn)
+            dataset = self.task.build_dataset_for_inference(tokens, lengths)
+            itr = self.task.get_batch_iterator(
+                dataset=dataset,
+                max_tokens=self.cfg.dataset.max_tokens,
+                max_sentences=self.cfg.dataset.batch_size,
+                max_positions=self.max_positions,
+                disable_iterator_cache=True,
+            ).next_epoch_itr(shuffle=False)
+
+        hypos = [None] * len(inputs)
+        for batch in itr:
+            ids = batch["id"].tolist()
+            sample = {
+                "net_input": {
+                    "src_tokens": batch["net_input"]["src_tokens"],
+                    "src_lengths": batch["net_input"]["src_lengths"],
+                }
+            }
+            batch_prefix_tokens, batch_constraints = None, None
+            if prefix_tokens is not None:
+                batch_prefix_tokens = data_utils.collate_tokens(
+                    [prefix_tokens[i] if prefix_tokens[i] is not None else torch.LongTensor() for i in ids],
+                    pad_idx=self.tgt_dict.pad(),
+                )
+            if constraints is not None:
+                if all(constraints[i] is None for i in ids):
+                    batch_constraints = torch.LongTensor()
+                else:
+                    batch_constraints = data_utils.collate_tokens(
+                        [constraints[i] if constraints[i] is not None else torch.zeros(1).long() for i in ids],
+                        pad_idx=0,
+                    )
+            if self.use_cuda:
+                sample = utils.move_to_cuda(sample)
+                batch_prefix_tokens = batch_prefix_tokens.cuda() if batch_prefix_tokens is not None else None
+                batch_constraints = batch_constraints.cuda() if batch_constraints is not None else None
+
+            with tracer.timer("imt.search"), torch.no_grad(), self.autocast():
+                translations = self.generator.generate(
+                    self.models, sample,
+                    prefix_tokens=batch_prefix_tokens,
+                    constraints=batch_constraints,
+                    per_sentence_max_len=True,
+                    **kwargs,
+                )
+            self.trace_search(sample, translations)
+            for i, id in enumerate(ids):
+                hypos[id] = translations[i][0]
+        return hypos
+
+    def trace_search(self, sample, translations):
+        """Counts the tokens in and out of a generator call. A search ends
+        with its last finished hypothesis, so the longest returned one gives
+        the number of beam search steps."""
+        tracer.count("src_tokens", int(sample["net_input"]["src_lengths"].sum()))
+        for hypos in translations:
+            tracer.count("output_tokens", len(hypos[0]["tokens"]))
+            tracer.count("beam_steps", max(len(hypo["tokens"]) for hypo in hypos))
+
+    def hypo_string(self, hypo_tokens):
+        return self.tgt_dict.string(
+            hypo_tokens, self.cfg.common_eval.post_process,
+            extra_symbols_to_ignore=get_symbols_to_strip_from_output(self.generator)
+        )
+
     def update(self, src, tgt):
         pass
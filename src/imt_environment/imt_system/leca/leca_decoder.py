@@ -11,6 +11,9 @@ class LecaDecoder(TransformerDecoderBase):
         self.ptrnet = PointerNet(cfg.encoder.embed_dim, cfg.decoder.embed_dim)
         self.sep_idx = dictionary.index("<sep>")
         self.eos_idx = dictionary.eos()
+        # keep the source masks and the encoder projection of the pointer
+        # gate in the incremental state instead of recomputing them per step
+        self.cache_source = True
 
     def extract_features_scriptable(
         self,
@@ -128,13 +131,21 @@ class LecaDecoder(TransformerDecoderBase):
         if self.project_out_dim is not None:
             x = self.project_out_dim(x)
         
-        if encoder_out is not None and len(encoder_out["src_tokens"]) > 0:
-            src_tokens = encoder_out["src_tokens"][0]
-        src_tokens = src_tokens.unsqueeze(1).expand(attn.size())
-        src_masks = src_tokens.eq(self.eos_idx) | src_tokens.eq(self.padding_idx) | src_tokens.eq(self.sep_idx)
-        dec_enc_attn = attn.masked_fill(src_masks, float(1e-15))
-        ctx = torch.bmm(dec_enc_attn, enc.transpose(0, 1))
-        gate = self.ptrnet(ctx, inner_states[-1].transpose(0, 1))
+        if not self.cache_source:
+            if encoder_out is not None and len(encoder_out["src_tokens"]) > 0:
+                src_tokens = encoder_out["src_tokens"][0]
+            src_tokens = src_tokens.unsqueeze(1).expand(attn.size())
+            src_masks = src_tokens.eq(self.eos_idx) | src_tokens.eq(self.padding_idx) | src_tokens.eq(self.sep_idx)
+            dec_enc_attn = attn.masked_fill(src_masks, float(1e-15))
+            ctx = torch.bmm(dec_enc_attn, enc.transpose(0, 1))
+            gate = self.ptrnet(ctx, inner_states[-1].transpose(0, 1))
+        else:
+            source = self.source_state(encoder_out, incremental_state)
+            src_tokens = source["src_tokens"].expand(attn.size())
+            dec_enc_attn = attn.masked_fill(source["src_masks"], float(1e-15))
+            gate = self.ptrnet.forward_projected(
+                torch.bmm(dec_enc_attn, source["ctx_proj"]), inner_states[-1].transpose(0, 1)
+            )
 
         return x, {
             "attn": [attn],
@@ -144,6 +155,44 @@ class LecaDecoder(TransformerDecoderBase):
             "src_tokens": src_tokens
         }
 
+    def source_state(
+        self,
+        encoder_out: Dict[str, List[Tensor]],
+        incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]] = None,
+    ) -> Dict[str, Optional[Tensor]]:
+        """The parts of the pointer network that only depend on the source:
+        the source tokens the attention is scattered to, the mask of the
+        eos/pad/sep tokens and the encoder output projected by the pointer
+        gate, all of shape `(batch, 1, src_len)` but the projection, of shape
+        `(batch, src_len, 1)`. With an incremental state, they are computed
+        at the first step and kept in it."""
+        if incremental_state is not None:
+            source = self.get_incremental_state(incremental_state, "source")
+            if source is not None:
+                return source
+        src_tokens = encoder_out["src_tokens"][0].unsqueeze(1)
+        source: Dict[str, Optional[Tensor]] = {
+            "src_tokens": src_tokens,
+            "src_masks": src_tokens.eq(self.eos_idx) | src_tokens.eq(self.padding_idx) | src_tokens.eq(self.sep_idx),
+            "ctx_proj": self.ptrnet.project_ctx(encoder_out["encoder_out"][0].transpose(0, 1)),
+        }
+        if incremental_state is not None:
+            self.set_incremental_state(incremental_state, "source", source)
+        return source
+
+    def reorder_incremental_state(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        new_order: Tensor,
+    ):
+        source = self.get_incremental_state(incremental_state, "source")
+        if source is not None:
+            for k in source.keys():
+                source_k = source[k]
+                if source_k is not None:
+                    source[k] = source_k.index_select(0, new_order)
+            self.set_incremental_state(incremental_state, "source", source)
+
     def get_normalized_probs(self, net_output, log_probs, sample=None):
         """Get normalized probabilities (or log probs) from a net's output."""
         logits = net_output[0].float()
@@ -155,9 +204,13 @@ class LecaDecoder(TransformerDecoderBase):
         gate = net_output[1]["gate"].float()
         dec_enc_attn = net_output[1]["dec_enc_attn"].float()
         src_tokens = net_output[1]["src_tokens"]
-        logits = utils.softmax(logits, dim=-1)
-        logits = (gate * logits).scatter_add(2, src_tokens, (1 - gate) * dec_enc_attn) + 1e-10
-        return torch.log(logits)
+        probs = utils.softmax(logits, dim=-1)
+        if probs.requires_grad or not self.cache_source:
+            probs = (gate * probs).scatter_add(2, src_tokens, (1 - gate) * dec_enc_attn) + 1e-10
+            return torch.log(probs)
+        # in place, so a step allocates a single buffer of the vocabulary size
+        probs.mul_(gate).scatter_add_(2, src_tokens, (1 - gate) * dec_enc_attn).add_(1e-10)
+        return probs.log_()
 
 
 class PointerNet(nn.Module):
@@ -173,4 +226,30 @@ class PointerNet(nn.Module):
         x = torch.cat((ctx, dec_hid), dim=-1)  # bsz x tgtlen x hidsize ->  bsz x tgtlen x (hidsize x 2)
         x = self.linear(x)   # bsz x tgtlen x 1
         x = torch.sigmoid(x) # bsz x tgtlen x 1 
-        return x
\ No newline at end of file
+        return x
+
+    def weights(self):
+        weight, bias = self.linear.weight, self.linear.bias
+        if callable(weight):
+            # a dynamically quantized linear layer
+            weight, bias = weight().dequantize(), bias()
+        return weight, bias
+
+    def project_ctx(self, enc):
+        """
+        enc: bsz x srclen x hidsize
+        The context of forward is an attention over enc, so its projection
+        by the linear layer is the attention over the projection of enc:
+        bsz x srclen x 1
+        """
+        weight, _ = self.weights()
+        return torch.matmul(enc, weight[:, :enc.size(-1)].t())
+
+    def forward_projected(self, ctx_proj, dec_hid):
+        """
+        ctx_proj: bsz x tgtlen x 1, the attention over project_ctx(enc)
+        dec_hid: bsz x tgtlen x hidsize
+        """
+        weight, bias = self.weights()
+        x = ctx_proj + torch.matmul(dec_hid, weight[:, -dec_hid.size(-1):].t()) + bias
+        return torch.sigmoid(x)
\ No newline at end of file
@@ -26,22 +26,22 @@ class LecaEncoder(TransformerEncoderBase):
                 x = embed + self.embed_positions(src_tokens)
             x += self.seg_embed(torch.zeros_like(src_tokens))
         else:
-            sep_mask = (src_tokens == self.sep_idx).nonzero(as_tuple=True)
-            sep_position = min(sep_mask[1])
-            src_sent = src_tokens[:, :sep_position]
-            src_x = self.embed_scale * self.embed_tokens(src_sent)
+            # each row is its source followed by its constraints, each
+            # starting with <sep>; rows without constraints are all source
+            is_sep = src_tokens == self.sep_idx
+            cons_seg = torch.cumsum(is_sep, dim=1).type_as(src_tokens)
+            cons_mask = (cons_seg > 0).unsqueeze(-1)
+            x = self.embed_scale * self.embed_tokens(src_tokens)
+
+            src_sent = src_tokens.masked_fill(cons_mask.squeeze(-1), self.padding_idx)
             src_position = self.embed_positions(src_sent)
-            src_seg_emb = self.seg_embed(torch.zeros_like(src_sent))
+            cons_position = self.cons_pos_embed(src_tokens, is_sep)
+            position = torch.where(cons_mask, cons_position, src_position)
 
-            cons_sent = src_tokens[:, sep_position:]
-            cons_sep_mask = (sep_mask[0], sep_mask[1] - sep_position)
-            cons_x = self.embed_scale * self.embed_tokens(cons_sent)
-            cons_position = self.cons_pos_embed(cons_sent, cons_sep_mask)
-            cons_seg = torch.cumsum((cons_sent == self.sep_idx), dim=1).type_as(cons_sent)
-            cons_seg[cons_sent == self.padding_idx] = torch.tensor([self.max_constraints_num]).type_as(cons_seg)
-            cons_seg_emb = self.seg_embed(cons_seg)
+            cons_seg[(cons_seg > 0) & (src_tokens == self.padding_idx)] = self.max_constraints_num
+            seg_emb = self.seg_embed(cons_seg)
 
-            x = torch.cat((src_x + src_position + src_seg_emb, cons_x + cons_position + cons_seg_emb), dim=1)
+            x = x + position + seg_emb
 
 
         # if self.layernorm_embedding is not None:
@@ -245,7 +245,7 @@ class ConsPosiEmb(nn.Module):
             emb[padding_idx, :] = 0
         return emb
 
-    def forward(self, input, cons_sep_mask, startpos=1024):
+    def forward(self, input, is_sep, startpos=1024):
         """Input is expected to be of size [bsz x seqlen]."""
         bsz, seq_len = input.size()
         max_pos = self.padding_idx + 1 + seq_len
@@ -257,29 +257,17 @@ class ConsPosiEmb(nn.Module):
                 startpos=startpos,
             )
         self.weights = self.weights.to(self._float_tensor)
-        positions = self.get_positions(input, self.padding_idx, cons_sep_mask)    
+        positions = self.get_positions(input, self.padding_idx, is_sep)
         return self.weights.index_select(0, positions.view(-1)).view(bsz, seq_len, -1).detach()
 
-    def get_positions(self, tensor, padding_idx, cons_sep_mask):
-        """Replace non-padding symbols with their position numbers.
-        Position numbers begin at padding_idx+1. use constraint-right-pad-source=True
+    def get_positions(self, tensor, padding_idx, is_sep):
+        """Replace non-padding symbols with their position numbers in their
+        constraint, row by row. Position numbers begin at padding_idx+1.
         padding_idx position=1, sep_idx position = 2 , others begin with 3, 
-        a little different from the figure 2 in paper.
+        a little different from the figure 2 in paper. Symbols before the
+        first sep_idx of their row get meaningless positions.
         """
-        zero_idx = (cons_sep_mask[1] == 0).nonzero(as_tuple=True)
-        diff = cons_sep_mask[1].clone()
-        diff[1:] -= cons_sep_mask[1][:-1]
-        diff[zero_idx] = 0
-        pad_mask = tensor.ne(padding_idx).int()
-        cons_pos = pad_mask.clone()
-        cons_pos[cons_sep_mask] -= diff
-        cons_pos = (torch.cumsum(cons_pos, dim=1).type_as(cons_pos) * pad_mask).long() + 1
-
-        # sep_cons = torch.ones_like(tensor)
-        # bsz, clen = tensor.size()       
-        # for b in range(bsz):
-        #     for j in range(clen):
-        #         if tensor[b, j] == padding_idx:
-        #             break 
-        #         sep_cons[b, j] = 2 if tensor[b, j] == sep_id else sep_cons[b, j - 1] + 1 
-        return cons_pos
\ No newline at end of file
+        columns = torch.arange(tensor.size(1), device=tensor.device).expand_as(tensor)
+        last_sep = torch.where(is_sep, columns, torch.zeros_like(columns)).cummax(dim=1)[0]
+        pad_mask = tensor.ne(padding_idx).long()
+        return (columns - last_sep + 1) * pad_mask + 1
@@ -1,27 +1,29 @@
-from fairseq_cli.generate import get_symbols_to_strip_from_output
+import torch
+
 from ..imt_system import IMTSystem, logger
+from ..token_template import TemplateEncoder
+from ...tracing import tracer
 
 class LecaImt(IMTSystem):
     def __init__(self, args) -> None:
         super().__init__(args)
         self.src = None
+        # the constraints are appended to the source
+        self.template_encoder = TemplateEncoder(self.encode_fn, self.src_dict)
+        self.max_constraints = 10
 
     def translate(self, src, template=None):
-        if src != self.src:
-            self.src = src
-            self.encoded_src = self.encode_fn(src)
-        template_str = ""
-        if template is not None:
-            constraints = template.get_constraints()
-            if len(constraints) > 10:
-                constraints = constraints[:10]
-                logger.warning("constraints num exceed limit!")
-            logger.debug("constraints:\n{}".format(constraints))
-            for cons in constraints:
-                template_str += " <sep> " + self.encode_constraint(cons)
-        input = self.encoded_src + template_str
+        with tracer.timer("imt.tokenize"):
+            if self.token_templates:
+                input = self.encode_input(src, template)
+            else:
+                if src != self.src:
+                    self.src = src
+                    self.encoded_src = self.encode_fn(src)
+                input = self.encoded_src + self.build_template(template)
         logger.debug("input:\n{}".format(input))
-        batch = self.make_batches(input)
+        with tracer.timer("imt.batch"):
+            batch = self.make_token_batch(input) if self.token_templates else self.make_batches(input)
         src_tokens = batch["net_input"]["src_tokens"]
         src_lengths = batch["net_input"]["src_lengths"]
 
@@ -35,15 +37,54 @@ class LecaImt(IMTSystem):
                 "src_lengths": src_lengths,
             }
         }
-        translation = self.task.inference_step(
-            self.generator, self.models, sample
-        )[0][0]
-
-        hypo_tokens = translation["tokens"]
-        hypo_str = self.tgt_dict.string(
-            hypo_tokens, self.cfg.common_eval.post_process,
-            extra_symbols_to_ignore=get_symbols_to_strip_from_output(self.generator)
-        )
+        with tracer.timer("imt.search"), self.autocast():
+            translations = self.task.inference_step(
+                self.generator, self.models, sample
+            )
+        self.trace_search(sample, translations)
+        with tracer.timer("imt.detokenize"):
+            return self.decode_hypo(translations[0][0]["tokens"])
+
+    def translate_batch(self, srcs, templates=None):
+        if templates is None:
+            templates = [None] * len(srcs)
+        with tracer.timer("imt.tokenize"):
+            if self.token_templates:
+                inputs = [self.encode_input(src, template) for src, template in zip(srcs, templates)]
+            else:
+                inputs = [self.encode_fn(src) + self.build_template(template) for src, template in zip(srcs, templates)]
+        hypos = self.generate_batch(inputs, None if self.token_templates else lambda x: x)
+        with tracer.timer("imt.detokenize"):
+            return [self.decode_hypo(hypo["tokens"]) for hypo in hypos]
+
+    def encode_input(self, src, template):
+        """The source token ids followed by <sep> and the ids of each
+        constraint, as build_template gives them in pieces."""
+        _, ids = self.template_encoder.encode_text(src)
+        if template is not None:
+            constraints = self.template_encoder.encode(template).constraints()
+            if len(constraints) > self.max_constraints:
+                constraints = constraints[:self.max_constraints]
+                logger.warning("constraints num exceed limit!")
+            sep = self.src_dict.index("<sep>")
+            for cons in constraints:
+                ids = ids + [sep] + cons
+        return torch.LongTensor(ids + [self.src_dict.eos()])
+
+    def build_template(self, template):
+        template_str = ""
+        if template is not None:
+            constraints = template.get_constraints()
+            if len(constraints) > self.max_constraints:
+                constraints = constraints[:self.max_constraints]
+                logger.warning("constraints num exceed limit!")
+            logger.debug("constraints:\n{}".format(constraints))
+            for cons in constraints:
+                template_str += " <sep> " + self.encode_constraint(cons)
+        return template_str
+
+    def decode_hypo(self, hypo_tokens):
+        hypo_str = self.hypo_string(hypo_tokens)
         detok_hypo_str = self.decode_fn(hypo_str)
         logger.debug("detok str:\n{}".format(detok_hypo_str))
         return detok_hypo_str
@@ -53,4 +94,4 @@ class LecaImt(IMTSystem):
         dataset = self.task.build_dataset_for_inference(tokens, lengths)
         sample = dataset[0]
         batch = dataset.collater([sample])
-        return batch
\ No newline at end of file
+        return batch
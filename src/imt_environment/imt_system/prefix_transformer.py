@@ -1,52 +1,71 @@
-from fairseq_cli.generate import get_symbols_to_strip_from_output
+import torch
+from fairseq.sequence_generator import PrefixStateCache
+
 from .imt_system import IMTSystem, logger
+from ..tracing import tracer
 
 class PrefixTransformer(IMTSystem):
     def __init__(self, args) -> None:
         super().__init__(args)
-        self.src = None
+        # decode the confirmed prefix in one decoder pass instead of forcing
+        # it token by token, the translations are the same
+        self.prime_prefix = True
+        # keep the decoder state of the last prefix of each source, a turn
+        # only decodes the prefix tokens after the point it diverges
+        self.decoder_cache_bytes = 256 * 2**20
+        self.generator.prefix_state_cache = PrefixStateCache(self.decoder_cache_bytes)
 
     def translate(self, src, template=None):
-        if template is not None:
-            prefix = template.template2hypo()
-            logger.debug("prefix:\n{}".format(prefix))
-            prefix_tokens = self.tgt_dict.encode_line(
-                self.encode_fn(prefix),
-                append_eos=False,
-                add_if_not_exist=False,
-            )
-            prefix_tokens = prefix_tokens.long().unsqueeze(0)
-        else:
-            prefix_tokens = None
-        
-        if src != self.src:
-            self.src = src
-            batch = self.make_batches(src)
-            # ids = batch["id"]
-            src_tokens = batch["net_input"]["src_tokens"]
-            src_lengths = batch["net_input"]["src_lengths"]
-
-            if self.use_cuda:
-                src_tokens = src_tokens.cuda()
-                src_lengths = src_lengths.cuda()
-            
-            self.sample = {
-                "net_input": {
-                    "src_tokens": src_tokens,
-                    "src_lengths": src_lengths,
-                }
-            }
+        with tracer.timer("imt.tokenize"):
+            prefix_tokens = self.encode_prefix(template)
+        if prefix_tokens is not None:
+            tracer.count("prefix_tokens", len(prefix_tokens))
+            prefix_tokens = prefix_tokens.unsqueeze(0)
+        sample, encoder_outs = self.encode_source(src)
         if self.use_cuda:
             prefix_tokens = prefix_tokens.cuda() if prefix_tokens is not None else None
 
-        translation = self.task.inference_step(
-            self.generator, self.models, self.sample, prefix_tokens=prefix_tokens
-        )[0][0]
-        hypo_tokens = translation["tokens"]
-        hypo_str = self.tgt_dict.string(
-            hypo_tokens, self.cfg.common_eval.post_process,
-            extra_symbols_to_ignore=get_symbols_to_strip_from_output(self.generator)
-        )
+        with tracer.timer("imt.search"), self.autocast():
+            translations = self.generator.generate(
+                self.models, sample, prefix_tokens=prefix_tokens, encoder_outs=encoder_outs,
+                prime_prefix=self.prime_prefix,
+            )
+        self.trace_search(sample, translations)
+        with tracer.timer("imt.detokenize"):
+            return self.decode_hypo(translations[0][0]["tokens"])
+
+    def translate_batch(self, srcs, templates=None):
+        if templates is None:
+            templates = [None] * len(srcs)
+        with tracer.timer("imt.tokenize"):
+            prefix_tokens = [self.encode_prefix(template) for template in templates]
+        if all(p is None for p in prefix_tokens):
+            prefix_tokens = None
+        hypos = self.generate_batch(srcs, self.encode_fn, prefix_tokens=prefix_tokens, prime_prefix=self.prime_prefix)
+        with tracer.timer("imt.detokenize"):
+            return [self.decode_hypo(hypo["tokens"]) for hypo in hypos]
+
+    def cache_info(self):
+        if self.generator.prefix_state_cache is None:
+            return super().cache_info()
+        return {**super().cache_info(), "decoder_state": self.generator.prefix_state_cache.cache_info()}
+
+    def encode_prefix(self, template):
+        if template is None:
+            return None
+        prefix = template.template2hypo()
+        logger.debug("prefix:\n{}".format(prefix))
+        if self.token_templates:
+            _, ids = self.template_encoder.encode_text(prefix)
+            return torch.LongTensor(ids)
+        return self.tgt_dict.encode_line(
+            self.encode_fn(prefix),
+            append_eos=False,
+            add_if_not_exist=False,
+        ).long()
+
+    def decode_hypo(self, hypo_tokens):
+        hypo_str = self.hypo_string(hypo_tokens)
         detok_hypo_str = self.decode_fn(hypo_str)
         logger.debug("detok str:\n{}".format(detok_hypo_str))
         return detok_hypo_str
@@ -56,4 +75,4 @@ class PrefixTransformer(IMTSystem):
         dataset = self.task.build_dataset_for_inference(tokens, lengths)
         sample = dataset[0]
         batch = dataset.collater([sample])
-        return batch
\ No newline at end of file
+        return batch
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+class TokenTemplate():
+    """A template in model tokens: spans of ("keep", pieces, ids) and
+    ("blank", [], []) in the order of Template.spans. The text of a kept
+    span is encoded as encode_constraint encodes it, so the span of a word
+    cut by a blank starts with the rest of its word."""
+    def __init__(self, spans) -> None:
+        self.spans = spans
+
+    def constraints(self):
+        return [ids for kind, _, ids in self.spans if kind == "keep"]
+
+class TemplateEncoder():
+    """Converts text and templates to the pieces of the model BPE and their
+    ids in dictionary, keeping the pieces and ids of the texts in an LRU.
+    The source and most kept spans of a template come back turn after
+    turn, and are encoded once. Whole texts are cached rather than words:
+    sentencepiece may split a word differently depending on the text
+    before it."""
+    def __init__(self, encode_fn, dictionary, cache_size=4096) -> None:
+        self.encode_fn = encode_fn
+        self.dictionary = dictionary
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode_text(self, text):
+        """The pieces and ids of encode_fn(text), as dictionary.encode_line
+        without eos gives them."""
+        if text in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(text)
+            return self.cache[text]
+        self.misses += 1
+        pieces = self.encode_fn(text).split()
+        value = (pieces, [self.dictionary.index(piece) for piece in pieces])
+        self.cache[text] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    def encode_constraint(self, text):
+        """The pieces and ids of IMTSystem.encode_constraint(text): text
+        that does not start with a space continues a word, its first piece
+        loses the word boundary marker."""
+        pieces, ids = self.encode_text(text)
+        if text.startswith(" ") or not pieces:
+            return pieces, ids
+        if len(pieces[0]) == 1:
+            # a lone "\u2581"
+            return pieces[1:], ids[1:]
+        first = pieces[0][1:]
+        return [first] + pieces[1:], [self.dictionary.index(first)] + ids[1:]
+
+    def encode(self, template):
+        spans = []
+        for kind, text in template.spans():
+            if kind == "keep":
+                spans.append((kind, *self.encode_constraint(text)))
+            else:
+                spans.append((kind, [], []))
+        return TokenTemplate(spans)
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "texts": len(self.cache)}
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from .imt_system import logger
+
+class TranslationCache():
+    """On-disk store of translations keyed by the sha256 of their request,
+    evicting the least recently used entries once it holds more than
+    max_bytes of hypotheses. Several processes may share one file."""
+    def __init__(self, path, max_bytes=1 << 30) -> None:
+        dir = os.path.dirname(path)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(key TEXT PRIMARY KEY, hypo TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS last_used_index ON translations (last_used)")
+        self.max_bytes = max_bytes
+        self.num_bytes = self.total_bytes()
+
+    def total_bytes(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM translations").fetchone()[0]
+
+    def get(self, key):
+        row = self.db.execute("SELECT hypo FROM translations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE translations SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, hypo):
+        size = len(hypo.encode("utf-8"))
+        self.db.execute(
+            "INSERT OR REPLACE INTO translations (key, hypo, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, hypo, size, time.time()),
+        )
+        self.num_bytes += size
+        if self.num_bytes > self.max_bytes:
+            # other processes may have written or evicted in the meantime
+            self.num_bytes = self.total_bytes()
+            self.evict()
+
+    def evict(self):
+        # evict down to 90% so that the next puts do not evict again
+        target = self.max_bytes * 0.9
+        while self.num_bytes > target:
+            rows = self.db.execute(
+                "SELECT key, size FROM translations ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                if self.num_bytes <= target:
+                    break
+                keys.append((key,))
+                self.num_bytes -= size
+            self.db.executemany("DELETE FROM translations WHERE key = ?", keys)
+        logger.debug("translation cache evicted down to {} bytes".format(self.num_bytes))
+
+class CachedImt():
+    """Wraps an IMT system so that translations are looked up in a
+    TranslationCache first. Requests are keyed by the system type, its
+    signature (config, checkpoints, decoding args), the source and the
+    template, so the cache can be shared by runs of different systems,
+    policies and seeds. last_from_cache tells which hypotheses of the last
+    call were cache hits, last_response_times the time taken by each
+    request: its share of the lookups, plus its translation for misses."""
+    def __init__(self, imt_system, cache) -> None:
+        self.imt_system = imt_system
+        self.cache = cache
+        self.system_key = json.dumps(
+            [type(imt_system).__name__, imt_system.cache_signature()], sort_keys=True, default=str
+        )
+        self.hits = 0
+        self.misses = 0
+        self.last_from_cache = None
+        self.last_response_times = None
+
+    def __getattr__(self, name):
+        return getattr(self.imt_system, name)
+
+    def request_key(self, src, template):
+        if template is not None:
+            template = [template.revised_hypo, list(template.tag)]
+        request = json.dumps([self.system_key, src, template], ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def translate(self, src, template=None):
+        return self.translate_batch([src], [template])[0]
+
+    def translate_batch(self, srcs, templates=None):
+        if templates is None:
+            templates = [None] * len(srcs)
+        start_time = time.time()
+        keys = [self.request_key(src, template) for src, template in zip(srcs, templates)]
+        hypos = [self.cache.get(key) for key in keys]
+        self.last_from_cache = [hypo is not None for hypo in hypos]
+        lookup_time = (time.time() - start_time) / len(srcs)
+        self.last_response_times = [lookup_time] * len(srcs)
+        missing = [i for i, hypo in enumerate(hypos) if hypo is None]
+        self.hits += len(srcs) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            start_time = time.time()
+            self.imt_system.last_response_times = None
+            if len(missing) == 1:
+                translations = [self.imt_system.translate(srcs[missing[0]], templates[missing[0]])]
+            else:
+                translations = self.imt_system.translate_batch([srcs[i] for i in missing], [templates[i] for i in missing])
+            response_times = self.imt_system.last_response_times
+            if response_times is None:
+                response_times = [(time.time() - start_time) / len(missing)] * len(missing)
+            for i, hypo, response_time in zip(missing, translations, response_times):
+                hypos[i] = hypo
+                self.last_response_times[i] += response_time
+                self.cache.put(keys[i], hypo)
+        return hypos
+
+    def translate_stream(self, src, template=None, on_partial=None):
+        """A cached translation comes as a single partial."""
+        if on_partial is None:
+            return self.translate(src, template)
+        start_time = time.time()
+        key = self.request_key(src, template)
+        hypo = self.cache.get(key)
+        self.last_from_cache = [hypo is not None]
+        if hypo is not None:
+            self.hits += 1
+            on_partial(hypo)
+        else:
+            self.misses += 1
+            hypo = self.imt_system.translate_stream(src, template, on_partial)
+            self.cache.put(key, hypo)
+        self.last_response_times = [time.time() - start_time]
+        return hypo
+
+    def update(self, src, tgt):
+        self.imt_system.update(src, tgt)
+
+    def cache_info(self):
+        return {
+            "translation": {"hits": self.hits, "misses": self.misses, "bytes": self.cache.num_bytes},
+            **self.imt_system.cache_info(),
+        }
@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger("journal")
+
+class EpisodeJournal():
+    """Append-only file with one JSON line per finished episode, so that
+    saving progress costs the same for every episode. Lines are flushed as
+    they are written and synced to disk every fsync_every episodes."""
+    def __init__(self, path, fsync_every=16) -> None:
+        dir = os.path.dirname(path)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+        if os.path.exists(path):
+            truncate_incomplete_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+        self.fsync_every = fsync_every
+        self.unsynced = 0
+
+    def append(self, index, state):
+        self.file.write(json.dumps({"index": index, **state}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+def truncate_incomplete_line(path):
+    """Cuts a last line left without its newline by a crash, so that new
+    records do not get appended to it."""
+    with open(path, "rb+") as journal:
+        data = journal.read()
+        if data and not data.endswith(b"\n"):
+            journal.truncate(data.rfind(b"\n") + 1)
+
+def load_journals(paths):
+    """Returns {index: state} of the episodes recorded in the journals. A
+    last line cut short by a crash is ignored, its episode runs again."""
+    states = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as journal:
+            try:
+                lines = journal.readlines()
+            except UnicodeDecodeError:
+                raise ValueError("{} is not an episode journal".format(path))
+        for n, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if n == len(lines) - 1:
+                    logger.warning("ignore the incomplete last line of {}".format(path))
+                    continue
+                raise ValueError("{} is not an episode journal (line {})".format(path, n + 1))
+            states[record.pop("index")] = record
+    return states
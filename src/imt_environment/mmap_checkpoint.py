@@ -0,0 +1,179 @@
+"""Memory-mapped checkpoints: the weights of a fairseq checkpoint stored as
+flat tensors aligned in one file, which IMTSystem maps instead of reading
+when it is given one as --path. The model is built without initializing
+its weights and takes the mapped tensors as its parameters, so loading it
+reads nothing but the header and the processes serving the same model share
+its weights through the page cache:
+
+    python -m imt_environment.mmap_checkpoint checkpoint.pt checkpoint.mmap
+
+The file holds a magic string, the length of its JSON header, the header
+with the dtype, shape and offset of each tensor and the position of the
+rest of the checkpoint (its config, pickled), then the tensors. The
+optimizer state is dropped.
+"""
+import io
+import os
+import sys
+import json
+import argparse
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch import nn
+
+from fairseq import checkpoint_utils
+from fairseq.dataclass.utils import overwrite_args_by_name
+
+logger = logging.getLogger("imt_system")
+
+MAGIC = b"IMTMMAP1"
+# tensors are aligned to this many bytes in a checkpoint file
+ALIGNMENT = 64
+
+def is_mmap_checkpoint(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def convert_checkpoint(src, dst):
+    """Writes the fairseq checkpoint src as a memory-mapped checkpoint.
+    Tensors shared by several names, e.g. tied embeddings, are stored once."""
+    state = checkpoint_utils.load_checkpoint_to_cpu(src)
+    model_state = state.pop("model")
+    state.pop("last_optimizer_state", None)
+    tensors, stored, offset = {}, {}, 0
+    for name, tensor in model_state.items():
+        if tensor.is_quantized:
+            raise ValueError("quantized tensor {} cannot be memory-mapped".format(name))
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.stride(), tensor.dtype)
+        if key not in stored:
+            stored[key] = (offset, tensor)
+            offset += align(tensor.nelement() * tensor.element_size())
+        tensors[name] = [str(tensor.dtype).replace("torch.", ""), list(tensor.shape), stored[key][0]]
+    blob = io.BytesIO()
+    torch.save(state, blob)
+    blob = blob.getvalue()
+    header = json.dumps({"tensors": tensors, "state": [offset, len(blob)]}).encode("utf-8")
+    data_start = align(len(MAGIC) + 8 + len(header))
+    tmp_path = dst + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for tensor_offset, tensor in stored.values():
+            f.seek(data_start + tensor_offset)
+            f.write(tensor.detach().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+        f.seek(data_start + offset)
+        f.write(blob)
+    os.replace(tmp_path, dst)
+    return len(tensors), len(stored)
+
+def load_mmap_checkpoint(path, arg_overrides=None):
+    """The checkpoint state of path, as checkpoint_utils.load_checkpoint_to_cpu
+    gives it, with copy-on-write memory-mapped tensors as its model state."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a memory-mapped checkpoint".format(path))
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+        data_start = align(len(MAGIC) + 8 + header_length)
+        blob_offset, blob_length = header["state"]
+        f.seek(data_start + blob_offset)
+        state = torch.load(io.BytesIO(f.read(blob_length)), map_location="cpu")
+    # private mapping: the pages are shared until a process writes to them
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start, shape=(blob_offset,)) if blob_offset > 0 else None
+    model_state = {}
+    for name, (dtype, shape, offset) in header["tensors"].items():
+        dtype = getattr(torch, dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        flat = torch.from_numpy(data[offset:offset + nbytes]) if nbytes > 0 else torch.empty(0, dtype=torch.uint8)
+        model_state[name] = flat.view(dtype).view(shape)
+    state["model"] = model_state
+    if arg_overrides is not None:
+        if state.get("args") is not None:
+            for arg_name, arg_val in arg_overrides.items():
+                setattr(state["args"], arg_name, arg_val)
+        if state.get("cfg") is not None:
+            overwrite_args_by_name(state["cfg"], arg_overrides)
+    return state
+
+@contextmanager
+def skip_init():
+    """Makes the torch.nn.init functions no-ops, so modules built in the
+    context keep their weights uninitialized, and unwritten."""
+    names = [name for name in dir(nn.init) if name.endswith("_") and not name.startswith("_")]
+    originals = {name: getattr(nn.init, name) for name in names}
+    for name in names:
+        setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(nn.init, name, function)
+
+def tied_parameters(model):
+    """The names of each parameter of model shared by several modules."""
+    names = {}
+    for name, parameter in model.named_parameters(remove_duplicate=False):
+        names.setdefault(id(parameter), []).append(name)
+    return [group for group in names.values() if len(group) > 1]
+
+def load_mmap_ensemble(filenames, arg_overrides=None, task=None, strict=True):
+    """The models of the memory-mapped checkpoints, as
+    checkpoint_utils.load_model_ensemble returns them, with the mapped
+    tensors as their parameters. Tensors whose dtype differs from that of
+    the model are copied."""
+    from fairseq import tasks
+
+    ensemble, cfg = [], None
+    for filename in filenames:
+        state = load_mmap_checkpoint(filename, arg_overrides)
+        cfg = state["cfg"]
+        if task is None:
+            task = tasks.setup_task(cfg.task)
+        if "task_state" in state:
+            task.load_state_dict(state["task_state"])
+        with skip_init():
+            model = task.build_model(cfg.model)
+        if state.get("optimizer_history") and "num_updates" in state["optimizer_history"][-1]:
+            model.set_num_updates(state["optimizer_history"][-1]["num_updates"])
+        model_state = state["model"]
+        model.upgrade_state_dict(model_state)
+        model_state = checkpoint_utils.prune_state_dict(model_state, cfg.model)
+        expected = model.state_dict()
+        copied = 0
+        for name, tensor in model_state.items():
+            if name in expected and expected[name].dtype != tensor.dtype:
+                model_state[name] = tensor.to(expected[name].dtype)
+                copied += 1
+        if copied > 0:
+            logger.warning("{}: {} tensors are copied to the dtype of the model".format(filename, copied))
+        ties = tied_parameters(model)
+        nn.Module.load_state_dict(model, model_state, strict=strict, assign=True)
+        # assigning gives each name a parameter of its own, tied again as
+        # the model was built, e.g. the output projection to the embeddings
+        for first, *others in ties:
+            parameter = model.get_parameter(first)
+            for name in others:
+                module_name, _, attr = name.rpartition(".")
+                setattr(model.get_submodule(module_name), attr, parameter)
+        ensemble.append(model)
+    return ensemble, cfg
+
+def main():
+    parser = argparse.ArgumentParser(description="convert a fairseq checkpoint to a memory-mapped checkpoint")
+    parser.add_argument("checkpoint", help="path of the fairseq checkpoint")
+    parser.add_argument("output", help="path of the memory-mapped checkpoint")
+    args = parser.parse_args()
+    names, stored = convert_checkpoint(args.checkpoint, args.output)
+    print("{} tensors ({} stored) written to {}, {:.1f}MB".format(names, stored, args.output, os.path.getsize(args.output) / (1 << 20)))
+
+if __name__ == "__main__":
+    sys.exit(main())
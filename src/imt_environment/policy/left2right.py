@@ -8,6 +8,7 @@ class Left2RightPolicy(Policy):
         self.n = n
 
     def initialize_episode(self):
+        super().initialize_episode()
         self.real_n = self.n
         self.prev_wrong_pos = -self.n
         self.prefix = None
@@ -8,6 +8,7 @@ class Left2RightInfillingPolicy(Policy):
         super().__init__(tokenizer)
 
     def initialize_episode(self):
+        super().initialize_episode()
         self.constraint_spans = None
         self.tolerance = 3
 
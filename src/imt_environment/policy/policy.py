@@ -1,24 +1,51 @@
 import logging
+from collections import OrderedDict
 from .utils import post_editing, edit_distance
+from ..tracing import tracer
 
 logger = logging.getLogger("policy")
 logger.setLevel(logging.DEBUG)
 
 class Policy():
-    def __init__(self, tokenizer) -> None:
+    def __init__(self, tokenizer, cache_size=64) -> None:
         self.tokenizer = tokenizer
+        # the same hypothesis and reference are tokenized many times per turn
+        self.cache_size = cache_size
+        self.encode_cache = OrderedDict()
+        self.decode_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def initialize_episode(self):
-        pass
+        self.encode_cache.clear()
+        self.decode_cache.clear()
 
     def revise(self, hyp, tgt):
         pass
 
     def encode(self, sentence: str) -> list:
-        return self.tokenizer.encode(sentence)
+        tokens = self.cached(self.encode_cache, sentence, lambda: self.tokenizer.encode(sentence))
+        return list(tokens) # callers edit the returned tokens in place
 
     def decode(self, tokens: list) -> str:
-        return self.tokenizer.decode(tokens)
+        return self.cached(self.decode_cache, tuple(tokens), lambda: self.tokenizer.decode(tokens))
+
+    def cached(self, cache, key, fn):
+        """LRU lookup of key in cache, calling fn on a miss."""
+        if key in cache:
+            self.cache_hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+        self.cache_misses += 1
+        with tracer.timer("policy.tokenize"):
+            value = fn()
+        cache[key] = value
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses}
 
     def max_turn(self, hypo, tgt):
         hypo_words = self.encode(hypo)
@@ -4,9 +4,10 @@ from .left2right_infilling import Left2RightInfillingPolicy, logger
 class RandomInfillingPolicy(Left2RightInfillingPolicy):
     def __init__(self, tokenizer, seed=1) -> None:
         super().__init__(tokenizer)
-        random.seed(seed)
+        self.random = random.Random(seed)
 
     def initialize_episode(self):
+        super().initialize_episode()
         self.constraint_spans = None
         self.tolerance = 3
 
@@ -18,7 +19,7 @@ class RandomInfillingPolicy(Left2RightInfillingPolicy):
             num_blank = len(self.constraint_spans) + 1 - int(self.constraint_spans[0][0] == 0) - int(self.constraint_spans[-1][1] == tgt_len)
         else:
             num_blank = 1
-        revise_pos = random.randint(0, 2 * num_blank - 1)
+        revise_pos = self.random.randint(0, 2 * num_blank - 1)
         logger.debug("revise_pos: {}".format(revise_pos))
         if revise_pos % 2 == 0:
             revise_pos = revise_pos // 2
@@ -7,9 +7,10 @@ from .utils import edit_operations, char_tag
 class RandomPolicy(Policy):
     def __init__(self, tokenizer, seed=1) -> None:
         super().__init__(tokenizer)
-        random.seed(seed)
+        self.random = random.Random(seed)
 
     def initialize_episode(self):
+        super().initialize_episode()
         self.constraint_span = None
         self.tolerance = 3
 
@@ -36,7 +37,7 @@ class RandomPolicy(Policy):
                     elif self.constraint_span[1] == tgt_len:
                         revise_direction = "left"
                     else:
-                        revise_direction = "right" if random.randint(0, 1) else "left"
+                        revise_direction = "right" if self.random.randint(0, 1) else "left"
                     logger.debug("direction: {}".format(revise_direction))
                     cons_begin_idx = np.argwhere(hyp_offset == cons_begin_pos).item()
                     cons_end_idx = np.argwhere(hyp_offset == cons_end_pos).item()
@@ -87,7 +88,7 @@ class RandomPolicy(Policy):
         if revise_ops:
             new_revise_ops = [op for op in revise_ops if tgt_words[op[2]] != "\u2581"]
             if new_revise_ops:
-                revise_op = random.choice(new_revise_ops)
+                revise_op = self.random.choice(new_revise_ops)
             else:
                 editing_cost = 0
                 token_tag = []
@@ -6,42 +6,49 @@ from sentencepiece import SentencePieceProcessor
 def edit_distance(src: List[str], tgt: List[str]) -> int:
     return editdistance.eval(src, tgt)
 
-def edit_operations(src: List[str], tgt: List[str]):
+def edit_distance_matrix(src: List[str], tgt: List[str]):
+    """Levenshtein distances between all prefixes of src and tgt. Each row
+    is computed with numpy: the insertion chain dis[i, j - 1] + 1 is a running
+    minimum of (dis[i, j] - j), so a row needs no loop over j."""
+    vocab = {}
+    src_ids = np.array([vocab.setdefault(w, len(vocab)) for w in src], dtype=int)
+    tgt_ids = np.array([vocab.setdefault(w, len(vocab)) for w in tgt], dtype=int)
     src_len = len(src)
     tgt_len = len(tgt)
-    dis = np.ones((src_len + 1, tgt_len + 1), dtype=int) * 1000
-    dis[:, 0] = np.arange(src_len + 1)
-    dis[0, :] = np.arange(tgt_len + 1)
-    op = np.zeros_like(dis) # 0: keep 1: insert 2: delete 3: replace
-    op[0, 1:] = np.ones(tgt_len, dtype=int)
-    op[1:, 0] = np.ones(src_len, dtype=int) * 2
+    dis = np.empty((src_len + 1, tgt_len + 1), dtype=int)
+    steps = np.arange(tgt_len + 1)
+    dis[0] = steps
     for i in range(1, src_len + 1):
-        for j in range(1, tgt_len + 1):
-            diagonal = dis[i - 1, j - 1] + int(src[i - 1] != tgt[j - 1])
-            dis[i, j] = min(dis[i - 1, j] + 1, dis[i, j - 1] + 1, diagonal)
-            if dis[i, j] == dis[i, j - 1] + 1:
-                op[i, j] = 1
-            elif dis[i, j] == diagonal > dis[i - 1, j - 1]:
-                op[i, j] = 3
-            elif dis[i, j] == dis[i - 1, j] + 1:
-                op[i, j] = 2
-    i, j = src_len, tgt_len
+        row = dis[i]
+        row[0] = i
+        np.minimum(dis[i - 1, :-1] + (tgt_ids != src_ids[i - 1]), dis[i - 1, 1:] + 1, out=row[1:])
+        row -= steps
+        np.minimum.accumulate(row, out=row)
+        row += steps
+    return dis
+
+def edit_operations(src: List[str], tgt: List[str]):
+    dis = edit_distance_matrix(src, tgt)
+    # walk back from the end, preferring insert, replace, delete, keep
+    d = dis.tolist()
+    i, j = len(src), len(tgt)
     op_list = []
     while i > 0 or j > 0:
-        if op[i, j] == 0:
-            i -= 1
+        if i == 0 or (j > 0 and d[i][j] == d[i][j - 1] + 1):
             j -= 1
-            op_list.insert(0, ("keep", i, j))
-        elif op[i, j] == 1:
+            op_list.append(("ins", i, j))
+        elif j > 0 and src[i - 1] != tgt[j - 1] and d[i][j] == d[i - 1][j - 1] + 1:
+            i -= 1
             j -= 1
-            op_list.insert(0, ("ins", i, j))
-        elif op[i, j] == 2:
+            op_list.append(("repl", i, j))
+        elif j == 0 or d[i][j] == d[i - 1][j] + 1:
             i -= 1
-            op_list.insert(0, ("del", i, j))
+            op_list.append(("del", i, j))
         else:
             i -= 1
             j -= 1
-            op_list.insert(0, ("repl", i, j))
+            op_list.append(("keep", i, j))
+    op_list.reverse()
     return op_list, dis
 
 def post_editing(src: List[str], tgt: List[str]):
@@ -1,13 +1,47 @@
+import os
+import logging
 from flask import Flask
 from .main import main
+from .session import SessionStore
+from .worker import ModelWorker, QueueTimeout
+
+logger = logging.getLogger("environment")
+
+def load_secret_key(args):
+    """The key signing the cookie naming the session of each annotator. It
+    is kept in --server-secret-key-file, by default next to the checkpoint
+    or export, so the cookies stay valid when the server restarts."""
+    path = getattr(args, "server_secret_key_file", None)
+    if path is None:
+        base = args.checkpoint if getattr(args, "checkpoint", None) is not None else getattr(args, "export_path", None)
+        if base is None:
+            logger.warning("no checkpoint or export path to keep the session key next to, annotators lose their session when the server restarts")
+            return os.urandom(16)
+        path = base + ".secret"
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    key = os.urandom(16)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
 
 def create_app(args, imt_system, testset):
     app = Flask(__name__)
+    app.secret_key = load_secret_key(args)
     if not hasattr(app, 'extensions'):
         app.extensions = {}
     app.extensions["args"] = args
     app.extensions["imt_system"] = imt_system
     app.extensions["testset"] = testset
+    app.extensions["sessions"] = SessionStore()
+    app.extensions["worker"] = ModelWorker(
+        imt_system,
+        max_batch_size=getattr(args, "server_batch_size", 8),
+        batch_wait=getattr(args, "server_batch_wait", 10) / 1000,
+        max_queue_wait=getattr(args, "server_max_queue_wait", None),
+    )
     app.register_blueprint(main)
 
-    return app
\ No newline at end of file
+    return app
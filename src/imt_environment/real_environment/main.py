@@ -1,105 +1,135 @@
-from flask import Blueprint, render_template, request, current_app, jsonify, redirect, url_for, abort
-import time, json, torch, os
+from flask import Blueprint, Response, render_template, request, current_app, jsonify, redirect, url_for, abort, session as flask_session
+import os, time, json, re, queue
 from imt_environment.template import Template
-from imt_environment.environment import State, logger
+from imt_environment.results import ResultsStore, human_records
+from imt_environment.environment import logger
+from .session import DEFAULT_SESSION
+from .worker import QueueTimeout
 
 main = Blueprint("main", __name__)
-translations = []
-current_index = page_index = 0
-
-success = []
-editing_cost = []
-turns = []
-response_time = []
-processes = []
-process = []
-last_hypothesis = None
-state = State()
-state.initialize_episode()
 punc_transtab = str.maketrans(",;:!?()", "，；：！？（）")
 
+def current_session():
+    """The session of the annotator of the request, named by the annotator
+    parameter of the index page."""
+    return current_app.extensions["sessions"].get(flask_session.get("annotator", DEFAULT_SESSION))
+
+def request_translation(session, src, template=None, future=None):
+    """Translates with the model worker, or waits for the future of a
+    request already queued. Returns the result of the worker, None if the
+    request waited too long."""
+    if future is None:
+        future = current_app.extensions["worker"].submit(src, template)
+    session.start_request()
+    try:
+        result = future.result()
+    except QueueTimeout as e:
+        logger.warning("session {}: {}".format(session.name, e))
+        session.end_request()
+        return None
+    session.end_request(result)
+    return result
+
 @main.route("/", methods=["GET", "POST"])
 def index():
-    global current_index, page_index, state, success, editing_cost, turns, response_time, processes, translations, last_hypothesis
+    annotator = request.args.get("annotator")
+    if annotator is not None:
+        if not re.fullmatch(r"[\w-]+", annotator):
+            abort(400)
+        flask_session["annotator"] = annotator
+    session = current_session()
     testset = current_app.extensions["testset"]
 
-    if request.method == "POST":
-        submit_result = request.get_json()
-        translation = submit_result['translation']
-        template = submit_result["template"]
-        if template:
-            state.editing_cost += calc_editing_cost(template["tags"])
-        process.append(template)
-        process[-1]["hypothesis"] = last_hypothesis
-        state.success = submit_result["success"]
-        if state.success:
-            logger.info(f"accept at turn {state.turn}!")
-        else:
-            logger.info("episode failed!")
-        if (page_index < current_index):
-            translations[page_index] = translation
-            editing_cost[page_index] = state.editing_cost
-            response_time[page_index]= state.response_time
-            success[page_index]= state.success
-            turns[page_index]= state.turn
-            processes[page_index] = process
-            redirect_url = url_for("main.submit", id=current_index)
-        elif (current_index < len(testset)):
-            translations.append(translation)
-            editing_cost.append(state.editing_cost)
-            response_time.append(state.response_time)
-            success.append(state.success)
-            turns.append(state.turn)
-            processes.append(process)
-            current_index += 1
-            redirect_url = url_for("main.submit", id=current_index)
-        else:
-            redirect_url = url_for("main.complete")
-        return jsonify({"url": redirect_url})
-    elif request.method == "GET":
-        checkpoint = current_app.extensions["args"].checkpoint
-        if checkpoint is not None and os.path.exists(checkpoint) and not translations:
-            state_dict = torch.load(checkpoint)
-            current_index = state_dict["num"]
-            success = state_dict["success"]
-            turns = state_dict["turns"]
-            editing_cost = state_dict["editing_cost"]
-            response_time = state_dict["response_time"]
-            translations = state_dict["translations"]
-            processes = state_dict["processes"]
+    with session.lock:
+        if request.method == "POST":
+            submit_result = request.get_json()
+            translation = submit_result['translation']
+            template = submit_result["template"]
+            state = session.state
+            if template:
+                state.editing_cost += calc_editing_cost(template["tags"])
+            session.process.append(template)
+            session.process[-1]["hypothesis"] = session.last_hypothesis
+            state.success = submit_result["success"]
+            if state.success:
+                logger.info(f"session {session.name}: accept at turn {state.turn}!")
+            else:
+                logger.info(f"session {session.name}: episode failed!")
+            if (session.page_index < session.current_index):
+                session.translations[session.page_index] = translation
+                session.editing_cost[session.page_index] = state.editing_cost
+                session.response_time[session.page_index]= state.response_time
+                session.success[session.page_index]= state.success
+                session.turns[session.page_index]= state.turn
+                session.processes[session.page_index] = session.process
+                session.init_model_time[session.page_index] = session.page_init_model_time
+                session.prefetched[session.page_index] = session.page_prefetched
+                session.first_token_time[session.page_index] = session.page_first_token_time
+                redirect_url = url_for("main.submit", id=session.current_index)
+            elif (session.current_index < len(testset)):
+                session.translations.append(translation)
+                session.editing_cost.append(state.editing_cost)
+                session.response_time.append(state.response_time)
+                session.success.append(state.success)
+                session.turns.append(state.turn)
+                session.processes.append(session.process)
+                session.init_model_time.append(session.page_init_model_time)
+                session.prefetched.append(session.page_prefetched)
+                session.first_token_time.append(session.page_first_token_time)
+                session.current_index += 1
+                redirect_url = url_for("main.submit", id=session.current_index)
+            else:
+                redirect_url = url_for("main.complete")
+            return jsonify({"url": redirect_url})
+        elif request.method == "GET":
+            session.load(current_app.extensions["args"].checkpoint)
 
-    return redirect(url_for("main.submit", id=current_index))
+        return redirect(url_for("main.submit", id=session.current_index))
 
 @main.route("/<int:id>", methods=["GET"])
 def submit(id):
-    global state, process, current_index, page_index, last_hypothesis
-    if id > current_index:
-        return redirect(url_for("main.submit", id=current_index))
+    session = current_session()
+    with session.lock:
+        if id > session.current_index:
+            return redirect(url_for("main.submit", id=session.current_index))
 
-    args = current_app.extensions["args"]
-    testset = current_app.extensions["testset"]
-    imt_system = current_app.extensions["imt_system"]
+        args = current_app.extensions["args"]
+        testset = current_app.extensions["testset"]
 
-    src_lang = args.src_lang
-    tgt_lang = args.tgt_lang
-    src_path = args.src_path
+        src_lang = args.src_lang
+        tgt_lang = args.tgt_lang
+        src_path = args.src_path
 
-    if (id < len(testset)):
-        src_sentence = testset[id]
-        page_index = id
-    else:
-        return redirect(url_for("main.complete"))
+        if (id < len(testset)):
+            src_sentence = testset[id]
+            session.page_index = id
+        else:
+            return redirect(url_for("main.complete"))
 
-    state.initialize_episode()
-    process = []
-    state.turn = 1
-    start_time = time.time()
-    init_translation = imt_system.translate(src_sentence)
-    respond_time = time.time() - start_time
-    state.response_time += respond_time
-    if tgt_lang == "zh":
-        init_translation = init_translation.translate(punc_transtab)
-    last_hypothesis = init_translation
+        state = session.state
+        state.initialize_episode()
+        session.process = []
+        session.page_first_token_time = 0
+        state.turn = 1
+        start_time = time.time()
+        future = session.take_prefetch(id)
+        session.page_prefetched = future is not None
+        result = request_translation(session, src_sentence, future=future)
+        if result is None:
+            abort(503)
+        # the next sentences are translated while the annotator works on this
+        # one; after revising an earlier sentence, the annotator comes back
+        # to the first one not annotated
+        start = id + 1 if id == session.current_index else session.current_index
+        session.prefetch(current_app.extensions["worker"], testset, start, getattr(args, "server_prefetch", 0))
+        init_translation = result["translation"]
+        # the annotator only waits for what is left of a prefetched translation
+        respond_time = time.time() - start_time
+        state.response_time += respond_time
+        session.page_init_model_time = result["model_time"]
+        if tgt_lang == "zh":
+            init_translation = init_translation.translate(punc_transtab)
+        session.last_hypothesis = init_translation
 
     return render_template(
         "index.html",
@@ -131,12 +161,85 @@ def complete():
 
 @main.route("/translate", methods=["POST"])
 def translate():
-    global state, process, last_hypothesis
+    session = current_session()
     req_data = request.get_json()
-    imt_system = current_app.extensions["imt_system"]
     tgt_lang = current_app.extensions["args"].tgt_lang
+    input_text, template, constraints, cost = parse_translate_request(req_data, tgt_lang)
+
+    with session.lock:
+        start_time = time.time()
+        result = request_translation(session, input_text, template)
+        if result is None:
+            return jsonify({"error": "the model is busy, please translate again"}), 503
+        translation = result["translation"]
+        respond_time = time.time() - start_time
+        translation, matched_pos = end_turn(session, req_data, translation, constraints, cost, respond_time, tgt_lang)
+
+    response = {"translated_text": translation, "constraints_pos": matched_pos}
+    return jsonify(response)
+
+@main.route("/translate_stream", methods=["POST"])
+def translate_stream():
+    """/translate as server-sent events: {"partial"} with the translation
+    so far, as the model produces it, then the response of /translate with
+    the response time and the time to the first partial, or {"error"}."""
+    session = current_session()
+    req_data = request.get_json()
+    tgt_lang = current_app.extensions["args"].tgt_lang
+    worker = current_app.extensions["worker"]
+    input_text, template, constraints, cost = parse_translate_request(req_data, tgt_lang)
+
+    def events():
+        with session.lock:
+            start_time = time.time()
+            partials = queue.Queue()
+            future = worker.submit(input_text, template, on_partial=partials.put)
+            future.add_done_callback(lambda _: partials.put(None))
+            session.start_request()
+            first_token_time = None
+            done = False
+            while not done:
+                # only the last of the partials queued while sending is sent
+                texts = [partials.get()]
+                while not partials.empty():
+                    texts.append(partials.get_nowait())
+                done = texts[-1] is None
+                texts = [text for text in texts if text is not None]
+                if texts:
+                    if first_token_time is None:
+                        first_token_time = time.time() - start_time
+                    partial = texts[-1].translate(punc_transtab) if tgt_lang == "zh" else texts[-1]
+                    yield server_event({"partial": partial})
+            try:
+                result = future.result()
+            except QueueTimeout as e:
+                logger.warning("session {}: {}".format(session.name, e))
+                session.end_request()
+                yield server_event({"error": "the model is busy, please translate again"})
+                return
+            respond_time = time.time() - start_time
+            if first_token_time is None:
+                first_token_time = respond_time
+            session.end_request(result, first_token_time)
+            session.page_first_token_time += first_token_time
+            translation, matched_pos = end_turn(session, req_data, result["translation"], constraints, cost, respond_time, tgt_lang)
+        yield server_event({
+            "translated_text": translation,
+            "constraints_pos": matched_pos,
+            "response_time": respond_time,
+            "first_token_time": first_token_time,
+        })
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def server_event(data):
+    return "data: {}\n\n".format(json.dumps(data, ensure_ascii=False))
+
+def parse_translate_request(req_data, tgt_lang):
+    """The source, template, constraints and editing cost of a translate
+    request."""
     input_text = req_data["input_text"].strip()
-    template, constraints, matched_pos = None, None, None
+    template, constraints = None, None
     cost = 0
     if req_data["template"] is not None:
         tags = req_data["template"]["tags"].copy()
@@ -145,36 +248,19 @@ def translate():
         cost = calc_editing_cost(template.tag)
 
     if constraints:
-        append_space = True
-        i = 0
-        while i < len(template.tag):
-            if template.tag[i] == 0:
-                i += 1
-            elif template.tag[i] == 4:
-                if tgt_lang != "zh":
-                    append_space = True
-                else:
-                    append_space = False
-                i += 1
-            elif append_space:
-                if template.revised_hypo[i].isalnum():
-                    template.revised_hypo = template.revised_hypo[:i] + " " + template.revised_hypo[i:]
-                    template.tag.insert(i, 1)
-                    i += 1
-                append_space = False
-                i += 1
-            else:
-                i += 1
-
-    start_time = time.time()
-    translation = imt_system.translate(input_text, template)
-    respond_time = time.time() - start_time
+        template.separate_constraints(tgt_lang)
+    return input_text, template, constraints, cost
 
+def end_turn(session, req_data, translation, constraints, cost, respond_time, tgt_lang):
+    """Records a turn of the session. Returns the translation shown to the
+    annotator and the positions of the constraints in it."""
+    matched_pos = None
+    state = session.state
     state.response_time += respond_time
     state.turn += 1
     state.editing_cost += cost
-    process.append(req_data["template"])
-    process[-1]["hypothesis"] = last_hypothesis
+    session.process.append(req_data["template"])
+    session.process[-1]["hypothesis"] = session.last_hypothesis
 
     if tgt_lang == "zh":
         translation = translation.translate(punc_transtab)
@@ -187,34 +273,50 @@ def translate():
             if cons_begin_pos >= 0:
                 cons_end_pos = cons_begin_pos + len(constraint)
                 matched_pos.append((cons_begin_pos, cons_end_pos))
-    last_hypothesis = translation
-
-    response = {"translated_text": translation, "constraints_pos": matched_pos}
-    return jsonify(response)
+    session.last_hypothesis = translation
+    return translation, matched_pos
 
 @main.route('/export', methods=["GET"])
 def export():
-    output_stats = collapse()
+    session = current_session()
+    with session.lock:
+        output_stats = collapse(session)
+        success, turns, editing_cost, response_time = session.success, session.turns, session.editing_cost, session.response_time
+        first_token_time = session.first_token_time
     num = len(output_stats)
     success_rate = sum(success) / num
     avg_turns = sum(turns) / num
     avg_cost = sum(editing_cost) / num
     avg_response_time = sum(response_time) / num
+    avg_first_token_time = sum(first_token_time) / num
     output_stats.append({
         "id": "avg statistics",
         "num": num,
         "avg_editing_cost": avg_cost,
         "avg_response_time": avg_response_time,
+        "avg_first_token_time": avg_first_token_time,
         "success_rate": success_rate,
         "avg_turns": avg_turns
     })
-    logger.info("success rate: {:.3f} | avg turns: {:.2f} | avg editing cost: {:.2f} | avg responding time: {:.3f}".format(
+    logger.info("session {} | success rate: {:.3f} | avg turns: {:.2f} | avg editing cost: {:.2f} | avg responding time: {:.3f}".format(
+        session.name,
         success_rate,
         avg_turns,
         avg_cost,
         avg_response_time
     ))
-    path = current_app.extensions["args"].export_path
+    args = current_app.extensions["args"]
+    results_dir = getattr(args, "results_dir", None)
+    if results_dir is not None:
+        ResultsStore(results_dir).write({
+            "system": current_app.extensions["imt_system"].name,
+            "policy": "Human",
+            "pair": args.src_lang + args.tgt_lang,
+            "testset": os.path.basename(os.path.dirname(os.path.abspath(args.src_path))),
+            "seed": None,
+            "annotator": session.name,
+        }, human_records(output_stats))
+    path = session.path(args.export_path)
     if path is not None:
         try:
             with open(path, "w") as f:
@@ -223,34 +325,44 @@ def export():
         except Exception as e:
             print(e)
             abort(404)
+    elif results_dir is not None:
+        return "success"
     else:
         abort(404)
 
 @main.route('/save', methods=["GET"])
 def save():
+    session = current_session()
     checkpoint = current_app.extensions["args"].checkpoint
     if checkpoint is not None:
-        torch.save({
-            "num": current_index,
-            "translations": translations,
-            "editing_cost": editing_cost,
-            "success": success,
-            "turns": turns,
-            "response_time": response_time,
-            "processes": processes
-        }, checkpoint)
+        with session.lock:
+            session.save(checkpoint)
         return "success"
     else:
         abort(404)
 
-def collapse():
+@main.route('/stats', methods=["GET"])
+def stats():
+    """The throughput of each session and the state of the model worker."""
+    return jsonify({
+        "sessions": current_app.extensions["sessions"].stats(),
+        "worker": current_app.extensions["worker"].stats(),
+    })
+
+def collapse(session):
     output_stats = []
-    for i, (trans, cost, time, turn, suc, proc) in enumerate(zip(translations, editing_cost, response_time, turns, success, processes)):
+    for i, (trans, cost, time, first_token_time, model_time, prefetched, turn, suc, proc) in enumerate(zip(
+        session.translations, session.editing_cost, session.response_time, session.first_token_time,
+        session.init_model_time, session.prefetched, session.turns, session.success, session.processes
+    )):
         output_stats.append({
             "id": i,
             "translation": trans,
             "editing_cost": cost,
             "response_time": time,
+            "first_token_time": first_token_time,
+            "init_model_time": model_time,
+            "prefetched": prefetched,
             "success": suc,
             "turns": turn,
             "process": proc
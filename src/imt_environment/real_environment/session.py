@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+import torch
+from imt_environment.environment import State
+
+DEFAULT_SESSION = "default"
+
+class Session():
+    """The annotation state of one annotator: the sentence being annotated,
+    the results of the submitted ones and the throughput of its requests.
+    The requests of a session hold its lock, so they are handled in turn."""
+    def __init__(self, name) -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.translations = []
+        self.current_index = self.page_index = 0
+        self.success = []
+        self.editing_cost = []
+        self.turns = []
+        self.response_time = []
+        self.processes = []
+        # the latency of the model for the turn-0 translation of each
+        # sentence, and whether it was prefetched
+        self.init_model_time = []
+        self.prefetched = []
+        # the time to the first partial translation of the streamed turns
+        # of each sentence, summed like the response time
+        self.first_token_time = []
+        self.process = []
+        self.last_hypothesis = None
+        self.page_init_model_time = None
+        self.page_prefetched = False
+        self.page_first_token_time = 0
+        # futures of the turn-0 translations of the next sentences, by id
+        self.prefetches = {}
+        self.state = State()
+        self.state.initialize_episode()
+        # throughput of the requests to the model
+        self.requests = 0
+        self.timeouts = 0
+        self.queue_wait = 0
+        self.model_time = 0
+        self.streamed = 0
+        self.time_to_first_token = 0
+        self.first_request = None
+        self.last_response = None
+
+    def path(self, path):
+        """The checkpoint or export path of the session, suffixed with its
+        name unless it is the default session."""
+        if path is None or self.name == DEFAULT_SESSION:
+            return path
+        return "{}.{}".format(path, self.name)
+
+    def load(self, checkpoint):
+        path = self.path(checkpoint)
+        if path is None or not os.path.exists(path) or self.translations:
+            return
+        state_dict = torch.load(path)
+        self.current_index = state_dict["num"]
+        self.success = state_dict["success"]
+        self.turns = state_dict["turns"]
+        self.editing_cost = state_dict["editing_cost"]
+        self.response_time = state_dict["response_time"]
+        self.translations = state_dict["translations"]
+        self.processes = state_dict["processes"]
+        self.init_model_time = state_dict.get("init_model_time", [None] * len(self.translations))
+        self.prefetched = state_dict.get("prefetched", [False] * len(self.translations))
+        self.first_token_time = state_dict.get("first_token_time", [0] * len(self.translations))
+
+    def save(self, checkpoint):
+        torch.save({
+            "num": self.current_index,
+            "translations": self.translations,
+            "editing_cost": self.editing_cost,
+            "success": self.success,
+            "turns": self.turns,
+            "response_time": self.response_time,
+            "processes": self.processes,
+            "init_model_time": self.init_model_time,
+            "prefetched": self.prefetched,
+            "first_token_time": self.first_token_time,
+        }, self.path(checkpoint))
+
+    def prefetch(self, worker, testset, start, k):
+        """Queues the turn-0 translations of the k sentences from start in
+        the background, and cancels those of the other sentences, left when
+        the annotator went to another sentence."""
+        upcoming = range(start, min(start + k, len(testset)))
+        for i in list(self.prefetches):
+            if i not in upcoming:
+                self.prefetches.pop(i).cancel()
+        for i in upcoming:
+            if i not in self.prefetches:
+                self.prefetches[i] = worker.submit(testset[i], background=True)
+
+    def take_prefetch(self, id):
+        """The future of the prefetched turn-0 translation of sentence id,
+        None if there is none or it failed. A prefetch the worker has not
+        started is cancelled, to be requested again in the foreground: in
+        the background, it would wait for the requests of all the other
+        annotators."""
+        future = self.prefetches.pop(id, None)
+        if future is None or future.cancel() or future.cancelled() or (future.done() and future.exception() is not None):
+            return None
+        return future
+
+    def start_request(self):
+        if self.first_request is None:
+            self.first_request = time.time()
+
+    def end_request(self, result=None, first_token_time=None):
+        """Records a response of the model worker, None for a timeout, and
+        the time to its first partial translation if it was streamed."""
+        self.last_response = time.time()
+        if result is None:
+            self.timeouts += 1
+            return
+        self.requests += 1
+        self.queue_wait += result["queue_wait"]
+        self.model_time += result["model_time"]
+        if first_token_time is not None:
+            self.streamed += 1
+            self.time_to_first_token += first_token_time
+
+    def stats(self):
+        active_time = self.last_response - self.first_request if self.last_response is not None else 0
+        return {
+            "sentences": self.current_index,
+            "requests": self.requests,
+            "prefetched": sum(self.prefetched),
+            "timeouts": self.timeouts,
+            "avg_queue_wait": self.queue_wait / self.requests if self.requests > 0 else 0,
+            "avg_model_time": self.model_time / self.requests if self.requests > 0 else 0,
+            "streamed": self.streamed,
+            "avg_first_token_time": self.time_to_first_token / self.streamed if self.streamed > 0 else 0,
+            "requests_per_minute": 60 * self.requests / active_time if active_time > 0 else 0,
+        }
+
+class SessionStore():
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.sessions:
+                self.sessions[name] = Session(name)
+            return self.sessions[name]
+
+    def stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {session.name: session.stats() for session in sessions}
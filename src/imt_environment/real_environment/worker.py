@@ -0,0 +1,131 @@
+import time
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+from imt_environment.environment import logger
+
+class QueueTimeout(Exception):
+    """A request waited longer than max_queue_wait for the model."""
+
+class ModelWorker():
+    """Runs the IMT system in a thread of its own for the requests of all
+    sessions. submit() queues a request and returns a future of its
+    translation; the worker takes the requests queued within batch_wait
+    seconds of the first one, up to max_batch_size, and translates them
+    with one translate_batch call. Requests that waited more than
+    max_queue_wait seconds in the queue, before batch_wait, fail with
+    QueueTimeout instead. Background requests, e.g. the translations of
+    the next sentences of an annotator, are taken after all the others and
+    wait as long as needed. Streamed requests are translated alone, with
+    translate_stream."""
+    def __init__(self, imt_system, max_batch_size=8, batch_wait=0.01, max_queue_wait=None) -> None:
+        self.imt_system = imt_system
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.max_queue_wait = max_queue_wait
+        self.queue = queue.PriorityQueue()
+        # keeps requests of the same priority in order
+        self.counter = itertools.count()
+        self.batches = 0
+        self.translated = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.thread = threading.Thread(target=self.run, name="model-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, src, template=None, background=False, on_partial=None):
+        """The future of {"translation", "queue_wait", "model_time",
+        "batch_size"} for the request. With on_partial, the request is
+        streamed: on_partial is called from the worker thread with each
+        partial translation."""
+        future = Future()
+        request = (src, template, future, time.monotonic(), background, on_partial)
+        self.queue.put((int(background), next(self.counter), request))
+        return future
+
+    def close(self):
+        self.queue.put((2, next(self.counter), None))
+        self.thread.join()
+
+    def run(self):
+        closed = False
+        while not closed:
+            # the first request accepted opens the batch for batch_wait seconds
+            batch, deadline = [], None
+            while len(batch) < self.max_batch_size:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    entry = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                request = entry[2]
+                if request is None:
+                    closed = True
+                    break
+                streamed = request[5] is not None
+                if streamed and batch:
+                    # left for the next batch, ahead of the requests after it
+                    self.queue.put(entry)
+                    break
+                if self.accept(request):
+                    batch.append(request)
+                    if streamed:
+                        break
+                    if deadline is None:
+                        deadline = time.monotonic() + self.batch_wait
+            if batch:
+                self.process(batch)
+
+    def accept(self, request):
+        """Whether the worker takes a request out of the queue, rather than
+        failing it because it waited too long."""
+        _, _, future, enqueued, background, _ = request
+        queue_wait = time.monotonic() - enqueued
+        if not background and self.max_queue_wait is not None and queue_wait > self.max_queue_wait:
+            self.timeouts += 1
+            future.set_exception(QueueTimeout("waited {:.3f}s for the model".format(queue_wait)))
+            return False
+        if not future.set_running_or_notify_cancel():
+            self.cancelled += 1
+            return False
+        return True
+
+    def process(self, batch):
+        start_time = time.monotonic()
+        requests = [(src, template, future, start_time - enqueued) for src, template, future, enqueued, _, _ in batch]
+        on_partial = batch[0][5]
+        try:
+            if on_partial is not None:
+                translations = [self.imt_system.translate_stream(requests[0][0], requests[0][1], on_partial)]
+            elif len(requests) == 1:
+                translations = [self.imt_system.translate(requests[0][0], requests[0][1])]
+            else:
+                translations = self.imt_system.translate_batch(
+                    [src for src, _, _, _ in requests], [template for _, template, _, _ in requests]
+                )
+        except Exception as e:
+            logger.exception("translation of a batch of {} failed".format(len(requests)))
+            for _, _, future, _ in requests:
+                future.set_exception(e)
+            return
+        model_time = time.monotonic() - start_time
+        self.batches += 1
+        self.translated += len(requests)
+        for (_, _, future, queue_wait), translation in zip(requests, translations):
+            future.set_result({
+                "translation": translation,
+                "queue_wait": queue_wait,
+                "model_time": model_time,
+                "batch_size": len(requests),
+            })
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "batches": self.batches,
+            "translated": self.translated,
+            "avg_batch_size": self.translated / self.batches if self.batches > 0 else 0,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
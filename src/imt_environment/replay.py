@@ -0,0 +1,144 @@
+import json
+import time
+import logging
+
+from .template import Template
+from .tracing import tracer
+from .policy import utils
+
+logger = logging.getLogger("replay")
+
+# the web UI shows chinese translations with full-width punctuation
+ZH_PUNC_TRANSTAB = str.maketrans(",;:!?()", "，；：！？（）")
+
+class Trajectory():
+    """The recorded interaction of an annotator with the web UI on one
+    sentence. process holds one template per revision: each but the last
+    was sent to the IMT system, the last one is the final post-editing.
+    The hypothesis of entry k, when recorded, is the translation the
+    annotator revised into that template, i.e. the answer to request k
+    (request 0 being the initial translation)."""
+    def __init__(self, index, src, process) -> None:
+        self.index = index
+        self.src = src
+        self.process = process
+
+    @property
+    def num_requests(self):
+        return len(self.process)
+
+    def template(self, k):
+        """The template of request k, None for the initial translation."""
+        if k == 0:
+            return None
+        entry = self.process[k - 1]
+        return Template(entry["revisedHypo"], list(entry["tags"]))
+
+    def recorded_hypo(self, k):
+        return self.process[k].get("hypothesis")
+
+def load_trajectories(path, srcs):
+    """Returns the trajectories of an exported human experiment, whose
+    sources are the lines of srcs at their ids."""
+    with open(path, encoding="utf-8") as f:
+        records = json.load(f)
+    trajectories = []
+    for record in records:
+        # the last record holds the averages of the experiment
+        if not isinstance(record["id"], int) or not record.get("process"):
+            continue
+        trajectories.append(Trajectory(record["id"], srcs[record["id"]].strip(), record["process"]))
+    return trajectories
+
+class Replay():
+    """Sends the requests of recorded trajectories to an IMT system, as the
+    web UI did, and compares the translations with the recorded ones.
+    Templates do not depend on the translations, so the next requests of
+    batch_size trajectories are translated by one translate_batch call."""
+    def __init__(self, imt_system, tgt_lang, batch_size=1) -> None:
+        self.imt_system = imt_system
+        self.tgt_lang = tgt_lang
+        self.batch_size = batch_size
+
+    def tokenize(self, hypo):
+        return list(hypo.replace(" ", "")) if self.tgt_lang == "zh" else hypo.split()
+
+    def run(self, trajectories):
+        """Yields one record per request: {"index", "turn", "hypo",
+        "recorded", "response_time", "divergence"}, the divergence being
+        the edit distance to the recorded hypothesis over its length in
+        words (characters for chinese), None if it was not recorded."""
+        trajectories = iter(trajectories)
+        running = []
+        while True:
+            while len(running) < self.batch_size:
+                trajectory = next(trajectories, None)
+                if trajectory is None:
+                    break
+                logger.info("trajectory {}".format(trajectory.index))
+                running.append((trajectory, 0))
+            if not running:
+                break
+
+            srcs = [trajectory.src for trajectory, _ in running]
+            templates = [self.prepare(trajectory.template(k)) for trajectory, k in running]
+            tracer.begin_turn(system=self.imt_system.name, policy="Replay", episode=None, turn=None)
+            start_time = time.time()
+            self.imt_system.last_response_times = None
+            with tracer.timer("translate"):
+                if len(running) == 1:
+                    hypos = [self.imt_system.translate(srcs[0], templates[0])]
+                else:
+                    hypos = self.imt_system.translate_batch(srcs, templates)
+            elapsed = time.time() - start_time
+            tracer.end_turn(requests=len(running))
+            response_times = self.imt_system.last_response_times or [elapsed / len(running)] * len(running)
+
+            next_running = []
+            for (trajectory, k), hypo, response_time in zip(running, hypos, response_times):
+                if self.tgt_lang == "zh":
+                    hypo = hypo.translate(ZH_PUNC_TRANSTAB)
+                recorded = trajectory.recorded_hypo(k)
+                yield {
+                    "index": trajectory.index,
+                    "turn": k,
+                    "hypo": hypo,
+                    "recorded": recorded,
+                    "response_time": response_time,
+                    "divergence": self.divergence(hypo, recorded),
+                }
+                if k + 1 < trajectory.num_requests:
+                    next_running.append((trajectory, k + 1))
+            running = next_running
+
+    def prepare(self, template):
+        if template is not None and template.get_constraints():
+            template.separate_constraints(self.tgt_lang)
+        return template
+
+    def divergence(self, hypo, recorded):
+        if recorded is None:
+            return None
+        recorded_tokens = self.tokenize(recorded)
+        return utils.edit_distance(self.tokenize(hypo), recorded_tokens) / max(len(recorded_tokens), 1)
+
+def summarize(records):
+    """Latency and divergence of the replayed requests, for the initial
+    translations and the translations of templates."""
+    summary = {}
+    for name, turns in (("initial", lambda turn: turn == 0), ("revised", lambda turn: turn > 0), ("all", lambda turn: True)):
+        selected = [record for record in records if turns(record["turn"])]
+        if not selected:
+            continue
+        latencies = sorted(record["response_time"] for record in selected)
+        divergences = [record["divergence"] for record in selected if record["divergence"] is not None]
+        summary[name] = {
+            "requests": len(selected),
+            "avg_latency": sum(latencies) / len(latencies),
+            "p50_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.5))],
+            "p95_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "recorded": len(divergences),
+            "exact_match": sum(d == 0 for d in divergences) / len(divergences) if divergences else 0,
+            "avg_divergence": sum(divergences) / len(divergences) if divergences else 0,
+        }
+    return summary
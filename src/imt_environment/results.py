@@ -0,0 +1,321 @@
+"""Columnar store of the per-episode results of simulation and human runs.
+
+Each run is a NumPy structured array of one row per episode, saved as
+``<run>.npy`` in the store directory, and a line of ``runs.jsonl`` with its
+metadata: {"system", "policy", "pair", "seed", ...}. The runs are
+concatenated into the columns of ``episodes.columns``, with a run column,
+the first time the store is read after a change, and read back
+memory-mapped, so aggregating thousands of runs only touches the columns
+it needs:
+
+    python -m imt_environment.results aggregate results/ --group-by system policy
+    python -m imt_environment.results aggregate results/ --group-by pair --where system=LecaImt
+    python -m imt_environment.results import results/ human_exps/*/*.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+EPISODE_DTYPE = np.dtype([
+    ("episode", "<i4"),
+    ("success", "<i1"),
+    ("turns", "<i4"),
+    ("editing_cost", "<f4"),
+    ("normalized_editing_cost", "<f4"),
+    # mean of the translated turns
+    ("response_time", "<f4"),
+    ("consistency", "<f4"),
+    ("cached_turns", "<i4"),
+    ("cached_response_time", "<f4"),
+])
+TABLE_DTYPE = np.dtype([("run", "<i4")] + EPISODE_DTYPE.descr)
+
+# the IMT systems of the exports of human experiments, by file name prefix
+HUMAN_EXPORT_SYSTEMS = {
+    "prefix": "PrefixTransformer",
+    "dba": "DBATransformer",
+    "bitiimt": "Bitiimt",
+    "leca": "LecaImt",
+    "chatgpt": "ChatgptImt",
+}
+
+def episode_records(states):
+    """The rows of {index: state} of the episodes of a simulation run."""
+    records = np.zeros(len(states), EPISODE_DTYPE)
+    for row, i in enumerate(sorted(states)):
+        state = states[i]
+        translated_turns = state["turn"] - state["cached_turns"]
+        records[row] = (
+            i,
+            state["success"],
+            state["turn"],
+            state["editing_cost"],
+            state["normalized_editing_cost"],
+            state["response_time"] / translated_turns if translated_turns > 0 else 0,
+            state["consistency"],
+            state["cached_turns"],
+            state["cached_response_time"] / state["cached_turns"] if state["cached_turns"] > 0 else 0,
+        )
+    return records
+
+def human_records(output_stats):
+    """The rows of the sentences of the export of a human experiment. The
+    response time of a sentence is averaged over its turns; the normalized
+    editing cost and the consistency are not recorded (NaN)."""
+    output_stats = [stats for stats in output_stats if stats["id"] != "avg statistics"]
+    records = np.zeros(len(output_stats), EPISODE_DTYPE)
+    for row, stats in enumerate(output_stats):
+        records[row] = (
+            stats["id"],
+            stats["success"],
+            stats["turns"],
+            stats["editing_cost"],
+            np.nan,
+            stats["response_time"] / stats["turns"] if stats["turns"] > 0 else 0,
+            np.nan,
+            0,
+            0,
+        )
+    return records
+
+def run_name(meta):
+    """The file name of a run, the same for the same metadata, so running
+    it again replaces its results."""
+    return hashlib.sha1(json.dumps(meta, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+class ResultsStore():
+    INDEX = "runs.jsonl"
+    TABLE = "episodes.columns"
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, meta, records):
+        name = run_name(meta)
+        tmp_path = os.path.join(self.path, "{}.{}.tmp.npy".format(name, os.getpid()))
+        np.save(tmp_path, records)
+        os.replace(tmp_path, os.path.join(self.path, name + ".npy"))
+        with open(os.path.join(self.path, self.INDEX), "a", encoding="utf-8") as index:
+            index.write(json.dumps({"run": name, "episodes": len(records), **meta}, ensure_ascii=False) + "\n")
+
+    def runs(self):
+        """The metadata of each run, by name; a run written again keeps its
+        first place with the metadata of the last write."""
+        runs = OrderedDict()
+        path = os.path.join(self.path, self.INDEX)
+        if not os.path.exists(path):
+            return runs
+        with open(path, encoding="utf-8") as index:
+            for line in index:
+                if line.endswith("\n"):
+                    meta = json.loads(line)
+                    runs[meta["run"]] = meta
+        return runs
+
+    def table(self):
+        """The metadata of the runs, and the memory-mapped columns of all
+        their episodes, with the position of the run in the first."""
+        table_path = os.path.join(self.path, self.TABLE)
+        index_path = os.path.join(self.path, self.INDEX)
+        if not os.path.exists(index_path):
+            return [], {field: np.zeros(0, dtype) for field, (dtype, _) in TABLE_DTYPE.fields.items()}
+        if not os.path.exists(table_path) or os.stat(table_path).st_mtime_ns < os.stat(index_path).st_mtime_ns:
+            self.build_table()
+        return read_columns(table_path)
+
+    def build_table(self):
+        runs = list(self.runs().values())
+        parts = [np.load(os.path.join(self.path, meta["run"] + ".npy"), mmap_mode="r") for meta in runs]
+        columns = concat_records(parts)
+        table_path = os.path.join(self.path, self.TABLE)
+        tmp_path = "{}.{}.tmp".format(table_path, os.getpid())
+        write_columns(tmp_path, runs, columns)
+        os.replace(tmp_path, table_path)
+
+def concat_records(parts):
+    """The columns of the records of several runs, with the position of
+    the run of each row, as aggregate() takes them."""
+    columns = {"run": np.repeat(np.arange(len(parts), dtype=TABLE_DTYPE["run"]), [len(part) for part in parts])}
+    for field in EPISODE_DTYPE.names:
+        columns[field] = np.concatenate([part[field] for part in parts]) if parts else np.zeros(0, EPISODE_DTYPE[field])
+    return columns
+
+# columns are aligned to this many bytes in a table file
+ALIGNMENT = 64
+
+def write_columns(path, runs, columns):
+    """Writes a table file: the length of its JSON header, the header with
+    the runs and the dtype, offset and length of each column, then the
+    columns, one after the other."""
+    offsets, offset = {}, 0
+    for field, column in columns.items():
+        offsets[field] = [column.dtype.str, offset, len(column)]
+        offset += -(-column.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"runs": runs, "columns": offsets}, ensure_ascii=False).encode("utf-8")
+    data_start = -(-(8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(path, "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for field, column in columns.items():
+            f.seek(data_start + offsets[field][1])
+            f.write(np.ascontiguousarray(column).tobytes())
+        f.truncate(data_start + offset)
+
+def read_columns(path):
+    with open(path, "rb") as f:
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = -(-(8 + header_length) // ALIGNMENT) * ALIGNMENT
+    columns = {}
+    for field, (dtype, offset, length) in header["columns"].items():
+        if length == 0:
+            columns[field] = np.zeros(0, dtype)
+        else:
+            columns[field] = np.memmap(path, dtype=dtype, mode="r", offset=data_start + offset, shape=(length,))
+    return header["runs"], columns
+
+def aggregate(runs, table, group_by, where=None, percentiles=(50, 95)):
+    """The results of the episodes of the runs matching where ({key: value}
+    of their metadata), for each value of the group_by keys, computed as
+    run.py logs them: response times over the episodes with translated
+    turns, consistency per turn after the first."""
+    where = where or {}
+    group_ids = OrderedDict()
+    run_group = np.full(len(runs), -1, dtype=np.int64)
+    run_count = []
+    for r, meta in enumerate(runs):
+        if any(str(meta.get(key)) != value for key, value in where.items()):
+            continue
+        key = tuple(meta.get(k) for k in group_by)
+        if key not in group_ids:
+            group_ids[key] = len(group_ids)
+            run_count.append(0)
+        run_group[r] = group_ids[key]
+        run_count[group_ids[key]] += 1
+    num_groups = len(group_ids)
+    # plain arrays on the memory-mapped columns
+    columns = {field: np.asarray(table[field]) for field in EPISODE_DTYPE.names if field != "episode"}
+    group = run_group[np.asarray(table["run"])]
+    selected = group >= 0
+    if not selected.all():
+        group = group[selected]
+        columns = {field: column[selected] for field, column in columns.items()}
+
+    episodes = np.bincount(group, minlength=num_groups)
+
+    def mean(values, mask=None):
+        if mask is None:
+            total, count = np.bincount(group, values, minlength=num_groups), episodes
+        else:
+            total = np.bincount(group[mask], values[mask], minlength=num_groups)
+            count = np.bincount(group[mask], minlength=num_groups)
+        return np.divide(total, count, out=np.full(num_groups, np.nan), where=count > 0)
+
+    turns = columns["turns"]
+    translated = (turns > columns["cached_turns"]) & ~np.isnan(columns["response_time"])
+    measured = ~np.isnan(columns["consistency"])
+    consistency = np.bincount(group, np.where(measured, columns["consistency"], 0), minlength=num_groups)
+    later_turns = np.bincount(group, np.where(measured, turns - 1, 0), minlength=num_groups)
+    results = {
+        "success_rate": mean(columns["success"]),
+        "avg_turns": mean(turns),
+        "avg_editing_cost": mean(columns["editing_cost"]),
+        "avg_normalized_editing_cost": mean(columns["normalized_editing_cost"], ~np.isnan(columns["normalized_editing_cost"])),
+        "avg_response_time": mean(columns["response_time"], translated),
+        "consistency": np.divide(consistency, later_turns, out=np.full(num_groups, np.nan), where=later_turns > 0),
+    }
+    # the response times of each group are made contiguous
+    response_group = group[translated]
+    order = np.argsort(response_group, kind="stable")
+    response_time = columns["response_time"][translated][order]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(response_group, minlength=num_groups))])
+    group_percentiles = np.full((num_groups, len(percentiles)), np.nan)
+    for g in range(num_groups):
+        if bounds[g + 1] > bounds[g]:
+            group_percentiles[g] = np.percentile(response_time[bounds[g]:bounds[g + 1]], percentiles)
+    for i, p in enumerate(percentiles):
+        results["p{}_response_time".format(p)] = group_percentiles[:, i]
+
+    rows = []
+    for key, g in group_ids.items():
+        row = OrderedDict(zip(group_by, key))
+        row["runs"] = run_count[g]
+        row["episodes"] = int(episodes[g])
+        for name, values in results.items():
+            # None for the groups without the data, e.g. human runs
+            row[name] = float(values[g]) if not np.isnan(values[g]) else None
+        rows.append(row)
+    return rows
+
+def format_table(rows):
+    if not rows:
+        return "no runs"
+    headers = list(rows[0])
+    cells = [[format_cell(row[h]) for h in headers] for row in rows]
+    widths = [max(len(h), *(len(c[i]) for c in cells)) for i, h in enumerate(headers)]
+    lines = ["  ".join(h.rjust(w) for h, w in zip(headers, widths))]
+    lines += ["  ".join(c.rjust(w) for c, w in zip(cell, widths)) for cell in cells]
+    return "\n".join(lines)
+
+def format_cell(value):
+    if isinstance(value, float):
+        return "{:.3f}".format(value)
+    return "-" if value is None else str(value)
+
+def import_human_exports(store, paths):
+    """Adds the exports of the Flask server, named <system>_<pair>.json,
+    with the annotator being the name of their directory."""
+    for path in paths:
+        match = re.fullmatch(r"([a-z]+)_([a-z]+)\.json", os.path.basename(path))
+        if match is None or match.group(1) not in HUMAN_EXPORT_SYSTEMS:
+            print("skip {}".format(path), file=sys.stderr)
+            continue
+        with open(path, encoding="utf-8") as f:
+            output_stats = json.load(f)
+        store.write({
+            "system": HUMAN_EXPORT_SYSTEMS[match.group(1)],
+            "policy": "Human",
+            "pair": match.group(2),
+            "seed": None,
+            "annotator": os.path.basename(os.path.dirname(os.path.abspath(path))),
+        }, human_records(output_stats))
+
+def main():
+    parser = argparse.ArgumentParser(description="per-episode results of runs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    aggregate_parser = subparsers.add_parser("aggregate", help="aggregate the results of the runs of a store")
+    aggregate_parser.add_argument("store", help="directory of the results store")
+    aggregate_parser.add_argument("--group-by", nargs="*", default=["system", "policy", "pair"], help="metadata keys of the groups, e.g. system policy pair seed annotator")
+    aggregate_parser.add_argument("--where", nargs="*", default=[], help="KEY=VALUE conditions on the metadata of the runs")
+    aggregate_parser.add_argument("--percentiles", type=float, nargs="*", default=[50, 95], help="percentiles of the response time")
+    aggregate_parser.add_argument("--json", action="store_true", help="print the groups as JSON")
+    import_parser = subparsers.add_parser("import", help="add exports of human experiments to a store")
+    import_parser.add_argument("store", help="directory of the results store")
+    import_parser.add_argument("exports", nargs="+", help="<system>_<pair>.json exports of the Flask server")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    if args.command == "import":
+        import_human_exports(store, args.exports)
+        return
+    where = dict(condition.split("=", 1) for condition in args.where)
+    start = time.perf_counter()
+    runs, table = store.table()
+    rows = aggregate(runs, table, args.group_by, where, [int(p) if p == int(p) else p for p in args.percentiles])
+    elapsed = time.perf_counter() - start
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print(format_table(rows))
+    print("{} runs, {} episodes in {:.1f}ms".format(len(runs), len(table["run"]), 1000 * elapsed), file=sys.stderr)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,21 +14,52 @@ class Template():
         # hypo = self.revised_hypo.strip().split()
         revised_hypo = self.revised_hypo[5:] if self.revised_hypo.startswith("<bos>") else self.revised_hypo
         assert len(revised_hypo) == len(self.tag), "\nrevised_hypo:{}\ntag: {}".format(revised_hypo, self.tag)
-        hypo = [revised_hypo[i] for i in range(len(self.tag)) if 0 < self.tag[i] < 4]
-        return "".join(hypo).lstrip(" ")
+        return "".join(text for kind, text in self.spans() if kind == "keep").lstrip(" ")
 
     def get_constraints(self):
+        return [text for kind, text in self.spans() if kind == "keep"]
+
+    def spans(self):
+        """The runs of kept (tags 1 to 3) and blank (tag 4) characters, in
+        order, as ("keep", text) and ("blank", ""). Deleted characters are
+        skipped and do not break a run."""
         revised_hypo = self.revised_hypo[5:] if self.revised_hypo.startswith("<bos>") else self.revised_hypo
-        constraints = []
-        constraint = ""
-        for i in range(len(self.tag)):
-            if self.tag[i] == 0:
+        spans = []
+        kept = []
+        for c, t in zip(revised_hypo, self.tag):
+            if t == 0:
                 continue
-            elif self.tag[i] < 4:
-                constraint += revised_hypo[i]
-            elif constraint:
-                constraints.append(constraint)
-                constraint = ""
-        if constraint and self.tag[i] < 4:
-            constraints.append(constraint)
-        return constraints
\ No newline at end of file
+            elif t < 4:
+                kept.append(c)
+            else:
+                if kept:
+                    spans.append(("keep", "".join(kept)))
+                    kept = []
+                if not spans or spans[-1][0] != "blank":
+                    spans.append(("blank", ""))
+        if kept:
+            spans.append(("keep", "".join(kept)))
+        return spans
+
+    def separate_constraints(self, tgt_lang):
+        """Inserts a kept space before a constraint that follows a blank and
+        starts with an alphanumeric character, as the web UI does before
+        sending a template, so that the constraint is not glued to the
+        words filled in before it. Chinese is written without spaces."""
+        append_space = True
+        i = 0
+        while i < len(self.tag):
+            if self.tag[i] == 0:
+                i += 1
+            elif self.tag[i] == 4:
+                append_space = tgt_lang != "zh"
+                i += 1
+            elif append_space:
+                if self.revised_hypo[i].isalnum():
+                    self.revised_hypo = self.revised_hypo[:i] + " " + self.revised_hypo[i:]
+                    self.tag.insert(i, 1)
+                    i += 1
+                append_space = False
+                i += 1
+            else:
+                i += 1
@@ -0,0 +1,131 @@
+"""Per-turn timing traces of Environment, Policy and IMTSystem.
+
+The components time their phases with ``tracer.timer(phase)`` and count
+things with ``tracer.count(name, n)``. Both cost next to nothing unless a
+hook is registered with ``tracer.add_hook``: the environment then builds one
+record per turn, {"system", "policy", "episode", "turn", "total", "phases",
+"counts"}, and passes it to every hook when the turn ends. JsonlSink writes
+the records to a file and Summary aggregates them by system and policy:
+
+    python -m imt_environment.tracing trace.jsonl [trace2.jsonl ...]
+"""
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+from contextlib import nullcontext
+
+NULL_TIMER = nullcontext()
+
+class Timer():
+    def __init__(self, phases, phase) -> None:
+        self.phases = phases
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.phases[self.phase] = self.phases.get(self.phase, 0.) + time.perf_counter() - self.start
+
+class Tracer():
+    def __init__(self) -> None:
+        self.hooks = []
+        self.record = None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def begin_turn(self, **fields):
+        if self.hooks:
+            self.record = {**fields, "phases": {}, "counts": {}}
+            self.start = time.perf_counter()
+
+    def end_turn(self, **fields):
+        record, self.record = self.record, None
+        if record is None:
+            return
+        record["total"] = time.perf_counter() - self.start
+        record.update(fields)
+        for hook in self.hooks:
+            hook(record)
+
+    def discard_turn(self):
+        """Drops the open record, e.g. of a turn that made no request."""
+        self.record = None
+
+    def timer(self, phase):
+        if self.record is None:
+            return NULL_TIMER
+        return Timer(self.record["phases"], phase)
+
+    def count(self, name, n=1):
+        if self.record is not None:
+            counts = self.record["counts"]
+            counts[name] = counts.get(name, 0) + n
+
+tracer = Tracer()
+
+class JsonlSink():
+    def __init__(self, path) -> None:
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, record):
+        # one write per record, so that forked workers can share the file
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class Summary():
+    """Totals of the records for each system and policy."""
+    def __init__(self) -> None:
+        self.groups = OrderedDict()
+
+    def __call__(self, record):
+        group = self.groups.setdefault((record["system"], record["policy"]), {
+            "turns": 0, "total": 0., "phases": OrderedDict(), "counts": OrderedDict(),
+        })
+        group["turns"] += 1
+        group["total"] += record["total"]
+        for phase, elapsed in record["phases"].items():
+            group["phases"][phase] = group["phases"].get(phase, 0.) + elapsed
+        for name, n in record["counts"].items():
+            group["counts"][name] = group["counts"].get(name, 0) + n
+
+    def table(self):
+        """One block per system x policy: the time of each phase, its share
+        of the turns' wall-clock and its mean per turn, then the counts.
+        Phases nest (imt.* within translate, policy.* within the policy
+        calls), so the shares do not add up to 100%."""
+        lines = []
+        for (system, policy), group in self.groups.items():
+            lines.append("{} x {}: {} turns, {:.3f}s".format(system, policy, group["turns"], group["total"]))
+            lines.append("  {:<20} {:>10} {:>8} {:>12}".format("phase", "total(s)", "share", "per turn(ms)"))
+            for phase, elapsed in sorted(group["phases"].items(), key=lambda p: -p[1]):
+                lines.append("  {:<20} {:>10.3f} {:>8.1%} {:>12.2f}".format(
+                    phase, elapsed, elapsed / group["total"] if group["total"] > 0 else 0, 1000 * elapsed / group["turns"],
+                ))
+            for name, n in group["counts"].items():
+                lines.append("  {:<20} {:>10} {:>8} {:>12.1f}".format(name, n, "", n / group["turns"]))
+        return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="summarize per-turn traces by system and policy")
+    parser.add_argument("traces", nargs="+", help="trace files written with --trace")
+    args = parser.parse_args()
+    summary = Summary()
+    for path in args.traces:
+        with open(path, encoding="utf-8") as trace:
+            for line in trace:
+                summary(json.loads(line))
+    print(summary.table())
+
+if __name__ == "__main__":
+    sys.exit(main())
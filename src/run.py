@@ -3,7 +3,11 @@ import logging
 import os
 import sys
 import json
+import glob
+import datetime
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
@@ -13,13 +17,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger("run")
 
-from imt_environment.environment import Environment
+from imt_environment.environment import Environment, BatchEnvironment
+from imt_environment.journal import EpisodeJournal, load_journals
+from imt_environment.tracing import tracer, JsonlSink, Summary
+from imt_environment.replay import Replay, load_trajectories, summarize
+from imt_environment.results import ResultsStore, episode_records
 from imt_environment.imt_system import (
     PrefixTransformer,
     DBATransformer,
     Bitiimt,
     LecaImt,
     ChatgptImt,
+    TranslationCache,
+    CachedImt,
 )
 from imt_environment.policy import (
     MtpePolicy,
@@ -40,11 +50,36 @@ if __name__ == "__main__":
     parser.add_argument("--policy-spm-model", type=str, default=None, help="path of spm model used by policy")
     parser.add_argument("--policy-seed", type=int, default=1, help="random seed for policy")
     parser.add_argument("--export-path", type=str, default=None, help="the export path when using real env")
+    parser.add_argument("--results-dir", type=str, default=None, help="directory of a columnar store the per-episode results of the run are written to, see imt_environment.results")
 
     parser.add_argument("--policy", default=0, type=int, required=True, help="the type of policy")
     parser.add_argument("--imt", default=0, type=int, required=True, help="the type of imt system")
+    parser.add_argument("--replay-path", default=None, type=str, help="exported human experiment replayed by policy type 6")
     parser.add_argument("--imt-args", default=None, type=str, help="the path of imt's args")
-    parser.add_argument("--checkpoint", default=None, type=str, help="the path of the checkpoint")
+    parser.add_argument("--checkpoint", default=None, type=str, help="the path of the episode journal, finished episodes are skipped when resuming")
+    parser.add_argument("--checkpoint-fsync-every", default=16, type=int, help="sync the episode journal to disk every this many episodes")
+    parser.add_argument("--checkpoint-turns", action="store_true", help="record the hypothesis and response time of every turn in the episode journal")
+    parser.add_argument("--trace", default=None, type=str, help="append per-turn phase timings and counts to this jsonl file, and log where the time goes at the end")
+    parser.add_argument("--batch-episodes", default=1, type=int, help="number of episodes run in lockstep, whose requests are translated as one batch")
+    parser.add_argument("--per-episode-seed", action="store_true", help="reseed the policy with policy-seed + sentence index at each episode (implied by --batch-episodes > 1 or sharded evaluation)")
+    parser.add_argument("--num-workers", default=1, type=int, help="number of worker processes on this node, each loads its own imt system")
+    parser.add_argument("--nnodes", default=1, type=int, help="number of nodes for sharded evaluation")
+    parser.add_argument("--node-rank", default=0, type=int, help="rank of this node for sharded evaluation")
+    parser.add_argument("--master-addr", default="127.0.0.1", type=str, help="address of the node with rank 0")
+    parser.add_argument("--master-port", default=29500, type=int, help="port of the work queue on the node with rank 0")
+    parser.add_argument("--num-threads", default=None, type=int, help="torch intra-op threads of each worker")
+    parser.add_argument("--translation-cache", default=None, type=str, help="path of an on-disk cache of translations shared by runs")
+    parser.add_argument("--translation-cache-size", default=1024, type=int, help="maximum size of the translation cache in MB")
+    parser.add_argument("--chatgpt-api-base", default=None, type=str, help="base url of an OpenAI-compatible api for the chatgpt imt system")
+    parser.add_argument("--chatgpt-concurrency", default=16, type=int, help="maximum number of chatgpt requests in flight")
+    parser.add_argument("--chatgpt-rpm", default=3500, type=int, help="chatgpt requests per minute limit")
+    parser.add_argument("--chatgpt-tpm", default=90000, type=int, help="chatgpt tokens per minute limit")
+    parser.add_argument("--chatgpt-max-retries", default=6, type=int, help="retries of a failed chatgpt request")
+    parser.add_argument("--server-batch-size", default=8, type=int, help="maximum number of translation requests of the annotators translated as one batch by the human evaluation server")
+    parser.add_argument("--server-batch-wait", default=10, type=float, help="milliseconds the server waits for more requests to batch with the first one")
+    parser.add_argument("--server-max-queue-wait", default=None, type=float, help="seconds a translation request may wait for the model before the server rejects it")
+    parser.add_argument("--server-secret-key-file", default=None, type=str, help="file of the key signing the annotators' session cookies, created if missing (default: next to --checkpoint or --export-path)")
+    parser.add_argument("--server-prefetch", default=2, type=int, help="number of sentences after the current one whose initial translation the server computes in the background")
 
     args = parser.parse_args()
     logger.info("Parameters: {}".format(args))
@@ -56,16 +91,34 @@ if args.imt_args is not None:
         imt_args = json.load(iarg)
 else:
     imt_args = args
-if imt_type == 0:
-    imt_system = PrefixTransformer(imt_args)
-elif imt_type == 1:
-    imt_system = DBATransformer(imt_args)
-elif imt_type == 2:
-    imt_system = Bitiimt(imt_args)
-elif imt_type == 3:
-    imt_system = LecaImt(imt_args)
-elif imt_type == 4:
-    imt_system = ChatgptImt(imt_args)
+def build_imt_system():
+    if imt_type == 0:
+        imt_system = PrefixTransformer(imt_args)
+    elif imt_type == 1:
+        imt_system = DBATransformer(imt_args)
+    elif imt_type == 2:
+        imt_system = Bitiimt(imt_args)
+    elif imt_type == 3:
+        imt_system = LecaImt(imt_args)
+    elif imt_type == 4:
+        imt_system = ChatgptImt(imt_args)
+    if args.translation_cache is not None:
+        cache = TranslationCache(args.translation_cache, args.translation_cache_size << 20)
+        imt_system = CachedImt(imt_system, cache)
+    return imt_system
+
+sharded = args.num_workers > 1 or args.nnodes > 1
+if sharded:
+    # episodes run on whichever worker is free, so each one needs its own seed
+    args.per_episode_seed = True
+if args.num_threads is not None:
+    # inherited by the forked workers
+    torch.set_num_threads(args.num_threads)
+
+if args.trace is not None:
+    trace_summary = Summary()
+    tracer.add_hook(trace_summary)
+    tracer.add_hook(JsonlSink(args.trace))
 
 # Initialize policy tokenizer
 if args.policy_spm_model is not None:
@@ -75,18 +128,22 @@ else:
 
 # Initialize policy
 policy_type = args.policy
-if policy_type == 0:
-    policy = MtpePolicy(tokenizer)
-elif policy_type == 1:
-    policy = Left2RightPolicy(tokenizer, n=1)
-elif policy_type == 2:
-    policy = RandomPolicy(tokenizer, args.policy_seed)
-elif policy_type == 3:
-    policy = Left2RightInfillingPolicy(tokenizer)
-elif policy_type == 4:
-    policy = RandomInfillingPolicy(tokenizer, args.policy_seed)
-elif policy_type == 5:
-    pass # human policy
+def build_policy(seed):
+    if policy_type == 0:
+        return MtpePolicy(tokenizer)
+    elif policy_type == 1:
+        return Left2RightPolicy(tokenizer, n=1)
+    elif policy_type == 2:
+        return RandomPolicy(tokenizer, seed)
+    elif policy_type == 3:
+        return Left2RightInfillingPolicy(tokenizer)
+    elif policy_type == 4:
+        return RandomInfillingPolicy(tokenizer, seed)
+    elif policy_type == 5:
+        return None # human policy
+    elif policy_type == 6:
+        return None # replay of a human experiment
+policy = build_policy(args.policy_seed)
 
 if args.checkpoint is not None:
     dir = os.path.dirname(args.checkpoint)
@@ -97,69 +154,194 @@ if args.export_path is not None:
     if not os.path.exists(dir):
         os.makedirs(dir)
 
-def run_interaction():
-    success = []
-    turns = []
-    avg_editing_cost = []
-    normalized_editing_cost = []
-    response_time = []
-    consistency = []
-    num = 0
-    if args.checkpoint is not None and os.path.exists(args.checkpoint):
-        state_dict = torch.load(args.checkpoint)
-        num = state_dict["num"]
-        success = state_dict["success"]
-        turns = state_dict["turns"]
-        avg_editing_cost = state_dict["avg_editing_cost"]
-        normalized_editing_cost = state_dict["normalized_editing_cost"]
-        response_time = state_dict["response_time"]
-        consistency = state_dict["consistency"]
+RESULT_KEYS = ["success", "turns", "avg_editing_cost", "normalized_editing_cost", "response_time", "consistency", "cached_turns", "cached_response_time"]
+
+def load_checkpoint():
+    """Returns {index: state} of the episodes finished by earlier runs, from
+    the journal of a sequential run and those of the workers of sharded ones."""
+    if args.checkpoint is None:
+        return {}
+    return load_journals([args.checkpoint] + sorted(glob.glob(glob.escape(args.checkpoint) + ".worker*")))
+
+def open_checkpoint(rank=None):
+    if args.checkpoint is None:
+        return None
+    path = args.checkpoint if rank is None else "{}.worker{}".format(args.checkpoint, rank)
+    return EpisodeJournal(path, args.checkpoint_fsync_every)
 
+def load_testset():
     with open(args.src_path, "r") as src, open(args.tgt_path, "r") as tgt:
-        for i, (src_sentence, tgt_sentence) in enumerate(zip(src, tgt)):
-            if i < num:
-                continue
-            logger.info("test case {}".format(i))
-            env.initialize_episode(src_sentence, tgt_sentence)
-            episode_over = False
-            
-            while not episode_over:
-                episode_over, state = env.next_turn()
-            success.append(int(state["success"]))
-            turns.append(state["turn"])
-            avg_editing_cost.append(state["editing_cost"])
-            normalized_editing_cost.append(state["normalized_editing_cost"])
-            response_time.append(state["response_time"] / state["turn"])
-            consistency.append(state["consistency"])
-            if args.checkpoint is not None and (i + 1) % 2 == 0:
-                torch.save({
-                    "num": i + 1,
-                    "success": success,
-                    "turns": turns,
-                    "avg_editing_cost": avg_editing_cost,
-                    "normalized_editing_cost": normalized_editing_cost,
-                    "response_time": response_time,
-                    "consistency": consistency
-                }, args.checkpoint)
-
-    num = i + 1
-    logger.info("success rate: {:.3f} | avg turns: {:.2f} | avg editing cost: {:.2f} ({:.2%}) | avg responding time: {:.3f} | avg consistency: {:.2f}".format(
-        sum(success) / num,
+        return list(zip(src, tgt))
+
+def append_result(results, state):
+    results["success"].append(int(state["success"]))
+    results["turns"].append(state["turn"])
+    results["avg_editing_cost"].append(state["editing_cost"])
+    results["normalized_editing_cost"].append(state["normalized_editing_cost"])
+    translated_turns = state["turn"] - state["cached_turns"]
+    results["response_time"].append(state["response_time"] / translated_turns if translated_turns > 0 else 0)
+    results["consistency"].append(state["consistency"])
+    results["cached_turns"].append(state["cached_turns"])
+    results["cached_response_time"].append(state["cached_response_time"] / state["cached_turns"] if state["cached_turns"] > 0 else 0)
+
+def collect_results(states):
+    results = {key: [] for key in RESULT_KEYS}
+    for i in sorted(states):
+        append_result(results, states[i])
+    return results
+
+def log_summary(results, num):
+    turns = results["turns"]
+    cached_turns = results["cached_turns"]
+    # response times are averaged over the episodes with turns of each kind
+    translated = sum(1 for t, c in zip(turns, cached_turns) if t > c)
+    cached = sum(1 for c in cached_turns if c > 0)
+    summary = "success rate: {:.3f} | avg turns: {:.2f} | avg editing cost: {:.2f} ({:.2%}) | avg responding time: {:.3f} | avg consistency: {:.2f}".format(
+        sum(results["success"]) / num,
         sum(turns) / num,
-        sum(avg_editing_cost) / num,
-        sum(normalized_editing_cost) / num,
-        sum(response_time) / num,
-        sum(consistency) / sum(t - 1 for t in turns) if sum(t - 1 for t in turns) > 0 else 0
-    ))
+        sum(results["avg_editing_cost"]) / num,
+        sum(results["normalized_editing_cost"]) / num,
+        sum(results["response_time"]) / translated if translated > 0 else 0,
+        sum(results["consistency"]) / sum(t - 1 for t in turns) if sum(t - 1 for t in turns) > 0 else 0
+    )
+    if args.translation_cache is not None:
+        summary += " | cache hits: {} | cache misses: {} | avg cached responding time: {:.4f}".format(
+            sum(cached_turns),
+            sum(turns) - sum(cached_turns),
+            sum(results["cached_response_time"]) / cached if cached > 0 else 0,
+        )
+    logger.info(summary)
+
+def run_meta():
+    """The metadata of the run in the results store."""
+    return {
+        "system": imt_system.name,
+        "config": os.path.splitext(os.path.basename(args.imt_args))[0] if args.imt_args is not None else None,
+        "policy": type(policy).__name__ if policy is not None else "Human",
+        "pair": args.src_lang + args.tgt_lang,
+        "testset": os.path.basename(os.path.dirname(os.path.abspath(args.src_path))),
+        "seed": args.policy_seed,
+    }
+
+def save_results(states):
+    if args.results_dir is not None:
+        ResultsStore(args.results_dir).write(run_meta(), episode_records(states))
+
+def run_episodes(episodes, journal):
+    """Runs the episodes, recording each one in the journal as it ends."""
+    if args.batch_episodes > 1:
+        batch_env = BatchEnvironment(imt_system, lambda i: build_policy(args.policy_seed + i), args.batch_episodes, args.checkpoint_turns)
+        finished = batch_env.run(episodes)
+    else:
+        finished = run_sequential(episodes)
+    for i, state in finished:
+        if journal is not None:
+            journal.append(i, state)
+        yield i, state
+    if journal is not None:
+        journal.close()
+
+def run_interaction():
+    states = load_checkpoint()
+    testset = load_testset()
+    episodes = ((i, src_sentence, tgt_sentence) for i, (src_sentence, tgt_sentence) in enumerate(testset) if i not in states)
+    states.update(run_episodes(episodes, open_checkpoint()))
+    log_summary(collect_results(states), len(testset))
+    save_results(states)
+    if args.trace is not None:
+        logger.info("time per phase:\n{}".format(trace_summary.table()))
+
+# workers finish at different times, the others wait for the slowest one
+DIST_TIMEOUT = datetime.timedelta(hours=24)
+
+def shared_queue(store, testset, order):
+    """Yields the episodes of order, taking the next position from a counter
+    shared by all workers, so a worker only takes new work when it is free."""
+    while True:
+        k = store.add("next_episode", 1) - 1
+        if k >= len(order):
+            return
+        i = order[k]
+        yield i, testset[i][0], testset[i][1]
+
+def run_worker(local_rank):
+    global imt_system, env
+    rank = args.node_rank * args.num_workers + local_rank
+    world_size = args.nnodes * args.num_workers
+    store = dist.TCPStore(args.master_addr, args.master_port, world_size, rank == 0, timeout=DIST_TIMEOUT)
+    dist.init_process_group("gloo", store=store, rank=rank, world_size=world_size, timeout=DIST_TIMEOUT)
+
+    imt_system = build_imt_system()
+    env = Environment(imt_system, policy, args.checkpoint_turns)
+    finished = load_checkpoint()
+    testset = load_testset()
+    # the most expensive episodes first, so that no worker ends with a long one
+    order = sorted((i for i in range(len(testset)) if i not in finished), key=lambda i: len(testset[i][0]), reverse=True)
+    states = list(run_episodes(shared_queue(store, testset, order), open_checkpoint(rank)))
+    logger.info("worker {} finished {} episodes".format(rank, len(states)))
+
+    all_states = [None] * world_size if rank == 0 else None
+    dist.gather_object(states, all_states, dst=0)
+    if rank == 0:
+        for worker_states in all_states:
+            finished.update(worker_states)
+        log_summary(collect_results(finished), len(testset))
+        save_results(finished)
+    if args.trace is not None:
+        logger.info("time per phase of worker {}:\n{}".format(rank, trace_summary.table()))
+    # rank 0 serves the store, so it must not exit before the others are done with it
+    dist.barrier()
+
+def run_sequential(episodes):
+    for i, src_sentence, tgt_sentence in episodes:
+        logger.info("test case {}".format(i))
+        if args.per_episode_seed:
+            env.policy = build_policy(args.policy_seed + i)
+        env.initialize_episode(src_sentence, tgt_sentence, i)
+        episode_over = False
+        
+        while not episode_over:
+            episode_over, state = env.next_turn()
+        yield i, state
+
+def run_replay():
+    with open(args.src_path, "r") as src:
+        srcs = src.readlines()
+    trajectories = load_trajectories(args.replay_path, srcs)
+    replay = Replay(imt_system, args.tgt_lang, args.batch_episodes)
+    records = list(replay.run(trajectories))
+    if args.export_path is not None:
+        with open(args.export_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    for name, summary in summarize(records).items():
+        logger.info("{} | requests: {} | avg responding time: {:.3f} | p50: {:.3f} | p95: {:.3f} | exact match: {:.2%} | avg divergence: {:.2%} (of {} recorded)".format(
+            name, summary["requests"], summary["avg_latency"], summary["p50_latency"], summary["p95_latency"],
+            summary["exact_match"], summary["avg_divergence"], summary["recorded"],
+        ))
+    if args.trace is not None:
+        logger.info("time per phase:\n{}".format(trace_summary.table()))
 
-if policy_type != 5:
+if policy_type == 6:
+    imt_system = build_imt_system()
+    run_replay()
+elif policy_type != 5 and sharded:
+    # fork before any model is loaded, every worker loads its own imt system
+    if args.num_workers > 1:
+        mp.start_processes(run_worker, nprocs=args.num_workers, start_method="fork")
+    else:
+        run_worker(0)
+elif policy_type != 5:
     # Initialize environment
-    env = Environment(imt_system, policy)
+    imt_system = build_imt_system()
+    env = Environment(imt_system, policy, args.checkpoint_turns)
     run_interaction()
 elif policy_type == 5:
+    imt_system = build_imt_system()
     with open(args.src_path, "r") as src:
         testset = src.readlines()
     testset = [s.strip() for s in testset]
     from imt_environment.real_environment import create_app
     app = create_app(args, imt_system, testset)
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    # each annotator's requests are handled in a thread of their own
+    app.run(host="0.0.0.0", port=5000, threaded=True)
\ No newline at end of file
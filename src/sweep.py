@@ -0,0 +1,235 @@
+"""Runs grids of IMT systems x policies x seeds, loading each IMT system
+once for all the policies and seeds of its grid. The grid spec is a JSON
+list of grids:
+
+    [{
+        "name": "wmt14-ende",
+        "src_path": "../data/wmt14-ende/test.en", "tgt_path": "../data/wmt14-ende/test.de",
+        "src_lang": "en", "tgt_lang": "de",
+        "configs": ["../config/*_wmt14ende.json"],
+        "policies": [0, 1, 2, 3, 4],
+        "seeds": [1, 2, 3]
+    }]
+
+    python sweep.py grids.json --workers 4 --batch-episodes 8 --results-dir ../results
+
+The IMT system of a config is the one of its file name prefix (prefix, dba,
+bitiimt or leca), or given as {"imt": "leca", "path": "..."} in configs. Its episodes are split in chunks of --chunk-size, run by
+--workers processes forked after the model is loaded, so they share its
+weights; the next system is only loaded once they are done. The requests go
+through a translation cache shared by the workers, so the turn-0
+translations of a sentence are only computed once per system. Policies
+without randomness only run with the first seed, and every episode reseeds
+its policy with seed + sentence index, as with --per-episode-seed. One table
+of the results of each system x policy x seed is printed per grid.
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+
+logging.basicConfig(
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=os.environ.get("LOGLEVEL", "INFO").upper(),
+    stream=sys.stdout,
+)
+logger = logging.getLogger("sweep")
+
+from imt_environment.environment import Environment, BatchEnvironment
+from imt_environment.results import ResultsStore, episode_records, concat_records, aggregate, format_table
+from imt_environment.imt_system import (
+    PrefixTransformer,
+    DBATransformer,
+    Bitiimt,
+    LecaImt,
+    TranslationCache,
+    CachedImt,
+)
+from imt_environment.policy import (
+    MtpePolicy,
+    Left2RightPolicy,
+    RandomPolicy,
+    Left2RightInfillingPolicy,
+    RandomInfillingPolicy,
+    utils,
+)
+
+IMT_SYSTEMS = {
+    "prefix": PrefixTransformer,
+    "dba": DBATransformer,
+    "bitiimt": Bitiimt,
+    "leca": LecaImt,
+}
+# the policy types of run.py whose episodes depend on the seed
+SEEDED_POLICIES = {2, 4}
+
+def build_policy(policy_type, tokenizer, seed):
+    if policy_type == 0:
+        return MtpePolicy(tokenizer)
+    elif policy_type == 1:
+        return Left2RightPolicy(tokenizer, n=1)
+    elif policy_type == 2:
+        return RandomPolicy(tokenizer, seed)
+    elif policy_type == 3:
+        return Left2RightInfillingPolicy(tokenizer)
+    elif policy_type == 4:
+        return RandomInfillingPolicy(tokenizer, seed)
+    raise ValueError("policy type {} cannot be swept".format(policy_type))
+
+def grid_configs(grid):
+    """The sorted (IMT system name, config path) of the configs of a grid."""
+    configs = []
+    for config in grid["configs"]:
+        if isinstance(config, dict):
+            configs.append((config["imt"], config["path"]))
+            continue
+        for path in glob.glob(config):
+            configs.append((os.path.basename(path).split("_")[0], path))
+    for name, path in configs:
+        if name not in IMT_SYSTEMS:
+            raise ValueError("no IMT system for config {}".format(path))
+    if not configs:
+        raise ValueError("no config matches {}".format(grid["configs"]))
+    return sorted(configs, key=lambda config: config[1])
+
+# the state shared with the forked workers
+sweep = {}
+
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+    # sqlite connections do not survive a fork, each worker opens its own
+    cache = TranslationCache(sweep["cache_path"], sweep["cache_bytes"])
+    sweep["worker_system"] = CachedImt(sweep["imt_system"], cache)
+    # the episodes are logged by the sweep, not one by one
+    logging.getLogger("environment").setLevel(logging.WARNING)
+
+def run_job(job):
+    """Runs the episodes of a chunk with a policy and seed, returns their
+    (index, state)."""
+    policy_type, seed, indices = job
+    testset, tokenizer = sweep["testset"], sweep["tokenizer"]
+    episodes = [(i, testset[i][0], testset[i][1]) for i in indices]
+    imt_system = sweep["worker_system"]
+    if sweep["batch_episodes"] > 1:
+        batch_env = BatchEnvironment(imt_system, lambda i: build_policy(policy_type, tokenizer, seed + i), sweep["batch_episodes"])
+        states = list(batch_env.run(episodes))
+    else:
+        states = []
+        env = Environment(imt_system, None)
+        for i, src, tgt in episodes:
+            env.policy = build_policy(policy_type, tokenizer, seed + i)
+            env.initialize_episode(src, tgt, i)
+            episode_over = False
+            while not episode_over:
+                episode_over, state = env.next_turn()
+            states.append((i, state))
+    return policy_type, seed, states
+
+def run_system(name, config, jobs, args):
+    """Loads the IMT system of config and runs the jobs on it. Returns
+    {(policy type, seed): {index: state}}."""
+    with open(config) as iarg:
+        imt_args = json.load(iarg)
+    start = time.time()
+    sweep["imt_system"] = IMT_SYSTEMS[name](imt_args)
+    logger.info("{} loaded in {:.1f}s".format(config, time.time() - start))
+    states = {}
+    num_threads = max(1, args.num_threads or torch.get_num_threads() // args.workers)
+    start = time.time()
+    if args.workers > 1:
+        # forked after the model is loaded, so the workers share its weights
+        with multiprocessing.get_context("fork").Pool(args.workers, init_worker, (num_threads,)) as pool:
+            for policy_type, seed, job_states in pool.imap_unordered(run_job, jobs):
+                states.setdefault((policy_type, seed), {}).update(job_states)
+    else:
+        init_worker(num_threads)
+        for policy_type, seed, job_states in map(run_job, jobs):
+            states.setdefault((policy_type, seed), {}).update(job_states)
+    logger.info("{}: {} episodes in {:.1f}s".format(config, sum(len(s) for s in states.values()), time.time() - start))
+    # the next system is loaded only once this one is freed
+    sweep.pop("worker_system", None)
+    del sweep["imt_system"]
+    return states
+
+def run_grid(grid, args):
+    with open(grid["src_path"]) as src, open(grid["tgt_path"]) as tgt:
+        testset = list(zip(src, tgt))
+    if grid.get("num") is not None:
+        testset = testset[:grid["num"]]
+    configs = grid_configs(grid)
+    spm_model = grid.get("policy_spm_model")
+    sweep["testset"] = testset
+    sweep["tokenizer"] = utils.SentencePieceTokenizer(spm_model) if spm_model is not None else utils.SpaceTokenizer()
+    sweep["batch_episodes"] = args.batch_episodes
+
+    combinations = [(policy_type, seed) for policy_type in grid["policies"] for seed in grid["seeds"]
+                    if policy_type in SEEDED_POLICIES or seed == grid["seeds"][0]]
+    # all the combinations of a chunk of sentences before the next chunk, so
+    # the turn-0 translations of the first one are cached for the others
+    chunks = [list(range(i, min(i + args.chunk_size, len(testset)))) for i in range(0, len(testset), args.chunk_size)]
+    jobs = [(policy_type, seed, chunk) for chunk in chunks for policy_type, seed in combinations]
+    store = ResultsStore(args.results_dir) if args.results_dir is not None else None
+    runs, parts = [], []
+    for name, config in configs:
+        states = run_system(name, config, jobs, args)
+        for policy_type, seed in combinations:
+            meta = {
+                "system": IMT_SYSTEMS[name].__name__,
+                "config": os.path.splitext(os.path.basename(config))[0],
+                "policy": type(build_policy(policy_type, sweep["tokenizer"], seed)).__name__,
+                "pair": grid["src_lang"] + grid["tgt_lang"],
+                "testset": os.path.basename(os.path.dirname(os.path.abspath(grid["src_path"]))),
+                "seed": seed,
+            }
+            records = episode_records(states[policy_type, seed])
+            runs.append(meta)
+            parts.append(records)
+            if store is not None:
+                store.write(meta, records)
+    return aggregate(runs, concat_records(parts), ["system", "policy", "seed"])
+
+def main():
+    parser = argparse.ArgumentParser(description="run grids of IMT systems x policies x seeds")
+    parser.add_argument("grids", type=str, help="JSON file of the grids")
+    parser.add_argument("--workers", default=1, type=int, help="number of processes running the episodes of a system")
+    parser.add_argument("--num-threads", default=None, type=int, help="torch intra-op threads of each worker (default: the cores divided among the workers)")
+    parser.add_argument("--batch-episodes", default=1, type=int, help="number of episodes a worker runs in lockstep, whose requests are translated as one batch")
+    parser.add_argument("--chunk-size", default=16, type=int, help="number of sentences of a job of a worker")
+    parser.add_argument("--translation-cache", default=None, type=str, help="path of the translation cache shared by the workers (default: a temporary one)")
+    parser.add_argument("--translation-cache-size", default=1024, type=int, help="maximum size of the translation cache in MB")
+    parser.add_argument("--results-dir", default=None, type=str, help="results store the per-episode results of every run are written to")
+    parser.add_argument("--output", default=None, type=str, help="write the table of each grid as JSON to this file")
+    args = parser.parse_args()
+
+    with open(args.grids) as f:
+        grids = json.load(f)
+    tmp_dir = None
+    if args.translation_cache is None:
+        tmp_dir = tempfile.mkdtemp(prefix="sweep")
+        args.translation_cache = os.path.join(tmp_dir, "translations.sqlite")
+    sweep["cache_path"] = args.translation_cache
+    sweep["cache_bytes"] = args.translation_cache_size << 20
+    tables = {}
+    try:
+        for k, grid in enumerate(grids):
+            name = grid.get("name", str(k))
+            tables[name] = run_grid(grid, args)
+            print("{}:\n{}".format(name, format_table(tables[name])), flush=True)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(tables, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import logging
+
+import pytest
+
+from imt_environment.environment import Environment, logger
+from imt_environment.imt_system import IMTSystem, TranslationCache, CachedImt
+from imt_environment.policy import MtpePolicy, utils
+
+class EchoImt(IMTSystem):
+    """Skips IMTSystem.__init__, as ChatgptImt does, and translates every
+    request to the same hypothesis."""
+    def __init__(self, hypo) -> None:
+        self.hypo = hypo
+
+    def translate(self, src, template=None):
+        return self.hypo
+
+    def cache_signature(self):
+        return {"hypo": self.hypo}
+
+@pytest.fixture
+def debug_logging():
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    yield
+    logger.setLevel(level)
+
+def run_episode(imt_system):
+    env = Environment(imt_system, MtpePolicy(utils.SpaceTokenizer()))
+    env.initialize_episode("ein kleiner Test\n", "a small test\n", 0)
+    episode_over = False
+    while not episode_over:
+        episode_over, state = env.next_turn()
+    return state
+
+def test_episode_of_system_without_base_init(debug_logging):
+    assert EchoImt("a small test").cache_info() == {}
+    state = run_episode(EchoImt("a small test"))
+    assert state["success"]
+    assert state["turn"] == 1
+
+def test_episode_of_cached_system_without_base_init(debug_logging, tmp_path):
+    imt_system = CachedImt(EchoImt("a little test"), TranslationCache(str(tmp_path / "cache.sqlite")))
+    state = run_episode(imt_system)
+    assert state["turn"] == 1
+    assert state["editing_cost"] > 0
+    assert imt_system.cache_info()["translation"]["misses"] == 1
@@ -290,17 +290,29 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         if encoder_out is not None and len(encoder_out["encoder_padding_mask"]) > 0:
             padding_mask = encoder_out["encoder_padding_mask"][0]
 
+        # an incremental state given several tokens beyond the ones it holds
+        # is extended with all of them in one pass, e.g. with a forced prefix
+        cached_len = slen - 1
+        if incremental_state is not None:
+            if not self.cross_self_attention:
+                cached_len = self.incremental_state_len(incremental_state)
+            elif len(incremental_state) == 0:
+                cached_len = 0
+        priming = incremental_state is not None and slen - cached_len > 1
+
         # embed positions
         positions = None
         if self.embed_positions is not None:
             positions = self.embed_positions(
-                prev_output_tokens, incremental_state=incremental_state
+                prev_output_tokens,
+                incremental_state=incremental_state if not priming else None,
             )
 
         if incremental_state is not None:
-            prev_output_tokens = prev_output_tokens[:, -1:]
+            start = cached_len if priming else slen - 1
+            prev_output_tokens = prev_output_tokens[:, start:]
             if positions is not None:
-                positions = positions[:, -1:]
+                positions = positions[:, -(slen - start) :]
 
         # Prevent torchscript exporting issue for dynamic quant embedding
         prev_output_tokens = prev_output_tokens.contiguous()
@@ -334,6 +346,10 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         for idx, layer in enumerate(self.layers):
             if incremental_state is None and not full_context_alignment:
                 self_attn_mask = self.buffered_future_mask(x)
+            elif priming:
+                self_attn_mask = self.buffered_future_mask(x.new_zeros(slen))[
+                    cached_len:
+                ]
             else:
                 self_attn_mask = None
 
@@ -397,6 +413,36 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         self._future_mask = self._future_mask.to(tensor)
         return self._future_mask[:dim, :dim]
 
+    def incremental_state_len(
+        self, incremental_state: Dict[str, Dict[str, Optional[Tensor]]]
+    ) -> int:
+        """Number of target positions held in *incremental_state*."""
+        length = 0
+        for idx, layer in enumerate(self.layers):
+            if idx == 0:
+                prev_key = layer.self_attn._get_input_buffer(incremental_state).get(
+                    "prev_key"
+                )
+                if prev_key is not None:
+                    length = prev_key.size(2)
+        return length
+
+    def truncate_incremental_state(
+        self, incremental_state: Dict[str, Dict[str, Optional[Tensor]]], length: int
+    ):
+        """Drop the target positions from *length* on in *incremental_state*,
+        so that decoding can resume from there."""
+        for layer in self.layers:
+            input_buffer = layer.self_attn._get_input_buffer(incremental_state)
+            for k in input_buffer.keys():
+                input_buffer_k = input_buffer[k]
+                if input_buffer_k is not None:
+                    if k == "prev_key_padding_mask":
+                        input_buffer[k] = input_buffer_k[:, :length]
+                    else:
+                        input_buffer[k] = input_buffer_k[:, :, :length]
+            layer.self_attn._set_input_buffer(incremental_state, input_buffer)
+
     def upgrade_state_dict_named(self, state_dict, name):
         """Upgrade a (possibly old) state dict for new versions of fairseq."""
         if isinstance(self.embed_positions, SinusoidalPositionalEmbedding):
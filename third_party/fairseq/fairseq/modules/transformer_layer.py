@@ -136,6 +136,33 @@ class TransformerEncoderLayerBase(nn.Module):
             elif len(self.torch_version) == 4:
                 if self.int_version >= 1130:
                     self.BT_version = True
+        # torch>=2.0 needs the type of the mask passed to the BT kernel
+        self.BT_mask_type = "fb" in torch.__version__ or self.int_version >= 2000
+
+    @torch.jit.unused
+    def _BT_forward_with_mask_type(self, x, mask, mask_type: int):
+        return torch._transformer_encoder_layer_fwd(
+            x,
+            self.embed_dim,
+            self.num_heads,
+            self.in_proj_weight,
+            self.in_proj_bias,
+            self.out_proj_weight,
+            self.out_proj_bias,
+            self.activation_relu_or_gelu == 2,
+            False,  # norm_first, currently not supported
+            self.self_attn_layer_norm.eps,
+            self.self_attn_layer_norm.weight,
+            self.self_attn_layer_norm.bias,
+            self.final_layer_norm.weight,
+            self.final_layer_norm.bias,
+            self.fc1_weight,
+            self.fc1_bias,
+            self.fc2_weight,
+            self.fc2_bias,
+            mask,
+            mask_type,
+        )
 
     def _load_from_state_dict(
         self,
@@ -316,6 +343,12 @@ class TransformerEncoderLayerBase(nn.Module):
             and not self.cfg_checkpoint_activations
         ):
             # assume is Batch first and nested tensor
+            mask = encoder_padding_mask if encoder_padding_mask is not None else attn_mask
+            if self.BT_mask_type and mask is not None:
+                # 1: key padding mask of shape (batch, seq_len), 0: attention mask
+                return self._BT_forward_with_mask_type(
+                    x, mask, 1 if encoder_padding_mask is not None else 0
+                )
             output = torch._transformer_encoder_layer_fwd(
                 x,
                 self.embed_dim,
@@ -335,7 +368,7 @@ class TransformerEncoderLayerBase(nn.Module):
                 self.fc1_bias,
                 self.fc2_weight,
                 self.fc2_bias,
-                encoder_padding_mask if encoder_padding_mask is not None else attn_mask,
+                mask,
             )
             return output
 
@@ -6,12 +6,12 @@
 import math
 from typing import List, Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
 from fairseq.token_generation_constraints import (
+    ConstraintAutomaton,
     ConstraintState,
-    OrderedConstraintState,
-    UnorderedConstraintState,
 )
 from torch import Tensor
 
@@ -223,7 +223,8 @@ class LexicallyConstrainedBeamSearch(Search):
     This is accomplished by maintaining, for each beam hypothesis, a
     ConstraintState object (see constraints.py) that tracks which
     constraints have been generated and using this information to
-    shape the beam for each input sentence.
+    shape the beam for each input sentence. The states of a sentence are
+    those of a ConstraintAutomaton compiled from its constraints.
     """
 
     def __init__(self, tgt_dict, representation):
@@ -232,23 +233,23 @@ class LexicallyConstrainedBeamSearch(Search):
         self.vocab_size = len(tgt_dict)
         self.num_cands = 0
         self.supports_constraints = True
+        # process the whole batch with tensor ops (step_batch) rather than
+        # one sentence at a time (step_sentence)
+        self.vectorized = True
 
     @torch.jit.export
     def init_constraints(self, batch_constraints: Optional[Tensor], beam_size: int):
         self.constraint_states = []
         for constraint_tensor in batch_constraints:
-            if self.representation == "ordered":
-                constraint_state = OrderedConstraintState.create(constraint_tensor)
-            elif self.representation == "unordered":
-                constraint_state = UnorderedConstraintState.create(constraint_tensor)
-
-            self.constraint_states.append([constraint_state for i in range(beam_size)])
+            automaton = ConstraintAutomaton.create(constraint_tensor, self.representation)
+            self.constraint_states.append([automaton.initial_state for i in range(beam_size)])
 
     @torch.jit.export
     def prune_sentences(self, batch_idxs: Tensor):
-        self.constraint_states = [
-            self.constraint_states[i] for i in batch_idxs.tolist()
-        ]
+        if self.constraint_states:
+            self.constraint_states = [
+                self.constraint_states[i] for i in batch_idxs.tolist()
+            ]
 
     @torch.jit.export
     def update_constraints(self, active_hypos: Tensor):
@@ -308,17 +309,11 @@ class LexicallyConstrainedBeamSearch(Search):
         # STEP 0: Preliminary. Prevent EOS for unfinished hyps across all batch items
         constraint_states = self.constraint_states
         if constraint_states and step > 0:
-            not_finished_indices = []
-            for sentno, sent_constraints in enumerate(constraint_states):
-                for beamno, state in enumerate(sent_constraints):
-                    index = sentno * beam_size + beamno
-                    if not state.finished:
-                        not_finished_indices.append(index)
-            not_finished_indices = torch.tensor(not_finished_indices)
-            if not_finished_indices.numel() > 0:
-                lprobs.view(batch_size * beam_size, -1)[
-                    not_finished_indices, self.eos
-                ] = -math.inf
+            not_finished = torch.tensor(
+                [[not state.finished for state in sent_constraints] for sent_constraints in constraint_states],
+                device=device,
+            )
+            lprobs[:, :, self.eos].masked_fill_(not_finished, -math.inf)
 
         if step == 0:
             # at the first step all hypotheses are equally likely, so use
@@ -356,6 +351,18 @@ class LexicallyConstrainedBeamSearch(Search):
             new_beams = torch.arange(0, beam_size, device=device).repeat(batch_size, 1)
             beams_buf = torch.cat((beams_buf, new_beams), dim=1)
 
+        if self.vectorized:
+            scores_buf, indices_buf, beams_buf, self.constraint_states = self.step_batch(
+                step, lprobs, constraint_states, beams_buf, indices_buf, scores_buf
+            )
+            new_scores_buf = scores_buf.new_zeros((batch_size, 2 * beam_size))
+            new_indices_buf = indices_buf.new_zeros((batch_size, 2 * beam_size))
+            new_beams_buf = beams_buf.new_zeros((batch_size, 2 * beam_size))
+            new_scores_buf[:, : self.num_cands] = scores_buf
+            new_indices_buf[:, : self.num_cands] = indices_buf
+            new_beams_buf[:, : self.num_cands] = beams_buf
+            return new_scores_buf, new_indices_buf, new_beams_buf
+
         # Now, process sentences in the batch one by one.
         new_scores_buf = torch.zeros((batch_size, 2 * beam_size), device=device)
         new_indices_buf = torch.zeros((batch_size, 2 * beam_size), device=device).long()
@@ -377,6 +384,127 @@ class LexicallyConstrainedBeamSearch(Search):
 
         return new_scores_buf, new_indices_buf, new_beams_buf
 
+    def step_batch(
+        self,
+        step: int,
+        lprobs: Tensor,
+        constraint_states: List[List[ConstraintState]],
+        beams_buf: Tensor,
+        indices_buf: Tensor,
+        scores_buf: Tensor,
+    ):
+        """Does the processing of step_sentence for all sentences at once.
+        The candidates of every sentence are kept in one row of
+        (batch size, candidates) tensors, the valid ones first, so the
+        sorts, de-duplication and striping are a few tensor ops over the
+        batch. Candidates are added in the order of step_sentence and the
+        sorts are stable, so both select the same candidates unless two of
+        them have exactly the same sort key, whose order the sorts of
+        step_sentence leave unspecified.
+        """
+        device = lprobs.device
+        batch_size = lprobs.size(0)
+
+        # STEP 2: Add all constraints for each beam item, padded to the
+        # largest number of next tokens. At the 0th time step, there is
+        # just one beam item
+        num_beams = lprobs.size(1)
+        next_tokens = [
+            [list(state.next_tokens()) for state in states[:num_beams]]
+            for states in constraint_states
+        ]
+        max_next = max(len(tokens) for beams in next_tokens for tokens in beams)
+        valid = torch.ones_like(indices_buf, dtype=torch.bool)
+        if max_next > 0:
+            next_valid = torch.tensor(
+                [[[i < len(tokens) for i in range(max_next)] for tokens in beams] for beams in next_tokens],
+                device=device,
+            )
+            next_tokens = torch.tensor(
+                [[tokens + [0] * (max_next - len(tokens)) for tokens in beams] for beams in next_tokens],
+                device=device,
+            ).long()
+            next_beams = torch.arange(num_beams, device=device).view(1, -1, 1).expand_as(next_tokens)
+            indices_buf = torch.cat((indices_buf, next_tokens.view(batch_size, -1)), dim=1)
+            beams_buf = torch.cat((beams_buf, next_beams.reshape(batch_size, -1)), dim=1)
+            scores_buf = torch.cat((scores_buf, lprobs.gather(2, next_tokens).view(batch_size, -1)), dim=1)
+            valid = torch.cat((valid, next_valid.view(batch_size, -1)), dim=1)
+            # move the padding to the end of the rows
+            order = (~valid).long().argsort(dim=1, stable=True)
+            indices_buf = indices_buf.gather(1, order)
+            beams_buf = beams_buf.gather(1, order)
+            scores_buf = scores_buf.gather(1, order)
+        num_valid = valid.sum(dim=1)
+        positions = torch.arange(indices_buf.size(1), device=device).unsqueeze(0)
+        valid = positions < num_valid.unsqueeze(1)
+
+        # STEP 3: Compute the new states and the "bank" of all candidates,
+        # see step_sentence. The states of a sentence are those of its
+        # constraint automaton, advanced with a lookup in its table
+        automata = [states[0].automaton for states in constraint_states]
+        beams_array = beams_buf.cpu().numpy()
+        indices_array = indices_buf.cpu().numpy()
+        new_ids = np.zeros_like(indices_array)
+        banks = np.zeros_like(indices_array)
+        for sentno, (states, automaton, n) in enumerate(zip(constraint_states, automata, num_valid.tolist())):
+            state_ids = np.array([state.id for state in states])
+            new_ids[sentno, :n] = automaton.advance_batch(state_ids[beams_array[sentno, :n]], indices_array[sentno, :n])
+            banks[sentno, :n] = automaton.banks[new_ids[sentno, :n]]
+        banks = torch.from_numpy(banks).to(device)
+
+        # STEP 4: Sort by keys (bank, score), the padding staying last
+        num_constraint_tokens = torch.tensor(
+            [len(automaton.tokens) for automaton in automata], device=device
+        ).unsqueeze(1)
+        MAX_SCORE = -100
+        sort_key = (num_constraint_tokens - banks) * MAX_SCORE + scores_buf
+        sort_key = sort_key.masked_fill(~valid, -math.inf)
+        _, sort_indices = sort_key.sort(dim=1, descending=True, stable=True)
+        scores_buf = scores_buf.gather(1, sort_indices)
+        indices_buf = indices_buf.gather(1, sort_indices)
+        beams_buf = beams_buf.gather(1, sort_indices)
+        banks = banks.gather(1, sort_indices)
+
+        # STEP 5: Remove duplicates, which the sort made adjacent. As in
+        # step_sentence, the first candidate is compared with the last one
+        uniques_key = beams_buf * (self.vocab_size + 1) + indices_buf
+        previous_key = uniques_key.roll(1, dims=1)
+        previous_key[:, 0] = uniques_key.gather(1, (num_valid - 1).unsqueeze(1)).squeeze(1)
+        uniques_mask = (previous_key != uniques_key) & valid
+        order = (~uniques_mask).long().argsort(dim=1, stable=True)
+        sort_indices = sort_indices.gather(1, order)
+        scores_buf = scores_buf.gather(1, order)
+        indices_buf = indices_buf.gather(1, order)
+        beams_buf = beams_buf.gather(1, order)
+        banks = banks.gather(1, order)
+        num_valid = uniques_mask.sum(dim=1)
+        valid = positions < num_valid.unsqueeze(1)
+
+        # STEP 6: Assign IDs round-robin across banks, see step_sentence.
+        # The count of a candidate in its bank is its distance to the start
+        # of its run of candidates of the same bank
+        run_starts = torch.ones_like(valid)
+        run_starts[:, 1:] = banks[:, 1:] != banks[:, :-1]
+        run_starts = torch.where(run_starts, positions, torch.zeros_like(positions)).cummax(dim=1)[0]
+        stripes = num_constraint_tokens - banks + (positions - run_starts) * (num_valid.unsqueeze(1) + 1)
+        stripes = stripes.masked_fill(~valid, torch.iinfo(stripes.dtype).max)
+
+        # STEP 7: Sort by the stripes values
+        _, stripe_indices = stripes.sort(dim=1, stable=True)
+        state_ids = np.take_along_axis(new_ids, sort_indices.gather(1, stripe_indices).cpu().numpy(), 1)
+        constraint_states = [
+            [automaton.states[i] for i in ids[:n]]
+            for automaton, ids, n in zip(automata, state_ids.tolist(), num_valid.tolist())
+        ]
+
+        # STEP 8: Truncate to the candidates size!
+        stripe_indices = stripe_indices[:, : self.num_cands]
+        scores_buf = scores_buf.gather(1, stripe_indices)
+        indices_buf = indices_buf.gather(1, stripe_indices)
+        beams_buf = beams_buf.gather(1, stripe_indices)
+
+        return scores_buf, indices_buf, beams_buf, constraint_states
+
     @torch.jit.export
     def step_sentence(
         self,
@@ -5,7 +5,8 @@
 
 import math
 import sys
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -122,6 +123,13 @@ class SequenceGenerator(nn.Module):
         self.should_set_src_lengths = (
             hasattr(self.search, "needs_src_lengths") and self.search.needs_src_lengths
         )
+        # prefix priming reproduces how plain beam search handles forced tokens
+        self.supports_prefix_priming = type(self.search) is search.BeamSearch
+        # optional PrefixStateCache reusing primed decoder states across calls
+        self.prefix_state_cache = None
+        # optional callable(step, tokens, scores) called after every search
+        # step with the active hypotheses, e.g. to stream partial outputs
+        self.step_callback = None
 
         self.model.eval()
 
@@ -200,6 +208,24 @@ class SequenceGenerator(nn.Module):
                 the list of constraints
             bos_token (int, optional): beginning of sentence token
                 (default: self.eos)
+            per_sentence_max_len (bool, optional): compute the maximum output
+                length (and the prefix/min-length rules) for each sentence from
+                its own source length, so that the output of a sentence does
+                not depend on the other sentences in the batch
+                (default: False)
+            prime_prefix (bool, optional): run the decoder over the leading
+                prefix tokens shared by all sentences in one parallel pass
+                and start beam search after them, instead of forcing them
+                one step at a time. The output is the same; this requires a
+                decoder that can be primed, see
+                :class:`~fairseq.models.transformer.TransformerDecoderBase`.
+                With a :class:`PrefixStateCache` in ``self.prefix_state_cache``,
+                the decoder state of the longest prefix shared with an earlier
+                call on the same source is reused (default: False)
+            encoder_outs (List[dict], optional): output of
+                ``self.model.forward_encoder`` on this sample, e.g. kept from
+                an earlier call on the same source; it is reordered for the
+                beams and not modified (default: None, run the encoder)
         """
         return self._generate(sample, **kwargs)
 
@@ -209,6 +235,9 @@ class SequenceGenerator(nn.Module):
         prefix_tokens: Optional[Tensor] = None,
         constraints: Optional[Tensor] = None,
         bos_token: Optional[int] = None,
+        per_sentence_max_len: bool = False,
+        encoder_outs: Optional[List[Dict[str, List[Tensor]]]] = None,
+        prime_prefix: bool = False,
     ):
         incremental_states = torch.jit.annotate(
             List[Dict[str, Dict[str, Optional[Tensor]]]],
@@ -266,16 +295,77 @@ class SequenceGenerator(nn.Module):
                 int(self.max_len_a * src_len + self.max_len_b),
                 self.max_len - 1,
             )
+        # per-sentence maximum lengths, laid out as (bsz * beam_size)
+        sent_max_lens: Optional[Tensor] = None
+        if per_sentence_max_len and not self.match_source_len:
+            sent_src_lens = src_tokens.ne(self.pad).long().sum(dim=1)
+            sent_max_lens = (
+                (sent_src_lens.double() * self.max_len_a + self.max_len_b)
+                .long()
+                .clamp(max=self.max_len - 1)
+            )
+            max_len = int(sent_max_lens.max().item())
+            assert (
+                self.min_len <= sent_max_lens.min().item()
+            ), "min_len cannot be larger than max_len, please adjust these!"
+            sent_max_lens = sent_max_lens.repeat_interleave(beam_size)
         assert (
             self.min_len <= max_len
         ), "min_len cannot be larger than max_len, please adjust these!"
         # compute the encoder output for each beam
-        with torch.autograd.profiler.record_function("EnsembleModel: forward_encoder"):
-            encoder_outs = self.model.forward_encoder(net_input)
+        if encoder_outs is None:
+            with torch.autograd.profiler.record_function(
+                "EnsembleModel: forward_encoder"
+            ):
+                encoder_outs = self.model.forward_encoder(net_input)
 
         # placeholder of indices for bsz * beam_size to hold tokens and accumulative scores
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
         new_order = new_order.to(src_tokens.device).long()
+
+        prime_len = 0
+        prefix_lprobs: Optional[Tensor] = None
+        prime_attn: Optional[Tensor] = None
+        if (
+            prime_prefix
+            and prefix_tokens is not None
+            and self.supports_prefix_priming
+            and self.lm_model is None
+            and self.repeat_ngram_blocker is None
+            and self.model.has_incremental_states()
+        ):
+            prime_len = self._prime_len(prefix_tokens, max_len, sent_max_lens)
+            if prime_len > 0:
+                # decode the forced steps 0 .. prime_len - 1 of each sentence
+                # in one pass, then copy the decoder state to all beams
+                prime_tokens = torch.cat(
+                    [
+                        prefix_tokens.new_full(
+                            (bsz, 1), self.eos if bos_token is None else bos_token
+                        ),
+                        prefix_tokens[:, : prime_len - 1],
+                    ],
+                    dim=1,
+                )
+                with torch.autograd.profiler.record_function(
+                    "EnsembleModel: forward_decoder"
+                ):
+                    if self.prefix_state_cache is not None and bsz == 1:
+                        prefix_lprobs, prime_attn = self._prime_from_cache(
+                            src_tokens,
+                            prime_tokens,
+                            prefix_tokens[:, :prime_len],
+                            encoder_outs,
+                            incremental_states,
+                        )
+                    else:
+                        prefix_lprobs, prime_attn = self._prime_decoder(
+                            prime_tokens,
+                            prefix_tokens[:, :prime_len],
+                            encoder_outs,
+                            incremental_states,
+                        )
+                self.model.reorder_incremental_state(incremental_states, new_order)
         encoder_outs = self.model.reorder_encoder_out(encoder_outs, new_order)
         # ensure encoder_outs is a List.
         assert encoder_outs is not None
@@ -332,7 +422,12 @@ class SequenceGenerator(nn.Module):
         else:
             original_batch_idxs = torch.arange(0, bsz).type_as(tokens)
 
-        for step in range(max_len + 1):  # one extra step for EOS marker
+        if prefix_lprobs is not None and prefix_tokens is not None:
+            attn = self._prime_buffers(
+                prime_len, prefix_lprobs, prime_attn, prefix_tokens, tokens, scores, max_len
+            )
+
+        for step in range(prime_len, max_len + 1):  # one extra step for EOS marker
             # reorder decoder internal states based on the prev choice of beams
             if reorder_state is not None:
                 if batch_idxs is not None:
@@ -375,6 +470,11 @@ class SequenceGenerator(nn.Module):
             if step >= max_len:
                 lprobs[:, : self.eos] = -math.inf
                 lprobs[:, self.eos + 1 :] = -math.inf
+            elif sent_max_lens is not None:
+                max_len_mask = sent_max_lens.le(step)
+                if max_len_mask.any():
+                    lprobs[max_len_mask, : self.eos] = -math.inf
+                    lprobs[max_len_mask, self.eos + 1 :] = -math.inf
 
             # handle prefix tokens (possibly with different lengths)
             if (
@@ -382,9 +482,29 @@ class SequenceGenerator(nn.Module):
                 and step < prefix_tokens.size(1)
                 and step < max_len
             ):
-                lprobs, tokens, scores = self._prefix_tokens(
-                    step, lprobs, scores, tokens, prefix_tokens, beam_size
-                )
+                if sent_max_lens is not None:
+                    # sentences that reached their own max length or exhausted
+                    # their prefix are decoded as if no prefix was given
+                    step_prefix_tokens = prefix_tokens.clone()
+                    step_prefix_tokens[
+                        sent_max_lens.view(-1, beam_size)[:, 0].le(step), step
+                    ] = self.pad
+                    lprobs, tokens, scores = self._prefix_tokens(
+                        step, lprobs, scores, tokens, step_prefix_tokens, beam_size
+                    )
+                    free_mask = (
+                        step_prefix_tokens[:, step].eq(self.pad).repeat_interleave(beam_size)
+                    )
+                    if step < self.min_len:
+                        lprobs[free_mask, self.eos] = -math.inf
+                    if self.token_indices_to_suppress is not None:
+                        lprobs[
+                            free_mask.nonzero().view(-1, 1), self.token_indices_to_suppress
+                        ] = -math.inf
+                else:
+                    lprobs, tokens, scores = self._prefix_tokens(
+                        step, lprobs, scores, tokens, prefix_tokens, beam_size
+                    )
             else:
                 if step < self.min_len:
                     # minimum length constraint (does not apply if using prefix_tokens)
@@ -459,6 +579,7 @@ class SequenceGenerator(nn.Module):
                     attn,
                     src_lengths,
                     max_len,
+                    sent_max_lens,
                 )
                 num_remaining_sent -= len(finalized_sents)
 
@@ -496,6 +617,8 @@ class SequenceGenerator(nn.Module):
 
                 if prefix_tokens is not None:
                     prefix_tokens = prefix_tokens[batch_idxs]
+                if sent_max_lens is not None:
+                    sent_max_lens = sent_max_lens.view(bsz, -1)[batch_idxs].view(-1)
                 src_lengths = src_lengths[batch_idxs]
                 cands_to_ignore = cands_to_ignore[batch_idxs]
 
@@ -572,6 +695,9 @@ class SequenceGenerator(nn.Module):
                     attn[:, :, : step + 2], dim=0, index=active_bbsz_idx
                 )
 
+            if self.step_callback is not None:
+                self._on_step(step, tokens, scores, bsz, beam_size)
+
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
@@ -587,6 +713,105 @@ class SequenceGenerator(nn.Module):
             )
         return finalized
 
+    def _prime_len(
+        self, prefix_tokens, max_len: int, sent_max_lens: Optional[Tensor]
+    ) -> int:
+        """Number of leading steps at which every sentence is forced to a
+        prefix token other than eos."""
+        forced = prefix_tokens.ne(self.pad) & prefix_tokens.ne(self.eos)
+        prime_len = int(forced.long().cumprod(dim=1).sum(dim=1).min().item())
+        prime_len = min(prime_len, max_len)
+        if sent_max_lens is not None:
+            prime_len = min(prime_len, int(sent_max_lens.min().item()))
+        return prime_len
+
+    def _prime_decoder(
+        self,
+        prime_tokens,
+        targets,
+        encoder_outs: Optional[List[Dict[str, List[Tensor]]]],
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+    ):
+        """Extend the incremental states with the prime tokens they do not
+        hold yet, and return the log-probabilities of *targets* (the forced
+        tokens at those positions) and the attention there."""
+        assert encoder_outs is not None
+        lprobs, attn = self.model.forward_decoder(
+            prime_tokens,
+            encoder_outs,
+            incremental_states,
+            self.temperature,
+            all_positions=True,
+        )
+        return lprobs.gather(-1, targets.unsqueeze(-1)).squeeze(-1), attn
+
+    @torch.jit.unused
+    def _on_step(self, step: int, tokens, scores, bsz: int, beam_size: int):
+        """Pass the active hypotheses after a search step to
+        ``self.step_callback``: their tokens (bsz x beam x step + 2, with
+        the leading bos) and their cumulative scores (bsz x beam), for the
+        sentences still being decoded."""
+        self.step_callback(
+            step,
+            tokens.view(bsz, beam_size, -1)[:, :, : step + 2],
+            scores.view(bsz, beam_size, -1)[:, :, step],
+        )
+
+    @torch.jit.unused
+    def _prime_from_cache(
+        self,
+        src_tokens,
+        prime_tokens,
+        targets,
+        encoder_outs: Optional[List[Dict[str, List[Tensor]]]],
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        return self.prefix_state_cache.prime(
+            self, src_tokens, prime_tokens, targets, encoder_outs, incremental_states
+        )
+
+    def _prime_buffers(
+        self,
+        prime_len: int,
+        prefix_lprobs,
+        prime_attn: Optional[Tensor],
+        prefix_tokens,
+        tokens,
+        scores,
+        max_len: int,
+    ) -> Optional[Tensor]:
+        """Fill tokens, scores and attention as if the first prime_len steps
+        had been forced by _prefix_tokens: only the first beam of each
+        sentence survives them, the other beams have a score of -inf."""
+        beam_size = self.beam_size
+        bsz = prefix_tokens.size(0)
+        prime_prefix = prefix_tokens[:, :prime_len]
+        prefix_lprobs = prefix_lprobs.clone()
+        prefix_lprobs[prefix_lprobs != prefix_lprobs] = torch.tensor(-math.inf).to(
+            prefix_lprobs
+        )
+        prefix_lprobs[prime_prefix.eq(self.unk)] -= self.unk_penalty
+
+        # accumulate step by step, as the search does
+        beam_scores = torch.full(
+            (bsz, beam_size, prime_len), -math.inf
+        ).to(prefix_lprobs)
+        beam_scores[:, 0, 0] = prefix_lprobs[:, 0]
+        for step in range(1, prime_len):
+            beam_scores[:, 0, step] = beam_scores[:, 0, step - 1] + prefix_lprobs[:, step]
+        scores[:, :prime_len] = beam_scores.view(bsz * beam_size, prime_len)
+        tokens[:, 1 : prime_len + 1] = prime_prefix.repeat_interleave(beam_size, dim=0)
+
+        attn: Optional[Tensor] = None
+        if prime_attn is not None:
+            attn = torch.empty(
+                bsz * beam_size, prime_attn.size(2), max_len + 2
+            ).to(scores)
+            attn[:, :, 1 : prime_len + 1] = prime_attn.transpose(1, 2).repeat_interleave(
+                beam_size, dim=0
+            )
+        return attn
+
     def _prefix_tokens(
         self, step: int, lprobs, scores, tokens, prefix_tokens, beam_size: int
     ):
@@ -634,6 +859,7 @@ class SequenceGenerator(nn.Module):
         attn: Optional[Tensor],
         src_lengths,
         max_len: int,
+        sent_max_lens: Optional[Tensor] = None,
     ):
         """Finalize hypothesis, store finalized information in `finalized`, and change `finished` accordingly.
         A sentence is finalized when {beam_size} finished items have been collected for it.
@@ -724,8 +950,11 @@ class SequenceGenerator(nn.Module):
             unique_sent: int = unique_s >> 32
             unique_unfin_idx: int = unique_s - (unique_sent << 32)
 
+            sent_max_len = max_len
+            if sent_max_lens is not None:
+                sent_max_len = int(sent_max_lens[unique_unfin_idx * beam_size].item())
             if not finished[unique_sent] and self.is_finished(
-                step, unique_unfin_idx, max_len, len(finalized[unique_sent]), beam_size
+                step, unique_unfin_idx, sent_max_len, len(finalized[unique_sent]), beam_size
             ):
                 finished[unique_sent] = True
                 newly_finished.append(unique_unfin_idx)
@@ -807,7 +1036,11 @@ class EnsembleModel(nn.Module):
         encoder_outs: List[Dict[str, List[Tensor]]],
         incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
         temperature: float = 1.0,
+        all_positions: bool = False,
     ):
+        """Log-probabilities and attention of the last position of tokens, or
+        of every position with all_positions (used to prime an empty
+        incremental state with several tokens)."""
         log_probs = []
         avg_attn: Optional[Tensor] = None
         encoder_out: Optional[Dict[str, List[Tensor]]] = None
@@ -838,17 +1071,20 @@ class EnsembleModel(nn.Module):
                         attn = attn_holder
                     elif attn_holder is not None:
                         attn = attn_holder[0]
-                if attn is not None:
+                if attn is not None and not all_positions:
                     attn = attn[:, -1, :]
 
             decoder_out_tuple = (
-                decoder_out[0][:, -1:, :].div_(temperature),
+                (decoder_out[0] if all_positions else decoder_out[0][:, -1:, :]).div_(
+                    temperature
+                ),
                 None if decoder_len <= 1 else decoder_out[1],
             )
             probs = model.get_normalized_probs(
                 decoder_out_tuple, log_probs=True, sample=None
             )
-            probs = probs[:, -1, :]
+            if not all_positions:
+                probs = probs[:, -1, :]
             if self.models_size == 1:
                 return probs, attn
 
@@ -1012,3 +1248,117 @@ class EnsembleModelWithAlignment(EnsembleModel):
         if len(self.models) > 1:
             avg_attn.div_(len(self.models))
         return avg_attn
+
+
+class PrefixStateCache(object):
+    """Keeps, for each source sentence, the decoder state primed with the
+    last prefix forced on it (see ``prime_prefix`` in
+    :func:`SequenceGenerator.generate`). A later call on the same source
+    truncates that state where its prefix diverges from the new one and only
+    runs the decoder over the tokens after that point, so decoding an
+    interactive session costs in proportion to the new material per turn.
+
+    States are kept in an LRU over sources bounded by *max_bytes*.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.computed_tokens = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def prime(
+        self, generator, src_tokens, prime_tokens, targets, encoder_outs, incremental_states
+    ):
+        """Prime the (empty) incremental states of a batch of one sentence
+        like :func:`SequenceGenerator._prime_decoder`, starting from the
+        cached state of the same source when there is one."""
+        key = tuple(src_tokens[0].tolist())
+        tokens = prime_tokens[0].tolist()
+        target_list = targets[0].tolist()
+
+        # a position can be reused when its inputs and its target are unchanged
+        reused = 0
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry["bytes"]
+            for old_token, new_token in zip(entry["tokens"], tokens):
+                if old_token != new_token:
+                    break
+                reused += 1
+            if reused > 0 and entry["targets"][reused - 1] != target_list[reused - 1]:
+                reused -= 1
+        if reused > 0:
+            self.hits += 1
+            for model, state, cached in zip(
+                generator.model.models, incremental_states, entry["states"]
+            ):
+                state.update(_copy_incremental_state(cached))
+                model.decoder.truncate_incremental_state(state, reused)
+            prefix_lprobs = entry["lprobs"][:, :reused]
+            attn = entry["attn"][:, :reused] if entry["attn"] is not None else None
+        else:
+            self.misses += 1
+            prefix_lprobs, attn = None, None
+
+        if reused < len(tokens):
+            new_lprobs, new_attn = generator._prime_decoder(
+                prime_tokens, targets[:, reused:], encoder_outs, incremental_states
+            )
+            if prefix_lprobs is None:
+                prefix_lprobs, attn = new_lprobs, new_attn
+            else:
+                prefix_lprobs = torch.cat([prefix_lprobs, new_lprobs], dim=1)
+                if attn is not None and new_attn is not None:
+                    attn = torch.cat([attn, new_attn], dim=1)
+                else:
+                    attn = None
+        self.reused_tokens += reused
+        self.computed_tokens += len(tokens) - reused
+
+        entry = {
+            "tokens": tokens,
+            "targets": target_list,
+            "states": [_copy_incremental_state(state) for state in incremental_states],
+            "lprobs": prefix_lprobs,
+            "attn": attn,
+        }
+        entry["bytes"] = sum(
+            t.element_size() * t.nelement()
+            for state in entry["states"]
+            for buffer in state.values()
+            for t in buffer.values()
+            if t is not None
+        ) + sum(
+            t.element_size() * t.nelement() for t in (prefix_lprobs, attn) if t is not None
+        )
+        self.entries[key] = entry
+        self.num_bytes += entry["bytes"]
+        while self.num_bytes > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted["bytes"]
+        return prefix_lprobs, attn
+
+    def cache_info(self):
+        total = self.reused_tokens + self.computed_tokens
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+            "computed_tokens": self.computed_tokens,
+            "token_hit_rate": self.reused_tokens / total if total > 0 else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.num_bytes,
+        }
+
+
+def _copy_incremental_state(incremental_state):
+    # the buffers are replaced, never modified in place, during decoding
+    return {key: dict(buffer) for key, buffer in incremental_state.items()}
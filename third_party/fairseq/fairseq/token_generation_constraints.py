@@ -18,6 +18,10 @@ There are two implementations:
 * OrderedConstraintState: Tracks progress through an ordered list of multitoken constraints.
 * UnorderedConstraintState: Tracks progress through an unordered list of multitoken constraints.
 
+Either can be compiled into a ConstraintAutomaton, whose states are integer
+IDs with their transitions in a table, so that advancing many beam items is
+an array lookup instead of building new state objects.
+
 The difference is that in the first, the constraints are assumed to be
 in order; the algorithm will permit zero or more tokens between them.
 In the second, the constraints are not ordered, so many orderings will
@@ -30,10 +34,13 @@ that many times in the output.
 from collections import Counter
 from typing import List, Optional, Set, Tuple
 
+import numpy as np
 import torch
 
 
 class ConstraintState:
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -504,3 +511,145 @@ class OrderedConstraintState(ConstraintState):
             next_state = OrderedConstraintState(self.sequence, -1)
 
         return next_state
+
+
+class ConstraintAutomaton:
+    """
+    Compiles the states of an OrderedConstraintState or an
+    UnorderedConstraintState into a deterministic automaton. States get
+    integer IDs in the order they are reached, and the transitions are
+    stored in a (states, columns) table, where column 0 stands for all the
+    tokens that are not in a constraint, which act the same, and column
+    i > 0 for the i-th constraint token. Transitions are computed on first
+    use with the state objects, whose number grows quickly with unordered
+    constraints, and read from the table afterwards.
+    """
+
+    def __init__(self, initial: ConstraintState):
+        # the ordered states keep the tokens as tensors
+        self.tokens = {int(token) for token in initial.tokens}
+        # sorted constraint tokens, then a sentinel for searchsorted
+        self.token_array = np.array(sorted(self.tokens) + [-1], dtype=np.int64)
+        self.columns = {token: i + 1 for i, token in enumerate(sorted(self.tokens))}
+
+        capacity = 16
+        self.transitions = np.full((capacity, len(self.tokens) + 1), -1, dtype=np.int64)
+        self.banks = np.zeros(capacity, dtype=np.int64)
+        self.references = []
+        self.keys = {}
+        self.states = []
+        self.initial_state = self.states[self.add(initial)]
+
+    @staticmethod
+    def create(constraint_tensor: torch.Tensor, representation: str = "ordered"):
+        if representation == "ordered":
+            return ConstraintAutomaton(OrderedConstraintState.create(constraint_tensor))
+        elif representation == "unordered":
+            return ConstraintAutomaton(UnorderedConstraintState.create(constraint_tensor))
+        raise ValueError(f"unknown constraints representation {representation}")
+
+    @staticmethod
+    def key(state: ConstraintState):
+        """What tells states apart."""
+        if isinstance(state, OrderedConstraintState):
+            return state.state
+        return (
+            id(state.node),
+            frozenset((id(node), n) for node, n in state.generated.items() if n),
+            frozenset((id(node), n) for node, n in state.completed.items() if n),
+        )
+
+    def add(self, reference: ConstraintState) -> int:
+        key = self.key(reference)
+        state_id = self.keys.get(key)
+        if state_id is not None:
+            return state_id
+        state_id = len(self.references)
+        if state_id == len(self.banks):
+            self.transitions = np.concatenate((self.transitions, np.full_like(self.transitions, -1)))
+            self.banks = np.concatenate((self.banks, np.zeros_like(self.banks)))
+        self.keys[key] = state_id
+        self.references.append(reference)
+        self.banks[state_id] = reference.bank
+        self.states.append(AutomatonState(self, state_id, reference))
+        return state_id
+
+    def column(self, token: int) -> int:
+        return self.columns.get(int(token), 0)
+
+    def transition(self, state_id: int, column: int) -> int:
+        next_id = self.transitions[state_id, column]
+        if next_id < 0:
+            token = self.token_array[column - 1] if column > 0 else -1
+            next_id = self.add(self.references[state_id].advance(token))
+            self.transitions[state_id, column] = next_id
+        return int(next_id)
+
+    def advance(self, state_id: int, token: int) -> int:
+        return self.transition(state_id, self.column(token))
+
+    def advance_batch(self, state_ids: np.ndarray, tokens: np.ndarray) -> np.ndarray:
+        """The states reached from each of state_ids by reading the token
+        at the same position of tokens."""
+        columns = np.searchsorted(self.token_array[:-1], tokens)
+        columns = np.where(self.token_array[columns] == tokens, columns + 1, 0)
+        next_ids = self.transitions[state_ids, columns]
+        for i in np.flatnonzero(next_ids < 0):
+            next_ids[i] = self.transition(state_ids[i], columns[i])
+        return next_ids
+
+
+class AutomatonState(ConstraintState):
+    """
+    A state of a ConstraintAutomaton. There is one object per state, shared
+    by all the beam items in that state.
+    """
+
+    __slots__ = (
+        "automaton",
+        "id",
+        "bank",
+        "num_completed",
+        "finished",
+        "is_root",
+        "name",
+        "next_token_set",
+        "description",
+    )
+
+    def __init__(self, automaton: ConstraintAutomaton, id: int, reference: ConstraintState):
+        self.automaton = automaton
+        self.id = id
+        self.bank = reference.bank
+        self.num_completed = reference.num_completed
+        self.finished = reference.finished
+        self.is_root = reference.is_root
+        self.name = reference.name
+        self.next_token_set = {int(token) for token in reference.next_tokens()}
+        self.description = str(reference)
+
+    def __str__(self):
+        return self.description
+
+    def copy(self):
+        # states are immutable
+        return self
+
+    @property
+    def tokens(self):
+        return self.automaton.tokens
+
+    @property
+    def token_counts(self):
+        return self.automaton.references[0].token_counts
+
+    @property
+    def num_constraint_tokens(self):
+        return self.automaton.references[0].num_constraint_tokens
+
+    def next_tokens(self) -> Set[int]:
+        return set(self.next_token_set)
+
+    def advance(self, token: int):
+        automaton = self.automaton
+        return automaton.states[automaton.advance(self.id, token)]
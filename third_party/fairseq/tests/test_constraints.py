@@ -6,9 +6,13 @@
 import unittest
 from typing import List
 
+import numpy as np
 import torch
 
+from fairseq.data import Dictionary
+from fairseq.search import LexicallyConstrainedBeamSearch
 from fairseq.token_generation_constraints import (
+    ConstraintAutomaton,
     ConstraintNode,
     OrderedConstraintState,
     UnorderedConstraintState,
@@ -271,5 +275,104 @@ class TestOrderedConstraintState(unittest.TestCase):
             ), f"TEST({tokens}) GOT: {result} WANTED: {expected}"
 
 
+class TestConstraintAutomaton(unittest.TestCase):
+    def setUp(self):
+        self.constraints = [
+            [],
+            [[5]],
+            [[1, 2], [1, 2]],
+            [[1], [2, 3]],
+            [[1, 2, 3], [1, 3], [1, 4], [4, 5, 6, 7], [1], [4, 5]],
+            [[3, 1, 2], [3], [4, 5, 6, 7]],
+        ]
+        self.attributes = ["bank", "num_completed", "finished", "is_root", "name"]
+
+    def compare(self, reference, state):
+        for attr in self.attributes:
+            assert getattr(reference, attr) == getattr(state, attr), f"{attr} of {reference} vs {state}"
+        assert {int(token) for token in reference.next_tokens()} == state.next_tokens()
+        assert {int(token) for token in reference.tokens} == state.tokens
+
+    def test_random_sequences(self):
+        """Automaton states follow the states they are compiled from."""
+        generator = torch.Generator().manual_seed(1)
+        for representation, state_class in (
+            ("ordered", OrderedConstraintState),
+            ("unordered", UnorderedConstraintState),
+        ):
+            for constraints in self.constraints:
+                packed = pack_constraints([tensorize(constraints)])[0]
+                automaton = ConstraintAutomaton.create(packed, representation)
+                for _ in range(20):
+                    reference = state_class.create(packed)
+                    state = automaton.initial_state
+                    self.compare(reference, state)
+                    # mostly constraint tokens, and some others
+                    for token in torch.randint(0, 10, (15,), generator=generator).tolist():
+                        reference = reference.advance(token)
+                        state = state.advance(token)
+                        self.compare(reference, state)
+
+    def test_advance_batch(self):
+        generator = torch.Generator().manual_seed(1)
+        packed = pack_constraints([tensorize(self.constraints[4])])[0]
+        for representation in ("ordered", "unordered"):
+            automaton = ConstraintAutomaton.create(packed, representation)
+            state_ids = np.zeros(8, dtype=np.int64)
+            for _ in range(10):
+                tokens = torch.randint(0, 10, (8,), generator=generator).numpy()
+                expected = [automaton.advance(i, token) for i, token in zip(state_ids, tokens)]
+                state_ids = automaton.advance_batch(state_ids, tokens)
+                assert state_ids.tolist() == expected
+
+
+class TestLexicallyConstrainedBeamSearch(unittest.TestCase):
+    def setUp(self):
+        self.tgt_dict = Dictionary()
+        for i in range(20):
+            self.tgt_dict.add_symbol(str(i))
+        self.vocab_size = len(self.tgt_dict)
+
+    def random_constraints(self, generator, batch_size, num_constraints):
+        return pack_constraints([
+            [
+                torch.randint(4, self.vocab_size, (torch.randint(1, 4, (1,), generator=generator).item(),), generator=generator)
+                for _ in range(torch.randint(0, num_constraints + 1, (1,), generator=generator).item())
+            ]
+            for _ in range(batch_size)
+        ])
+
+    def test_vectorized_step(self):
+        """The batched step selects the same candidates as the per-sentence one."""
+        generator = torch.Generator().manual_seed(1)
+        for representation in ("ordered", "unordered"):
+            for beam_size in (1, 2, 5):
+                for num_constraints in (1, 3):
+                    batch_size = 3
+                    constraints = self.random_constraints(generator, batch_size, num_constraints)
+                    searches = []
+                    for vectorized in (False, True):
+                        search = LexicallyConstrainedBeamSearch(self.tgt_dict, representation)
+                        search.vectorized = vectorized
+                        search.init_constraints(constraints, beam_size)
+                        searches.append(search)
+                    scores = torch.zeros(batch_size, beam_size, 0)
+                    for step in range(8):
+                        lprobs = torch.randn(batch_size, beam_size, self.vocab_size, generator=generator).log_softmax(-1)
+                        outputs = [search.step(step, lprobs.clone(), scores) for search in searches]
+                        for expected, result in zip(*outputs):
+                            assert torch.equal(expected, result), f"{representation} beam {beam_size} step {step}"
+                        cand_scores, _, _ = outputs[0]
+                        active_hypos = torch.arange(beam_size).repeat(batch_size, 1)
+                        for search in searches:
+                            search.update_constraints(active_hypos)
+                        expected, result = [
+                            [[(state.bank, state.num_completed) for state in states] for states in search.constraint_states]
+                            for search in searches
+                        ]
+                        assert expected == result
+                        scores = torch.cat((scores, cand_scores[:, :beam_size].unsqueeze(2)), dim=2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -16,7 +16,11 @@ from fairseq import search
 from fairseq.data.dictionary import Dictionary
 from fairseq.models.transformer import TransformerModel
 from fairseq.ngram_repeat_block import NGramRepeatBlock
-from fairseq.sequence_generator import EnsembleModel, SequenceGenerator
+from fairseq.sequence_generator import (
+    EnsembleModel,
+    PrefixStateCache,
+    SequenceGenerator,
+)
 from fairseq.tasks.fairseq_task import LegacyFairseqTask
 
 DEFAULT_TEST_VOCAB_SIZE = 100
@@ -166,6 +170,72 @@ class TestJitSequenceGenerator(TestJitSequenceGeneratorBase):
         torch.jit.script(ensemble_models)
 
 
+class TestPrefixPriming(TestJitSequenceGeneratorBase):
+    def test_prime_prefix(self):
+        self.transformer_model.eval()
+        generator = SequenceGenerator(
+            [self.transformer_model],
+            self.task.tgt_dict,
+            beam_size=3,
+            max_len_b=12,
+        )
+        pad = self.task.tgt_dict.pad()
+        # prefixes of different lengths: the shared part is primed, the rest
+        # is still forced step by step
+        prefix_tokens = torch.LongTensor([[5, 6, 7, 8, 9], [10, 11, 12, pad, pad]])
+        hypos = generator.generate(
+            [self.transformer_model], self.sample, prefix_tokens=prefix_tokens
+        )
+        primed_hypos = generator.generate(
+            [self.transformer_model],
+            self.sample,
+            prefix_tokens=prefix_tokens,
+            prime_prefix=True,
+        )
+        for sent_hypos, sent_primed_hypos in zip(hypos, primed_hypos):
+            self.assertEqual(len(sent_hypos), len(sent_primed_hypos))
+            for hypo, primed_hypo in zip(sent_hypos, sent_primed_hypos):
+                self.assertHypoEqual(hypo, primed_hypo)
+
+    def test_prefix_state_cache(self):
+        self.transformer_model.eval()
+        generator = SequenceGenerator(
+            [self.transformer_model],
+            self.task.tgt_dict,
+            beam_size=3,
+            max_len_b=12,
+        )
+        cache = PrefixStateCache()
+        sample = {
+            "net_input": {
+                "src_tokens": self.sample["net_input"]["src_tokens"][:1],
+                "src_lengths": self.sample["net_input"]["src_lengths"][:1],
+            }
+        }
+        # a new prefix, an extension of it, a divergence and a shorter prefix
+        turns = [[5, 6, 7], [5, 6, 7, 8, 9], [5, 6, 10, 11], [5, 6], [5, 6, 10, 11]]
+        for prefix in turns:
+            prefix_tokens = torch.LongTensor([prefix])
+            generator.prefix_state_cache = None
+            hypos = generator.generate(
+                [self.transformer_model], sample, prefix_tokens=prefix_tokens
+            )
+            generator.prefix_state_cache = cache
+            cached_hypos = generator.generate(
+                [self.transformer_model],
+                sample,
+                prefix_tokens=prefix_tokens,
+                prime_prefix=True,
+            )
+            for hypo, cached_hypo in zip(hypos[0], cached_hypos[0]):
+                self.assertHypoEqual(hypo, cached_hypo)
+        info = cache.cache_info()
+        self.assertEqual(info["misses"], 1)
+        self.assertEqual(info["hits"], 4)
+        self.assertEqual(info["reused_tokens"], 3 + 2 + 2 + 2)
+        self.assertEqual(info["computed_tokens"], 3 + 2 + 2 + 0 + 2)
+
+
 class TestExportSearch(unittest.TestCase):
     def setUp(self):
         task, _ = get_dummy_task_and_parser()
@@ -245,6 +315,31 @@ class TestSequenceGenerator(TestSequenceGeneratorBase):
         self.assertHypoTokens(hypos[1][1], [w1, w2, eos])
         self.assertHypoScore(hypos[1][1], [0.7, 0.4, 0.6])
 
+    def test_step_callback(self):
+        generator = SequenceGenerator([self.model], self.tgt_dict, beam_size=2)
+        expected = generator.forward(self.sample)
+        steps = []
+        generator.step_callback = lambda step, tokens, scores: steps.append(
+            (step, tokens.clone(), scores.clone())
+        )
+        hypos = generator.forward(self.sample)
+        eos, w1, w2 = self.tgt_dict.eos(), self.w1, self.w2
+        for sent in range(2):
+            for beam in range(2):
+                self.assertTensorEqual(hypos[sent][beam]["tokens"], expected[sent][beam]["tokens"])
+        step, tokens, scores = steps[0]
+        self.assertEqual(step, 0)
+        self.assertEqual(tokens.size(), (2, 2, 2))
+        self.assertEqual(scores.size(), (2, 2))
+        # the best hypothesis of sentence 2 so far, after the leading eos
+        self.assertEqual(tokens[1, scores[1].argmax(), 1].item(), w1)
+        self.assertEqual([s for s, _, _ in steps], list(range(len(steps))))
+        # the finished hypotheses are left out, the active ones go on
+        step, tokens, scores = steps[1]
+        self.assertEqual(tokens[1, scores[1].argmax(), 1:].tolist(), [w1, w2])
+        self.assertEqual(tokens[0, scores[0].argmax(), 1:].tolist(), [w2, w1])
+        self.assertNotIn(eos, tokens[:, :, 1:].flatten().tolist())
+
     def test_without_normalization(self):
         # Sentence 1: unchanged from the normalized case
         # Sentence 2: beams swap order